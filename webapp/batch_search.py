@@ -0,0 +1,163 @@
+__author__ = 'dm'
+
+import argparse
+import collections
+import json
+import os
+import sys
+
+import numpy
+import engine.batch as batch
+import util.audio as audio
+
+
+def expand_queries(paths):
+    """
+    Lists the audio files of the given files and directories, directories recursively and in sorted order.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dir_path, dir_names, file_names in sorted(os.walk(path)):
+                dir_names.sort()
+                files.extend(os.path.join(dir_path, name) for name in sorted(file_names))
+        else:
+            files.append(path)
+    return files
+
+
+class JsonlWriter:
+    """
+    Writes one JSON line per query as soon as its results are ranked.
+    """
+    def __init__(self, f, tracks):
+        self.f = f
+        self.tracks = tracks
+
+    def write(self, i, entry):
+        record = {"query": entry["query"], "label": entry["label"]}
+        if entry["error"] is not None:
+            record["error"] = entry["error"]
+        else:
+            record["precision"] = entry["precision"]
+            record["results"] = [{"track_id": int(track_id), "signature_id": int(signature_id),
+                                  "path": self.tracks.get(int(track_id)), "similarity": float(similarity)}
+                                 for track_id, signature_id, similarity
+                                 in zip(entry["track_ids"], entry["signature_ids"], entry["similarities"])]
+        self.f.write(json.dumps(record) + "\n")
+
+    def close(self):
+        if self.f is sys.stdout:
+            self.f.flush()
+        else:
+            self.f.close()
+
+
+class NpyWriter:
+    """
+    Writes the track ids and similarities of the results of all queries to two memory-mapped .npy files,
+    one row per query in the order of the queries, padded with -1 and NaN. The queries are listed in a text file.
+    """
+    def __init__(self, prefix, queries, n_tracks):
+        shape = (len(queries), n_tracks)
+        self.track_ids = numpy.lib.format.open_memmap(prefix + "_track_ids.npy", mode='w+', dtype=numpy.int64,
+                                                      shape=shape)
+        self.similarities = numpy.lib.format.open_memmap(prefix + "_similarities.npy", mode='w+',
+                                                         dtype=numpy.float64, shape=shape)
+        self.track_ids[:] = -1
+        self.similarities[:] = numpy.nan
+        with open(prefix + "_queries.txt", "w") as f:
+            f.writelines(str(query) + "\n" for query in queries)
+
+    def write(self, i, entry):
+        if entry["error"] is None:
+            n = len(entry["track_ids"])
+            self.track_ids[i, :n] = entry["track_ids"]
+            self.similarities[i, :n] = entry["similarities"]
+
+    def close(self):
+        self.track_ids.flush()
+        self.similarities.flush()
+
+
+def report_precision(entries, n_tracks, f=sys.stderr):
+    """
+    Prints the mean precision@k over all labelled queries and per label.
+    """
+    per_label = collections.defaultdict(list)
+    for label, precision in entries:
+        per_label[label].append(precision)
+
+    all_precisions = [p for precisions in per_label.values() for p in precisions]
+    if len(all_precisions) == 0:
+        print("No query is labelled by a folder of the dataset, precision@" + str(n_tracks) + " is undefined", file=f)
+        return
+
+    print("precision@%d: %.4f over %d queries" % (n_tracks, numpy.mean(all_precisions), len(all_precisions)), file=f)
+    for label in sorted(per_label):
+        print("  %s: %.4f over %d queries" % (label, numpy.mean(per_label[label]), len(per_label[label])), file=f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Searches a dataset with many queries at once and writes the most "
+                                                 "similar tracks of every query as JSON lines or .npy files.")
+    parser.add_argument("dataset")
+    parser.add_argument("engine_class")
+    parser.add_argument("queries", nargs="*", help="Audio files or directories of audio files to search with")
+    parser.add_argument("--track-ids", type=int, nargs="+", default=[], help="Tracks of the dataset to search with")
+    parser.add_argument("--all-tracks", action="store_true",
+                        help="Search with every track of the dataset, e.g. for deduplication or leave-one-out "
+                             "evaluation")
+    parser.add_argument("--include-self", action="store_true",
+                        help="Keep a query's own track in its results when the query is a track of the dataset")
+    parser.add_argument("-n", "--n-tracks", type=int, default=10, help="Number of results per query, the k of "
+                                                                         "the reported precision@k")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of processes to extract and score on, defaults to the number of cores")
+    parser.add_argument("--block-size", type=int, default=batch.BLOCK_SIZE,
+                        help="Number of queries extracted and ranked at once")
+    parser.add_argument("--offset", type=float, default=0.0, help="Start of the part of query files to use in seconds")
+    parser.add_argument("--duration", type=float, default=None,
+                        help="Length of the part of query files to use in seconds, defaults to the rest of the file")
+    parser.add_argument("--segments", type=int, default=1,
+                        help="Number of parts of the duration spread over every query file, pooled into one query")
+    parser.add_argument("--format", choices=["jsonl", "npy"], default="jsonl")
+    parser.add_argument("--output", help="File to write JSON lines to instead of standard output, or prefix of "
+                                         "the .npy files")
+    args = parser.parse_args()
+    if args.n_tracks < 1:
+        parser.error("-n must be at least 1")
+
+    tracks = batch.dataset_tracks(args.dataset)
+    queries = expand_queries(args.queries) + args.track_ids
+    if args.all_tracks:
+        queries += sorted(tracks)
+    if len(queries) == 0:
+        parser.error("no queries given")
+
+    if args.format == "npy":
+        if not args.output:
+            parser.error("--format npy needs an --output prefix")
+        writer = NpyWriter(args.output, queries, args.n_tracks)
+    else:
+        writer = JsonlWriter(open(args.output, "w") if args.output else sys.stdout, tracks)
+
+    window = (args.offset, args.duration, args.segments, audio.DEFAULT_RATE)
+    precisions, n_failed = [], 0
+    results = batch.batch_search(queries, args.engine_class, args.dataset, n_tracks=args.n_tracks,
+                                 workers=args.workers, window=window, block_size=args.block_size,
+                                 include_self=args.include_self, tracks=tracks,
+                                 progress=lambda stage, fraction: print("Progress: %.1f%%" % (fraction * 100),
+                                                                        file=sys.stderr))
+    for i, entry in enumerate(results):
+        writer.write(i, entry)
+        if entry["error"] is not None:
+            n_failed += 1
+            print("Failed to search with " + str(entry["query"]) + ": " + entry["error"], file=sys.stderr)
+        elif entry["precision"] is not None:
+            precisions.append((entry["label"], entry["precision"]))
+    writer.close()
+
+    if n_failed > 0:
+        print(str(n_failed) + " of " + str(len(queries)) + " queries failed", file=sys.stderr)
+    report_precision(precisions, args.n_tracks)
@@ -0,0 +1,156 @@
+__author__ = 'dm'
+
+import argparse
+import contextlib
+import inspect
+import json
+import os
+import sys
+import time
+
+import numpy
+import engine.engine as engine
+import engine.search as srch
+import engine.store as signature_store
+
+DEFAULT_RATE = 22050
+DEFAULT_DURATIONS = [5, 30]
+DEFAULT_CATALOG_SIZES = [1000, 10000, 100000]
+
+
+def synthetic_tracks(rate=DEFAULT_RATE, durations=DEFAULT_DURATIONS, seed=0):
+    """
+    Generates deterministic synthetic audio: a chord of tones, white noise and a click track for every duration.
+    :return: Dictionary {case name: samples}
+    """
+    rng = numpy.random.RandomState(seed)
+    tracks = {}
+    for duration in durations:
+        t = numpy.arange(int(duration * rate)) / float(rate)
+
+        tones = sum(numpy.sin(2 * numpy.pi * f * t) for f in (220.0, 277.2, 329.6)) / 3
+        tracks["tones_" + str(duration) + "s"] = (0.5 * tones).astype(numpy.float32)
+
+        tracks["noise_" + str(duration) + "s"] = (0.1 * rng.randn(len(t))).astype(numpy.float32)
+
+        clicks = numpy.zeros(len(t), dtype=numpy.float32)
+        beat = int(rate * 60 / 120.0)  # 120 BPM
+        for start in range(0, len(t) - 64, beat):
+            clicks[start:start + 64] = numpy.hanning(64)
+        tracks["clicks_" + str(duration) + "s"] = clicks + (0.01 * rng.randn(len(t))).astype(numpy.float32)
+
+    return tracks
+
+
+def engine_classes():
+    return [cls for name, cls in sorted(inspect.getmembers(engine, inspect.isclass))
+            if issubclass(cls, engine.Engine) and not inspect.isabstract(cls)]
+
+
+def time_call(fn, repeats):
+    """
+    Runs fn repeatedly with standard output discarded.
+    :return: Tuple (median seconds, last return value)
+    """
+    times, result = [], None
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeats):
+            start = time.perf_counter()
+            result = fn()
+            times.append(time.perf_counter() - start)
+    return float(numpy.median(times)), result
+
+
+def synthetic_store(engine_class, signatures, n_signatures):
+    """
+    Builds an in-memory signature store of the given size by cycling through the extracted signatures.
+    """
+    packed = signature_store.pack_signatures(signatures)
+    rows = numpy.arange(n_signatures) % len(signatures)
+    arrays = engine_class.prepare_signatures({key: packed[key][rows] for key in packed})
+    ids = numpy.arange(n_signatures, dtype=numpy.int64)
+    return signature_store.SignatureStore(ids, ids, arrays)
+
+
+def run(durations, catalog_sizes, repeats, max_seconds, engine_names=None):
+    tracks = synthetic_tracks(durations=durations)
+    results = []
+
+    for engine_class in engine_classes():
+        if engine_names and engine_class.__name__ not in engine_names:
+            continue
+        name = engine_class.__name__
+        print("Benchmarking " + name, file=sys.stderr)
+
+        signatures = []
+        for case in sorted(tracks):
+            seconds, sig = time_call(lambda: engine_class.extract_signature(tracks[case], DEFAULT_RATE), repeats)
+            signatures.append(sig)
+            results.append({"benchmark": "extract_signature", "engine": name, "case": case, "seconds": seconds})
+
+        seconds, _ = time_call(lambda: engine_class.measure_similarity(signatures[0], signatures[-1]), repeats)
+        results.append({"benchmark": "measure_similarity", "engine": name, "case": "pair", "seconds": seconds})
+
+        query = signatures[0]
+        for n_signatures in sorted(catalog_sizes):
+            store = synthetic_store(engine_class, signatures, n_signatures)
+            seconds, _ = time_call(lambda: srch.scan_greatest_similarity(engine_class, query, store), repeats)
+            results.append({"benchmark": "search", "engine": name, "case": str(n_signatures), "seconds": seconds})
+
+            if seconds * max(catalog_sizes) / n_signatures > max_seconds and n_signatures < max(catalog_sizes):
+                print("Skipping larger catalogs for " + name, file=sys.stderr)
+                break
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Flags the results that are slower than the baseline by more than the threshold fraction.
+    :return: List of (result, baseline seconds) pairs
+    """
+    key = lambda r: (r["benchmark"], r["engine"], r["case"])
+    baseline_seconds = {key(r): r["seconds"] for r in baseline}
+
+    regressions = []
+    for result in results:
+        old = baseline_seconds.get(key(result))
+        if old is not None and result["seconds"] > old * (1 + threshold):
+            regressions.append((result, old))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Times signature extraction, similarity and search of every engine "
+                                                 "on synthetic audio and prints the results as JSON.")
+    parser.add_argument("--engines", nargs="+", help="Engine class names, defaults to all engines")
+    parser.add_argument("--durations", type=float, nargs="+", default=DEFAULT_DURATIONS,
+                        help="Durations of the synthetic tracks in seconds")
+    parser.add_argument("--catalog-sizes", type=int, nargs="+", default=DEFAULT_CATALOG_SIZES,
+                        help="Numbers of signatures to search through")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--max-seconds", type=float, default=60,
+                        help="Skip larger catalogs once a search is expected to take longer than this")
+    parser.add_argument("--output", help="File to write the results to instead of standard output")
+    parser.add_argument("--compare", help="Baseline results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="Slowdown relative to the baseline that counts as a regression")
+    args = parser.parse_args()
+
+    results = run(args.durations, args.catalog_sizes, args.repeats, args.max_seconds, args.engines)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for result, old in regressions:
+            print("REGRESSION " + result["benchmark"] + " " + result["engine"] + " " + result["case"] + ": " +
+                  "{0:.4f}s -> {1:.4f}s".format(old, result["seconds"]), file=sys.stderr)
+        if regressions:
+            exit(1)
@@ -1,11 +1,50 @@
+import sqlite3
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///asse.db'
 db = SQLAlchemy(app)
 
 
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    # WAL lets the web application read while preprocess.py writes
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+
+# Columns added to existing tables since the first schema, as (table, column, SQL type)
+ADDED_COLUMNS = [('track_signature', 'source_mtime', 'FLOAT'),
+                 ('track_signature', 'source_size', 'INTEGER')]
+
+
+def upgrade():
+    """
+    Brings a database created by an earlier version to the current schema, columns and indexes, without touching
+    its data.
+    Does nothing to an up-to-date database or to one create_database.py has not created yet.
+    """
+    with app.app_context(), db.engine.begin() as connection:
+        for table, column, column_type in ADDED_COLUMNS:
+            columns = [row[1] for row in connection.execute(text("PRAGMA table_info(" + table + ")"))]
+            if len(columns) > 0 and column not in columns:
+                connection.execute(text("ALTER TABLE " + table + " ADD COLUMN " + column + " " + column_type))
+
+        # Indexes of the models, e.g. those the lookups of preprocess.py and of searches rely on
+        for table in db.metadata.sorted_tables:
+            if len(list(connection.execute(text("PRAGMA table_info(" + table.name + ")")))) == 0:
+                continue
+            for index in table.indexes:
+                connection.execute(text("CREATE INDEX IF NOT EXISTS " + index.name + " ON " + table.name + " (" +
+                                        ", ".join(column.name for column in index.columns) + ")"))
+
+
 class EngineModel(db.Model):
     __tablename__ = 'engine_model'
 
@@ -35,9 +74,9 @@ class AudioTrack(db.Model):
 
     id = db.Column(db.Integer, db.Sequence('audio_track_id'), primary_key=True)
     name = db.Column(db.String(100))
-    path = db.Column(db.String(500))
+    path = db.Column(db.String(500), index=True)
 
-    dataset_name = db.Column(db.String(100), db.ForeignKey('dataset.name'))
+    dataset_name = db.Column(db.String(100), db.ForeignKey('dataset.name'), index=True)
     dataset = db.relationship("Dataset", backref=db.backref('tracks'))
 
     def __init__(self, name, path, dataset):
@@ -51,6 +90,7 @@ class AudioTrack(db.Model):
 
 class TrackSignature(db.Model):
     __tablename__ = 'track_signature'
+    __table_args__ = (db.Index('ix_track_signature_engine_track', 'engine_class', 'audio_track_id'),)
 
     id = db.Column(db.Integer, db.Sequence('track_signature_id'), primary_key=True)
     path = db.Column(db.String(500))
@@ -61,10 +101,16 @@ class TrackSignature(db.Model):
     audio_track_id = db.Column(db.Integer, db.ForeignKey('audio_track.id'))
     audio_track = db.relationship("AudioTrack", backref=db.backref('signatures'))
 
-    def __init__(self, path, engine_model, audio_track):
+    # State of the source file when the signature was extracted, used to skip unchanged files
+    source_mtime = db.Column(db.Float)
+    source_size = db.Column(db.Integer)
+
+    def __init__(self, path, engine_model, audio_track, source_mtime=None, source_size=None):
         self.path = path
         self.engine_model = engine_model
         self.audio_track = audio_track
+        self.source_mtime = source_mtime
+        self.source_size = source_size
 
     def __repr__(self):
         return '<TrackSignature engine: ' + self.engine_class + '| track: %r>' % self.audio_track.name
@@ -0,0 +1,212 @@
+__author__ = 'dm'
+
+import os
+import threading
+import numpy
+import numpy.linalg as linalg
+import engine.store as signature_store
+
+INDEX_FILENAME = "ann_index.npz"
+CHUNK_SIZE = 65536
+MAX_TRAINING_POINTS = 25000
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def whitening_matrix(covariances):
+    """
+    Inverse square root of the mean covariance matrix of a dataset.
+    """
+    mean_covariance = numpy.mean(covariances, axis=0)
+    eigenvalues, eigenvectors = linalg.eigh(mean_covariance)
+    return (eigenvectors / numpy.sqrt(numpy.maximum(eigenvalues, 1e-12))) @ eigenvectors.T
+
+
+def gaussian_embedding(means, covariances, whitening):
+    """
+    Maps Gaussians to vectors whose squared Euclidean distance approximates the symmetrized KL divergence
+    measure_similarity uses: the whitened mean followed by the upper triangle of the matrix logarithm
+    of the covariance, scaled so that the Frobenius distance of the logarithms is preserved.
+    :param means: Means (N x d)
+    :param covariances: Covariance matrices (N x d x d)
+    :param whitening: Whitening matrix of the dataset, see whitening_matrix
+    :return: Embeddings (N x (d + d(d+1)/2))
+    """
+    eigenvalues, eigenvectors = linalg.eigh(covariances)
+    log_covariances = numpy.einsum('nij,nj,nkj->nik', eigenvectors,
+                                   numpy.log(numpy.maximum(eigenvalues, 1e-12)), eigenvectors)
+
+    d = means.shape[1]
+    rows, cols = numpy.triu_indices(d)
+    scale = numpy.where(rows == cols, 1.0, numpy.sqrt(2.0)) * numpy.sqrt(0.5)
+
+    return numpy.hstack([means @ whitening.T, log_covariances[:, rows, cols] * scale])
+
+
+def squared_distances(x, centroids):
+    return numpy.sum(x ** 2, axis=1)[:, None] - 2 * x @ centroids.T + numpy.sum(centroids ** 2, axis=1)[None, :]
+
+
+def nearest_centroids(x, centroids):
+    labels = numpy.empty(len(x), dtype=numpy.int64)
+    for start in range(0, len(x), CHUNK_SIZE):
+        labels[start:start + CHUNK_SIZE] = numpy.argmin(squared_distances(x[start:start + CHUNK_SIZE], centroids), axis=1)
+    return labels
+
+
+def kmeans(x, n_clusters, n_iterations=20, seed=0):
+    """
+    Lloyd's k-means, initialized with randomly chosen points.
+    :return: Centroids (n_clusters x dim)
+    """
+    rng = numpy.random.RandomState(seed)
+    centroids = x[rng.choice(len(x), n_clusters, replace=False)].copy()
+    for _ in range(n_iterations):
+        labels = nearest_centroids(x, centroids)
+        counts = numpy.bincount(labels, minlength=n_clusters)
+        sums = numpy.zeros_like(centroids)
+        numpy.add.at(sums, labels, x)
+        non_empty = counts > 0
+        centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
+    return centroids
+
+
+class IVFPQIndex:
+    """
+    Inverted file index with product quantization: vectors are assigned to their nearest coarse centroid
+    and their residuals are compressed to one byte per subspace. A search scans only the lists of the
+    coarse centroids nearest to the query, with distances looked up in per-subspace tables.
+    """
+    def __init__(self, track_ids, whitening, coarse_centroids, codebooks, list_offsets, list_rows, codes):
+        self.track_ids = track_ids
+        self.whitening = whitening
+        self.coarse_centroids = coarse_centroids
+        self.codebooks = codebooks  # n_subspaces x n_codes x subspace dim
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows  # Rows sorted by their list
+        self.codes = codes  # N x n_subspaces, in row order
+
+    @classmethod
+    def build(cls, track_ids, means, covariances, n_lists=None, n_subspaces=32, n_codes=256, seed=0):
+        """
+        :param n_lists: Number of coarse centroids, defaults to the square root of the number of tracks
+        :param n_subspaces: Number of subspaces the residuals are quantized in, i.e. bytes per track
+        :param n_codes: Number of centroids per subspace
+        """
+        whitening = whitening_matrix(covariances)
+        x = gaussian_embedding(means, covariances, whitening)
+        n_rows = len(x)
+
+        # The quantizers are trained on a sample, all tracks are encoded
+        training = numpy.random.RandomState(seed).permutation(n_rows)[:MAX_TRAINING_POINTS]
+
+        n_lists = min(n_lists or max(1, int(numpy.sqrt(n_rows))), len(training))
+        coarse_centroids = kmeans(x[training], n_lists, seed=seed)
+        labels = nearest_centroids(x, coarse_centroids)
+        residuals = _pad(x - coarse_centroids[labels], n_subspaces)
+
+        n_codes = min(n_codes, len(training))
+        subspaces = numpy.split(residuals, n_subspaces, axis=1)
+        codebooks = numpy.stack([kmeans(sub[training], n_codes, seed=seed) for sub in subspaces])
+        codes = numpy.stack([nearest_centroids(sub, codebook) for sub, codebook in zip(subspaces, codebooks)],
+                            axis=1).astype(numpy.uint8 if n_codes <= 256 else numpy.uint16)
+
+        list_rows = numpy.argsort(labels, kind='stable')
+        list_offsets = numpy.searchsorted(labels[list_rows], numpy.arange(n_lists + 1))
+
+        return cls(numpy.asarray(track_ids), whitening, coarse_centroids, codebooks, list_offsets, list_rows, codes)
+
+    @classmethod
+    def load(cls, path):
+        with numpy.load(path) as f:
+            return cls(f['track_ids'], f['whitening'], f['coarse_centroids'], f['codebooks'], f['list_offsets'],
+                       f['list_rows'], f['codes'])
+
+    def save(self, path):
+        numpy.savez(path, track_ids=self.track_ids, whitening=self.whitening, coarse_centroids=self.coarse_centroids,
+                    codebooks=self.codebooks, list_offsets=self.list_offsets, list_rows=self.list_rows,
+                    codes=self.codes)
+
+    def matches(self, store):
+        return numpy.array_equal(self.track_ids, store.track_ids)
+
+    def search(self, means, covariance, n_candidates=100, n_probe=16):
+        """
+        Approximate nearest neighbours of one Gaussian.
+        :return: Rows of the n_candidates nearest embeddings found, nearest first
+        """
+        query = gaussian_embedding(means[None], covariance[None], self.whitening)[0]
+        n_probe = min(n_probe, len(self.coarse_centroids))
+        probed = numpy.argsort(squared_distances(query[None], self.coarse_centroids)[0])[:n_probe]
+
+        rows, distances = [], []
+        for list_id in probed:
+            list_rows = self.list_rows[self.list_offsets[list_id]:self.list_offsets[list_id + 1]]
+            if len(list_rows) == 0:
+                continue
+            residual = _pad((query - self.coarse_centroids[list_id])[None], len(self.codebooks))[0]
+            subqueries = numpy.split(residual, len(self.codebooks))
+            tables = numpy.stack([numpy.sum((codebook - sub) ** 2, axis=1)
+                                  for sub, codebook in zip(subqueries, self.codebooks)])
+            codes = self.codes[list_rows]
+            rows.append(list_rows)
+            distances.append(numpy.sum(tables[numpy.arange(len(self.codebooks)), codes], axis=1))
+
+        if len(rows) == 0:
+            return numpy.array([], dtype=numpy.int64)
+        rows = numpy.concatenate(rows)
+        distances = numpy.concatenate(distances)
+
+        n_candidates = min(n_candidates, len(rows))
+        nearest = numpy.argpartition(distances, n_candidates - 1)[:n_candidates]
+        return rows[nearest[numpy.argsort(distances[nearest], kind='stable')]]
+
+
+def _pad(x, n_subspaces):
+    # Zero-pad the dimension to a multiple of the number of subspaces
+    extra = -x.shape[1] % n_subspaces
+    return numpy.hstack([x, numpy.zeros((len(x), extra))]) if extra else x
+
+
+def index_path_for(dataset_name, engine_class, signature_dir=signature_store.SIGNATURE_PARENT_DIR):
+    return os.path.join(signature_store.signature_dir_for(dataset_name, engine_class, signature_dir), INDEX_FILENAME)
+
+
+def build_index(dataset_name, engine_class, signature_dir=signature_store.SIGNATURE_PARENT_DIR, **kwargs):
+    """
+    Builds the ANN index of a Gaussian engine's signatures and persists it next to them.
+    :param kwargs: Parameters of IVFPQIndex.build
+    :return: The index, or None if the dataset has fewer tracks than the index has lists
+    """
+    means_key, covariance_key = engine_class.get_gaussian_keys()
+    store = signature_store.get_store(dataset_name, engine_class, signature_dir)
+    if len(store) == 0 or len(store) < (kwargs.get('n_lists') or 1):
+        return None
+
+    index = IVFPQIndex.build(store.track_ids, store.arrays[means_key], store.arrays[covariance_key], **kwargs)
+    index.save(index_path_for(dataset_name, engine_class, signature_dir))
+
+    with _indexes_lock:
+        _indexes[(dataset_name, engine_class.__name__, signature_dir)] = (store, index)
+
+    return index
+
+
+def get_index(dataset_name, engine_class, store, signature_dir=signature_store.SIGNATURE_PARENT_DIR):
+    """
+    Returns the persisted ANN index matching the given store, or None if there is none or it is out of date.
+    """
+    key = (dataset_name, engine_class.__name__, signature_dir)
+    with _indexes_lock:
+        cached = _indexes.get(key)
+        if cached is not None and cached[0] is store:
+            return cached[1]
+
+        path = index_path_for(dataset_name, engine_class, signature_dir)
+        index = IVFPQIndex.load(path) if os.path.isfile(path) else None
+        if index is not None and not index.matches(store):
+            index = None
+
+        _indexes[key] = (store, index)
+        return index
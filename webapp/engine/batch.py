@@ -0,0 +1,198 @@
+__author__ = 'dm'
+
+import atexit
+import contextlib
+import os
+import threading
+import numpy
+import db.database as db
+import engine.engine as engine
+import engine.store as signature_store
+import engine.parallel as parallel
+import engine.search as search
+import util.audio as audio
+
+BLOCK_SIZE = 64
+SCORING_TASK_SIZE = 16  # Queries scored by one task of a worker process
+
+# Extraction pools by number of processes, shared by all batches and kept for the life of the process
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def dataset_tracks(dataset_id):
+    """
+    :return: Dictionary {track id: path of the audio file} of a dataset
+    """
+    return {track.id: track.path for track in db.AudioTrack.query.filter_by(dataset_name=dataset_id)}
+
+
+def folder_label(path):
+    # The folders of a dataset are its labels, e.g. the genres of GTZAN
+    return os.path.basename(os.path.dirname(path))
+
+
+def get_pool(workers):
+    """
+    Returns the shared pool of processes that extracts query files, started on first use.
+    Batches may run on several threads of the web application at once; they all submit to the same pool.
+    """
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            pool = parallel.MP_CONTEXT.Pool(workers)
+            _pools[workers] = pool
+        return pool
+
+
+@atexit.register
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+            pool.join()
+        _pools.clear()
+
+
+def extract_query(job):
+    """
+    Decodes a query file and extracts its signature. Runs in a worker process.
+    :param job: Tuple (path, engine class name, window (offset, duration, number of segments, sampling rate) or None)
+    :return: Tuple (path, signature or None, error message or None)
+    """
+    path, engine_classname, window = job
+    offset, duration, n_segments, sr = window or (0.0, None, 1, audio.DEFAULT_RATE)
+    try:
+        segments, rate = audio.load_segments(path, sr, offset=offset, duration=duration, n_segments=n_segments)
+        sig = search.extract_query_signature(getattr(engine, engine_classname),
+                                             segments if len(segments) > 1 else segments[0], rate)
+        return path, sig, None
+    except Exception as e:
+        return path, None, repr(e)
+
+
+def score_queries(engine_class, arrays, task):
+    """
+    Ranks the stored signatures for a block of query signatures. Runs in this process or on the workers of a
+    parallel.ShardedSearcher, against the same resident signature arrays for every block.
+    :param task: Tuple (list of query signatures, number of results, list of a row to leave out or None per query)
+    :return: List of (rows, similarities) per query, most similar first
+    """
+    signatures, n_tracks, excluded_rows = task
+    ranked = []
+    for sig, excluded_row in zip(signatures, excluded_rows):
+        measures = search.normalize_similarities(engine_class.measure_similarity_batch(sig, arrays), engine_class)
+        measures = numpy.array(measures, dtype=float)
+        if excluded_row is not None:
+            measures[excluded_row] = -numpy.inf
+
+        n = min(n_tracks, int(numpy.isfinite(measures).sum()))
+        if n == 0:
+            ranked.append((numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0)))
+            continue
+        top = numpy.argpartition(-measures, n - 1)[:n]
+        top = top[numpy.argsort(-measures[top], kind='stable')]
+        ranked.append((top, measures[top]))
+    return ranked
+
+
+def batch_search(queries, engine_classname, dataset_id, signature_dir=signature_store.SIGNATURE_PARENT_DIR,
+                 n_tracks=10, workers=None, window=None, block_size=BLOCK_SIZE, include_self=False, tracks=None,
+                 progress=None):
+    """
+    Searches a dataset with many queries at once. Query files are decoded and extracted on the shared pool of
+    get_pool; queries by track id use the stored signature of the track. Each block of queries is then ranked
+    against the dataset's signatures, loaded once for the whole batch, so the full query x reference matrix is
+    never held.
+    :param queries: List of paths of audio files and ids (int) of tracks of the dataset
+    :param workers: Number of processes to extract and score on; None or 1 works in this process
+    :param window: Tuple (offset, duration, number of segments, sampling rate) of the part of query files to use,
+    see util.audio.load_segments, or None for whole files
+    :param include_self: Keep a query's own track in its results if the query is a track of the dataset
+    :param tracks: Dictionary {track id: path} of the dataset as returned by dataset_tracks, loaded if None
+    :param progress: Optional function progress(stage, fraction) called after every block
+    :return: Generator of {"query", "label", "track_ids", "signature_ids", "similarities", "precision", "error"}
+    dictionaries in the order of the queries. label is the folder of the query; precision is the fraction of
+    the results in the same folder, or None if no track of the dataset is in it
+    """
+    engine_class = getattr(engine, engine_classname)
+    store = signature_store.get_store(dataset_id, engine_class, signature_dir)
+    tracks = dataset_tracks(dataset_id) if tracks is None else tracks
+    row_of_track = {int(track_id): row for row, track_id in enumerate(store.track_ids)}
+    track_of_path = {os.path.abspath(path): track_id for track_id, path in tracks.items()}
+    row_labels = numpy.array([folder_label(tracks.get(int(track_id), "")) for track_id in store.track_ids])
+    known_labels = set(row_labels) - {""}
+
+    pool = None
+    if workers is not None and workers > 1 and any(not isinstance(q, (int, numpy.integer)) for q in queries):
+        pool = get_pool(workers)
+    with contextlib.ExitStack() as stack:
+        searcher = None
+        if workers is not None and workers > 1 and len(store) > 0:
+            searcher = stack.enter_context(parallel.get_searcher(dataset_id, engine_class, store, signature_dir,
+                                                                 workers))
+
+        for start in range(0, len(queries), block_size):
+            block = queries[start:start + block_size]
+            yield from _search_block(block, engine_class, store, tracks, row_of_track, track_of_path,
+                                     row_labels, known_labels, n_tracks, window, include_self, pool, searcher)
+            if progress is not None:
+                progress("batch", min(start + block_size, len(queries)) / len(queries))
+
+
+def _search_block(block, engine_class, store, tracks, row_of_track, track_of_path, row_labels, known_labels,
+                  n_tracks, window, include_self, pool, searcher):
+    paths = [query for query in block if not isinstance(query, (int, numpy.integer))]
+    jobs = [(path, engine_class.__name__, window) for path in paths]
+    extracted = pool.map(extract_query, jobs) if pool is not None else [extract_query(job) for job in jobs]
+    extracted = {path: (sig, error) for path, sig, error in extracted}
+
+    entries, signatures, excluded_rows = [], [], []
+    for query in block:
+        if isinstance(query, (int, numpy.integer)):
+            row = row_of_track.get(int(query))
+            path = tracks.get(int(query))
+            sig, error = (store.signature(row), None) if row is not None else (None, "No signature of the track")
+        else:
+            path = query
+            sig, error = extracted[query]
+            track_id = track_of_path.get(os.path.abspath(query))
+            row = row_of_track.get(track_id) if track_id is not None else None
+
+        label = folder_label(path) if path is not None else None
+        entries.append({"query": query, "label": label, "error": error})
+        if sig is not None:
+            signatures.append(sig)
+            excluded_rows.append(None if include_self else row)
+
+    ranked = []
+    if len(signatures) > 0:
+        tasks = [(signatures[i:i + SCORING_TASK_SIZE], n_tracks, excluded_rows[i:i + SCORING_TASK_SIZE])
+                 for i in range(0, len(signatures), SCORING_TASK_SIZE)]
+        if searcher is not None:
+            results = searcher.map_rows(score_queries, tasks)
+        else:
+            results = (score_queries(engine_class, store.arrays, task) for task in tasks)
+        ranked = [r for result in results for r in result]
+
+    ranked = iter(ranked)
+    for entry in entries:
+        if entry["error"] is None:
+            rows, similarities = next(ranked)
+            entry["track_ids"] = store.track_ids[rows]
+            entry["signature_ids"] = store.signature_ids[rows]
+            entry["similarities"] = similarities
+            entry["precision"] = precision_at_k(entry["label"], row_labels[rows], n_tracks) \
+                if entry["label"] in known_labels else None
+        else:
+            entry["track_ids"] = entry["signature_ids"] = entry["similarities"] = entry["precision"] = None
+        yield entry
+
+
+def precision_at_k(label, result_labels, k):
+    """
+    Fraction of the first k results that have the query's label.
+    """
+    if k <= 0:
+        return None
+    return float(numpy.sum(numpy.asarray(result_labels[:k]) == label)) / k
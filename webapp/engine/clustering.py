@@ -0,0 +1,144 @@
+__author__ = 'dm'
+
+import contextlib
+import numpy
+import sklearn.cluster as cluster
+
+try:
+    import threadpoolctl
+except ImportError:
+    threadpoolctl = None
+
+BACKENDS = ('kmeans', 'minibatch', 'quantile', 'optimal1d')
+DEFAULT_SEED = 0
+DEFAULT_MAX_ITER = 100
+DEFAULT_N_INIT = 3
+
+
+def cluster_labels(samples, n_clusters, backend='kmeans', seed=DEFAULT_SEED, max_iter=DEFAULT_MAX_ITER):
+    """
+    Clusters the frames of a track deterministically, on a single thread.
+    kmeans and minibatch run scikit-learn with a fixed seed and iteration budget; quantile and optimal1d
+    only apply to one-dimensional frames, optimal1d finding the exact k-means optimum.
+    Clusters may be empty when there are fewer distinct frames than clusters.
+    :param samples: Frames (N x d)
+    :param n_clusters: Number of clusters
+    :param backend: One of BACKENDS
+    :return: Array of N cluster labels in range(n_clusters)
+    """
+    samples = numpy.asarray(samples, dtype=numpy.float64)
+    if samples.ndim == 1:
+        samples = samples[:, None]
+
+    if backend in ('quantile', 'optimal1d'):
+        if samples.shape[1] != 1:
+            raise ValueError("The " + backend + " clustering backend needs one-dimensional frames")
+        if backend == 'quantile':
+            return quantile_labels(samples[:, 0], n_clusters)
+        return optimal_1d_labels(samples[:, 0], n_clusters)
+
+    if backend == 'kmeans':
+        model = cluster.KMeans(n_clusters=n_clusters, n_init=DEFAULT_N_INIT, max_iter=max_iter, random_state=seed)
+    elif backend == 'minibatch':
+        model = cluster.MiniBatchKMeans(n_clusters=n_clusters, n_init=DEFAULT_N_INIT, max_iter=max_iter,
+                                        random_state=seed)
+    else:
+        raise ValueError("Unknown clustering backend " + str(backend) + ", expected one of " + str(BACKENDS))
+
+    with _single_threaded():
+        return model.fit_predict(samples)
+
+
+@contextlib.contextmanager
+def _single_threaded():
+    # scikit-learn parallelizes k-means over OpenMP threads, which oversubscribes the cores of a worker pool
+    if threadpoolctl is None:
+        yield
+    else:
+        with threadpoolctl.threadpool_limits(limits=1):
+            yield
+
+
+def quantile_labels(values, n_clusters):
+    """
+    Splits the values into bins holding equally many of them.
+    """
+    edges = numpy.quantile(values, numpy.linspace(0, 1, n_clusters + 1)[1:-1])
+    return numpy.searchsorted(edges, values, side='right')
+
+
+def optimal_1d_labels(values, n_clusters):
+    """
+    Exact one-dimensional k-means by dynamic programming over the sorted distinct values, weighted by their counts.
+    Clusters are numbered in increasing order of their values.
+    """
+    unique, inverse, counts = numpy.unique(values, return_inverse=True, return_counts=True)
+    n = len(unique)
+    if n <= n_clusters:
+        return inverse.reshape(-1)
+
+    # Prefix sums give the sum of squared errors of any run of sorted values in constant time
+    x = unique - numpy.average(unique, weights=counts)
+    w_sums = numpy.concatenate([[0], numpy.cumsum(counts)])
+    x_sums = numpy.concatenate([[0], numpy.cumsum(counts * x)])
+    xx_sums = numpy.concatenate([[0], numpy.cumsum(counts * x * x)])
+
+    def cost(i, j):
+        # Sum of squared errors of the values i..j inclusive
+        w = w_sums[j + 1] - w_sums[i]
+        s = x_sums[j + 1] - x_sums[i]
+        return numpy.maximum(xx_sums[j + 1] - xx_sums[i] - s * s / w, 0)
+
+    ends = numpy.arange(n)
+    costs = cost(numpy.zeros(n, dtype=int), ends)
+    starts = numpy.zeros((n_clusters, n), dtype=int)  # Start of the last cluster of the optimal clustering of 0..j
+    for m in range(1, n_clusters):
+        costs, starts[m] = _optimal_layer(costs, cost, m, n)
+
+    labels = numpy.empty(n, dtype=int)
+    j = n - 1
+    for m in range(n_clusters - 1, -1, -1):
+        i = starts[m, j]
+        labels[i:j + 1] = m
+        j = i - 1
+
+    return labels[inverse.reshape(-1)]
+
+
+def _optimal_layer(previous, cost, m, n):
+    """
+    One step of the dynamic program: the optimal clustering of values 0..j into m + 1 clusters for every j,
+    given the optimal costs for m clusters. The optimal start of the last cluster does not decrease with j,
+    so the ends are solved by divide and conquer, all subproblems of one recursion depth at once.
+    :return: Tuple (costs, starts of the last cluster)
+    """
+    costs = numpy.full(n, numpy.inf)
+    starts = numpy.zeros(n, dtype=int)
+
+    # Subproblems: ends j_low..j_high whose last cluster starts within i_low..i_high
+    j_low, j_high = numpy.array([m]), numpy.array([n - 1])
+    i_low, i_high = numpy.array([m]), numpy.array([n - 1])
+    while len(j_low) > 0:
+        mid = (j_low + j_high) // 2
+        high = numpy.minimum(i_high, mid)
+        counts = high - i_low + 1
+        offsets = numpy.cumsum(counts) - counts
+        segment = numpy.repeat(numpy.arange(len(mid)), counts)
+        i = i_low[segment] + numpy.arange(numpy.sum(counts)) - offsets[segment]
+
+        candidates = previous[i - 1] + cost(i, mid[segment])
+        best = numpy.minimum.reduceat(candidates, offsets)
+        first = numpy.flatnonzero(candidates == best[segment])
+        first = first[numpy.unique(segment[first], return_index=True)[1]]
+
+        costs[mid] = best
+        starts[mid] = i[first]
+
+        left = j_low <= mid - 1
+        right = mid + 1 <= j_high
+        j_low, j_high, i_low, i_high = (numpy.concatenate([j_low[left], mid[right] + 1]),
+                                        numpy.concatenate([mid[left] - 1, j_high[right]]),
+                                        numpy.concatenate([i_low[left], i[first][right]]),
+                                        numpy.concatenate([i[first][left], i_high[right]]))
+
+    return costs, starts
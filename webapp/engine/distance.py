@@ -2,15 +2,15 @@ __author__ = 'dm'
 
 import numpy
 import numpy.linalg as linalg
-import pulp
 import math
+import warnings
 
 
-def kl_divergence(means1, covariance1, means2, covariance2):
+def kl_divergence(means1, covariance1, means2, covariance2, inverse1=None, inverse2=None):
     d = len(means1)
 
-    e1_inv = linalg.inv(covariance1)
-    e2_inv = linalg.inv(covariance2)
+    e1_inv = linalg.inv(covariance1) if inverse1 is None else inverse1
+    e2_inv = linalg.inv(covariance2) if inverse2 is None else inverse2
 
     inv_trace = (numpy.dot(e2_inv, covariance1) + numpy.dot(e1_inv, covariance2)).trace()
     mean_product = numpy.dot(numpy.dot((means1 - means2).T, (e2_inv + e1_inv)), (means1 - means2))
@@ -19,77 +19,227 @@ def kl_divergence(means1, covariance1, means2, covariance2):
     return result / 2
 
 
-def earth_movers_distance(hist1, hist2, distance_matrix):  # Histogram 1 must always be the larger one
-    sum_weights_1 = numpy.sum(hist1)
-    sum_weights_2 = numpy.sum(hist2)
-    flow_sum = min(sum_weights_1, sum_weights_2)
+def kl_divergence_matrix(means1, covariances1, inverses1, means2, covariances2, inverses2):
+    """
+    Computes the symmetrized KL divergence between every pair of Gaussians of two multi-Gaussian signatures.
+    The second signature may carry extra leading axes, e.g. a stack of N reference signatures.
+    :param means1: Means of the first signature (K1 x d)
+    :param covariances1: Covariance matrices of the first signature (K1 x d x d)
+    :param inverses1: Inverses of covariances1
+    :param means2: Means of the second signature (... x K2 x d)
+    :param covariances2: Covariance matrices of the second signature (... x K2 x d x d)
+    :param inverses2: Inverses of covariances2
+    :return: Divergence matrix (... x K1 x K2), entry [i][j] equal to kl_divergence of cluster i and cluster j
+    """
+    d = means1.shape[-1]
+
+    inv_trace = numpy.einsum('...jab,iba->...ij', inverses2, covariances1) + \
+        numpy.einsum('iab,...jba->...ij', inverses1, covariances2)
+    diff = means1[:, None, :] - means2[..., None, :, :]
+    mean_product = numpy.einsum('...ija,...jab,...ijb->...ij', diff, inverses2, diff) + \
+        numpy.einsum('...ija,iab,...ijb->...ij', diff, inverses1, diff)
+    result = inv_trace - 2*d + mean_product
 
-    n_bins = len(hist1)
-    n_cols = len(hist1)
+    return result / 2
 
-    if sum_weights_1 != sum_weights_2:
-            # Add an entry to the end of hist2 with the difference
-            hist2 = numpy.append(hist2, abs(sum_weights_2 - sum_weights_1))
 
-            # Add a column to the dist_matrix filled with zeroes
-            z = numpy.zeros((n_cols, 1))
-            distance_matrix = numpy.append(distance_matrix, z, axis=1)
-            n_cols += 1
+def gaussian_precomputations(covariance):
+    """
+    Computes the data KL divergences reuse for a covariance matrix, or for a stack of them.
+    :param covariance: Covariance matrix (d x d) or stack of matrices (... x d x d)
+    :return: Inverse of the matrix, or stack of inverses
+    """
+    return linalg.inv(numpy.asarray(covariance, dtype=float))
 
-    # Solve the optimization
-    problem = pulp.LpProblem("Transportation problem", sense=pulp.LpMinimize)
-    routes = [(i, j) for i in range(n_bins) for j in range(n_cols)]
-    route_vars = pulp.LpVariable.dicts("Route", (range(n_bins), range(n_cols)), 0, None, pulp.LpInteger)
-    problem += pulp.lpSum([route_vars[i][j]*distance_matrix[i][j] for (i, j) in routes])
 
-    # The supply maximum constraints are added to prob for each supply node
-    for i in range(n_bins):
-        problem += pulp.lpSum([route_vars[i][j] for j in range(n_cols)]) <= hist1[i]
+def earth_movers_distance(hist1, hist2, distance_matrix):  # Histogram 1 must always be the larger one
+    sum_weights_1 = numpy.sum(hist1)
+    sum_weights_2 = numpy.sum(hist2)
+    flow_sum = min(sum_weights_1, sum_weights_2)
 
-    # The demand minimum constraints are added to prob for each demand node
-    for j in range(n_cols):
-        problem += pulp.lpSum([route_vars[i][j] for i in range(n_bins)]) >= hist2[j]
+    hist1 = numpy.asarray(hist1, dtype=float)
+    hist2 = numpy.asarray(hist2, dtype=float)
+    distance_matrix = numpy.asarray(distance_matrix, dtype=float)
 
-    problem.solve()
-    flow_cost = pulp.value(problem.objective)
+    if sum_weights_1 > sum_weights_2:
+        # Add an entry to the end of hist2 with the difference and a matching column of zero cost
+        hist2 = numpy.append(hist2, sum_weights_1 - sum_weights_2)
+        distance_matrix = numpy.append(distance_matrix, numpy.zeros((len(hist1), 1)), axis=1)
+    elif sum_weights_1 < sum_weights_2:
+        hist1 = numpy.append(hist1, sum_weights_2 - sum_weights_1)
+        distance_matrix = numpy.append(distance_matrix, numpy.zeros((1, len(hist2))), axis=0)
 
+    flow_cost = transportation_cost(hist1, hist2, distance_matrix)
 
     return flow_cost / flow_sum
 
 
-def quadratic_chi_distance(hist1, hist2, distance_matrix):
-    norm_factor = 0.5
-
-    # Convert distance matrix into similarity matrix
-    m = numpy.amax(distance_matrix)
-    dim = distance_matrix.shape[0]
-
-    for i in range(dim):
-        for j in range(dim):
-            distance_matrix[i][j] = 1 - distance_matrix[i][j] / m
-
-    result = 0
-    for i in range(dim):
-        for j in range(dim):
-            qcdq1 = qcd_quotient(hist1, hist2, distance_matrix, i, norm_factor)
-            qcdq2 = qcd_quotient(hist1, hist2, distance_matrix, j, norm_factor)
-            result += qcdq1 * qcdq2 * distance_matrix[i][j]
-
-    if result < 0:
-        return 0
-    return math.sqrt(result)
+def earth_movers_distance_batch(hist1, hists2, distance_matrices):
+    """
+    Computes the EMD between one histogram and N others. Every pair is still solved on its own by
+    transportation_cost, in a Python loop; only the ground distances are computed for all pairs at once.
+    :param hist1: Histogram of the query (n,)
+    :param hists2: Reference histograms (N x n)
+    :param distance_matrices: Ground distances, one matrix per pair (N x n x n), rows belonging to hist1
+    :return: Array of N distances
+    """
+    return numpy.array([earth_movers_distance(hist1, hist2, dist_matrix)
+                        for hist2, dist_matrix in zip(hists2, distance_matrices)])
+
+
+def transportation_cost(supply, demand, cost, max_iterations=None):
+    """
+    Solves a balanced transportation problem with the transportation simplex (MODI) method.
+    Integer supplies and demands always have an integral optimal flow, so this equals the integer program.
+    :param supply: Supply of every row (m,)
+    :param demand: Demand of every column (n,), summing to the total supply
+    :param cost: Cost of moving a unit from row i to column j (m x n)
+    :param max_iterations: Maximum number of pivots, by default 10 times the number of cells plus 100. Should the
+    simplex not reach the optimum within it (e.g. by cycling on a degenerate basis), a RuntimeWarning is issued
+    and the cost of the last feasible flow, an upper bound of the optimum, is returned
+    :return: Cost of the optimal flow
+    """
+    m, n = cost.shape
+    if max_iterations is None:
+        max_iterations = 10 * m * n + 100
+    flow = numpy.zeros((m, n))
+    basis = numpy.zeros((m, n), dtype=bool)
+
+    # North-west corner rule, giving a spanning tree of m + n - 1 basic cells
+    s, d = numpy.array(supply, dtype=float), numpy.array(demand, dtype=float)
+    i = j = 0
+    while True:
+        q = min(s[i], d[j])
+        flow[i, j] = q
+        basis[i, j] = True
+        s[i] -= q
+        d[j] -= q
+        if i == m - 1 and j == n - 1:
+            break
+        if j == n - 1 or (i < m - 1 and s[i] <= d[j]):
+            i += 1
+        else:
+            j += 1
+
+    tolerance = 1e-9 * max(numpy.amax(numpy.abs(cost)), 1)
+    cells = set(zip(*numpy.nonzero(basis)))
+    for iteration in range(max_iterations + 1):
+        u, v = _transportation_potentials(cost, cells)
+        reduced = cost - u[:, None] - v[None, :]
+
+        i0, j0 = numpy.unravel_index(numpy.argmin(reduced), reduced.shape)
+        if reduced[i0, j0] >= -tolerance:
+            break
+        if iteration == max_iterations:
+            warnings.warn("Transportation simplex did not converge in " + str(max_iterations) + " iterations, "
+                          "the cost is an upper bound of the optimum", RuntimeWarning)
+            break
+
+        # Cells on the basis path from column j0 to row i0 alternately lose and gain flow
+        path = _transportation_path(cells, i0, j0)
+        losing = path[0::2]
+        leaving = min(losing, key=lambda cell: flow[cell])
+        theta = flow[leaving]
+
+        flow[i0, j0] += theta
+        for cell in losing:
+            flow[cell] -= theta
+        for cell in path[1::2]:
+            flow[cell] += theta
+
+        cells.remove(leaving)
+        cells.add((i0, j0))
+
+    return float(numpy.sum(flow * cost))
+
+
+def _transportation_potentials(cost, cells):
+    # Solve u[i] + v[j] = cost[i][j] over the basic cells, which form a spanning tree
+    m, n = cost.shape
+    u = [None] * m
+    v = [None] * n
+    u[0] = 0.0
+    remaining = list(cells)
+    while remaining:
+        unresolved = []
+        for i, j in remaining:
+            if u[i] is not None and v[j] is None:
+                v[j] = cost[i, j] - u[i]
+            elif v[j] is not None and u[i] is None:
+                u[i] = cost[i, j] - v[j]
+            elif u[i] is None:
+                unresolved.append((i, j))
+        remaining = unresolved
+
+    return numpy.array(u), numpy.array(v)
+
+
+def _transportation_path(cells, i0, j0):
+    # Breadth-first search in the basis tree from column j0 to row i0
+    row_cells, col_cells = {}, {}
+    for i, j in cells:
+        row_cells.setdefault(i, []).append(j)
+        col_cells.setdefault(j, []).append(i)
+
+    parent = {('col', j0): None}
+    queue = [('col', j0)]
+    for node in queue:
+        kind, k = node
+        if node == ('row', i0):
+            break
+        if kind == 'col':
+            neighbours = [('row', i) for i in col_cells.get(k, [])]
+        else:
+            neighbours = [('col', j) for j in row_cells.get(k, [])]
+        for neighbour in neighbours:
+            if neighbour not in parent:
+                parent[neighbour] = node
+                queue.append(neighbour)
+
+    path = []
+    node = ('row', i0)
+    while parent[node] is not None:
+        previous = parent[node]
+        path.append((node[1], previous[1]) if node[0] == 'row' else (previous[1], node[1]))
+        node = previous
+
+    return path[::-1]
+
+
+def ground_similarity_matrix(distance_matrix):
+    """
+    Converts a ground distance matrix (or a stack of them) into the similarity matrix used by the quadratic-chi distance.
+    """
+    distance_matrix = numpy.asarray(distance_matrix, dtype=float)
+    m = numpy.amax(distance_matrix, axis=(-2, -1), keepdims=True)
+    return 1 - distance_matrix / m
 
 
-def qcd_quotient(hist1, hist2, distance_matrix, i, m):
-    numerator = hist1[i] - hist2[i]
-    denominator = 0
-
-    for c in range(distance_matrix.shape[0]):
-        denominator += (hist1[c] + hist2[c]) * distance_matrix[c][i]
-
-    denominator = denominator ** m
-
-    if numerator == 0 and denominator == 0:
-        return 0
-
-    return numerator / denominator
\ No newline at end of file
+def quadratic_chi_distance(hist1, hist2, distance_matrix):
+    similarity_matrix = ground_similarity_matrix(distance_matrix)
+    return float(quadratic_chi_distance_batch(hist1, hist2, similarity_matrix))
+
+
+def quadratic_chi_distance_batch(hist1, hist2, similarity_matrix, norm_factor=0.5):
+    """
+    Computes the quadratic-chi distance for a stack of histogram pairs at once.
+    :param hist1: Histogram(s), shape (n,) or (N, n)
+    :param hist2: Histogram(s), shape (n,) or (N, n)
+    :param similarity_matrix: Ground similarity matrix (n x n) shared by all pairs, or one per pair (N x n x n)
+    :param norm_factor: Exponent of the normalizing denominator
+    :return: Distance(s), shape () or (N,)
+    """
+    hist1 = numpy.asarray(hist1, dtype=float)
+    hist2 = numpy.asarray(hist2, dtype=float)
+    similarity_matrix = numpy.asarray(similarity_matrix, dtype=float)
+
+    numerator = hist1 - hist2
+    # Denominator of bin i is sum_c (hist1[c] + hist2[c]) * A[c][i]
+    denominator = numpy.einsum('...c,...ci->...i', hist1 + hist2, similarity_matrix) ** norm_factor
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        quotients = numerator / denominator
+        quotients = numpy.where((numerator == 0) & (denominator == 0), 0, quotients)
+        result = numpy.einsum('...i,...ij,...j->...', quotients, similarity_matrix, quotients)
+
+    return numpy.sqrt(numpy.where(result < 0, 0, result))
@@ -4,9 +4,10 @@ import abc
 import librosa
 import numpy
 import numpy.linalg as linalg
-import sklearn.cluster as cluster
 from math import sqrt
+import engine.clustering as clustering
 import engine.distance as distance
+import engine.features as engine_features
 
 
 __author__ = 'dm'
@@ -15,7 +16,13 @@ __author__ = 'dm'
 class Engine(metaclass=abc.ABCMeta):
     @classmethod
     @abc.abstractclassmethod
-    def extract_signature(cls, track_data, track_rate):
+    def extract_signature(cls, track_data, track_rate, features=None):
+        """
+        :param track_data: Audio samples
+        :param track_rate: Sampling rate
+        :param features: Optional FeatureContext of the same track, shared with other engines
+        :return: Signature dictionary {key: array}
+        """
         pass
 
     @classmethod
@@ -28,14 +35,116 @@ class Engine(metaclass=abc.ABCMeta):
     def get_engine_identifier(cls):
         pass
 
+    @classmethod
+    def measure_similarity_batch(cls, sig, signatures):
+        """
+        Measures the similarity of one signature against many stacked signatures.
+        Engines that can vectorize their measure override this; the default falls back to measure_similarity.
+        :param sig: A single signature dictionary
+        :param signatures: Dictionary {key: array} with the reference track as the first axis
+        :return: Array of N similarities
+        """
+        n_rows = len(next(iter(signatures.values()))) if signatures else 0
+        return numpy.array([cls.measure_similarity(sig, {key: signatures[key][row] for key in signatures})
+                            for row in range(n_rows)])
+
+    @classmethod
+    def prepare_signatures(cls, signatures):
+        """
+        Adds data derived from the stacked reference signatures that measure_similarity_batch reuses on every query.
+        :param signatures: Dictionary {key: array} with the reference track as the first axis
+        :return: The same dictionary, possibly with extra keys
+        """
+        return signatures
+
     @classmethod
     def allows_metric_indexing(cls):
         return False
 
+    @classmethod
+    def has_fixed_shape_signatures(cls):
+        """
+        Tells whether every signature has the same keys and shapes, so that all of them fit one record file.
+        """
+        return True
+
+    @classmethod
+    def allows_streaming(cls):
+        return False
+
     @classmethod
     def get_partial_weights(cls):
         return {}
 
+    @classmethod
+    def proxy_vectors(cls, signatures):
+        """
+        Cheap vectors whose Euclidean distance roughly follows the engine's similarity, used to shortlist candidates.
+        :param signatures: Dictionary {key: array} with the track as the first axis
+        :return: Array (N x d), or None if the engine has no proxy
+        """
+        return None
+
+    @classmethod
+    def get_gaussian_keys(cls):
+        """
+        Keys of the mean and covariance of engines whose signature is a single multivariate Gaussian.
+        Such engines can be searched through an approximate nearest-neighbour index of embedded signatures.
+        :return: Tuple (means key, covariance key), or None
+        """
+        return None
+
+
+class MetricEngine(metaclass=abc.ABCMeta):
+    """
+    Mixin of engines whose signatures can be searched through the pivot index of engine.index.
+    """
+    @classmethod
+    def allows_metric_indexing(cls):
+        return True
+
+    @classmethod
+    @abc.abstractclassmethod
+    def measure_distance_batch(cls, sig, signatures):
+        """
+        Distance between one signature and N stacked signatures used by the metric index.
+        The index prunes with the triangle inequality, so its results are exact only as far as the distance
+        satisfies it.
+        :return: Array of N distances
+        """
+        pass
+
+
+class StreamingEngine(metaclass=abc.ABCMeta):
+    """
+    Mixin of engines whose signature is made of the mean and covariance of frame-wise features,
+    which engine.streaming accumulates over windows of a track.
+    """
+    @classmethod
+    def allows_streaming(cls):
+        return True
+
+    @classmethod
+    @abc.abstractclassmethod
+    def frame_features(cls, features):
+        """
+        Frame-wise features whose mean and covariance make up the signature, on the STFT frame grid.
+        streaming.extract_signatures calls it on overlapping windows of a track and accumulates the statistics
+        of the frames.
+        :param features: FeatureContext of a track or of a window of it
+        :return: Array (d x frames)
+        """
+        pass
+
+    @classmethod
+    @abc.abstractclassmethod
+    def signature_from_statistics(cls, statistics):
+        """
+        :param statistics: streaming.GaussianAccumulator of the frame features of a whole track
+        :return: Signature dictionary {key: array}
+        """
+        pass
+
 
 class CompoundEngine(Engine):
     @classmethod
@@ -43,11 +152,14 @@ class CompoundEngine(Engine):
         pass
 
     @classmethod
-    def extract_signature(cls, track_data, track_rate):
+    def extract_signature(cls, track_data, track_rate, features=None):
+        if features is None:
+            features = engine_features.FeatureContext(track_data, track_rate)
+
         signature = {}
         for key in cls.get_components():
             engine_class, weight = cls.get_components()[key]
-            signature.update(engine_class.extract_signature(track_data, track_rate))
+            signature.update(engine_class.extract_signature(track_data, track_rate, features))
 
         return signature
 
@@ -62,6 +174,27 @@ class CompoundEngine(Engine):
 
         return similarity
 
+    @classmethod
+    def measure_similarity_batch(cls, sig, signatures):
+        similarity = {}
+        for key in cls.get_components():
+            engine_class, weight = cls.get_components()[key]
+            similarity[key] = engine_class.measure_similarity_batch(sig, signatures)
+
+        return similarity
+
+    @classmethod
+    def prepare_signatures(cls, signatures):
+        for key in cls.get_components():
+            engine_class, weight = cls.get_components()[key]
+            signatures = engine_class.prepare_signatures(signatures)
+
+        return signatures
+
+    @classmethod
+    def has_fixed_shape_signatures(cls):
+        return all(engine_class.has_fixed_shape_signatures() for engine_class, weight in cls.get_components().values())
+
     @classmethod
     @abc.abstractmethod
     def get_components(cls):
@@ -89,13 +222,24 @@ class UltimateEngine(CompoundEngine):
         return "MalyValasek_Engine_v01"
 
 
-class SpectralContrastEngine(Engine):
+class SpectralContrastEngine(MetricEngine, StreamingEngine, Engine):
     @classmethod
-    def extract_signature(cls, track_data, track_rate):
-        sc = librosa.feature.spectral_contrast(track_data, track_rate)
+    def extract_signature(cls, track_data, track_rate, features=None):
+        if features is None:
+            features = engine_features.FeatureContext(track_data, track_rate)
+        sc = cls.frame_features(features)
         means = numpy.mean(sc, axis=1)
         covariance = numpy.cov(sc, rowvar=1)
-        return {'sct_means': means, 'sct_covariance' : covariance}
+        return add_gaussian_precomputations({'sct_means': means, 'sct_covariance' : covariance}, 'sct_covariance')
+
+    @classmethod
+    def frame_features(cls, features):
+        return librosa.feature.spectral_contrast(sr=features.track_rate, S=features.magnitude())
+
+    @classmethod
+    def signature_from_statistics(cls, statistics):
+        return add_gaussian_precomputations({'sct_means': statistics.mean, 'sct_covariance': statistics.covariance()},
+                                            'sct_covariance')
 
     @classmethod
     def measure_similarity(cls, sig1, sig2):
@@ -104,13 +248,43 @@ class SpectralContrastEngine(Engine):
         m1 = sig1['sct_means']
         m2 = sig2['sct_means']
 
-        dist = distance.kl_divergence(m1, e1, m2, e2)
+        dist = distance.kl_divergence(m1, e1, m2, e2, sig1.get('sct_covariance_inv'), sig2.get('sct_covariance_inv'))
         '''dist = 0
         for i in range(len(m1)):
             dist += math.sqrt((m1[i] - m2[i])**2)'''
 
         return 1 / (1 + dist)
 
+    @classmethod
+    def measure_similarity_batch(cls, sig, signatures):
+        return 1 / (1 + cls.divergence_batch(sig, signatures))
+
+    @classmethod
+    def divergence_batch(cls, sig, signatures):
+        sig = add_gaussian_precomputations(dict(sig), 'sct_covariance')
+        dist = distance.kl_divergence_matrix(sig['sct_means'][None], sig['sct_covariance'][None],
+                                             sig['sct_covariance_inv'][None],
+                                             signatures['sct_means'][:, None], signatures['sct_covariance'][:, None],
+                                             signatures['sct_covariance_inv'][:, None])
+        return dist[:, 0, 0]
+
+    @classmethod
+    def measure_distance_batch(cls, sig, signatures):
+        # The square root of the symmetrized KL divergence; not a metric, so the index can miss tracks a scan finds
+        return numpy.sqrt(numpy.maximum(cls.divergence_batch(sig, signatures), 0))
+
+    @classmethod
+    def prepare_signatures(cls, signatures):
+        return add_gaussian_precomputations(signatures, 'sct_covariance')
+
+    @classmethod
+    def proxy_vectors(cls, signatures):
+        return signatures['sct_means']
+
+    @classmethod
+    def get_gaussian_keys(cls):
+        return 'sct_means', 'sct_covariance'
+
     @classmethod
     def get_engine_identifier(cls):
         return "SpectralContrast_Engine_v01"
@@ -119,12 +293,12 @@ class SpectralContrastEngine(Engine):
 class ZeroCrossingEngine(Engine):
 
     n_clusters = 16
+    clustering_backend = 'optimal1d'  # See clustering.BACKENDS
 
     @classmethod
-    def extract_signature(cls, track_data, track_rate):
+    def extract_signature(cls, track_data, track_rate, features=None):
         zcr = librosa.feature.zero_crossing_rate(track_data)
-        kmeans = cluster.KMeans(n_clusters=cls.n_clusters, precompute_distances=True, n_jobs=-1)
-        labels = kmeans.fit_predict(zcr.T)
+        labels = clustering.cluster_labels(zcr.T, cls.n_clusters, cls.clustering_backend)
 
         all_means = numpy.zeros(cls.n_clusters)
         all_weights = numpy.zeros(cls.n_clusters)
@@ -132,6 +306,10 @@ class ZeroCrossingEngine(Engine):
         for i in range(cls.n_clusters):
             sample_indices = numpy.where(labels == i)[0]  # Indices of frames belonging to cluster i
             samples = zcr.T[sample_indices]  # The frames themselves
+            if sample_indices.size == 0:
+                # Fewer distinct frames than clusters: the empty cluster gets no weight
+                all_means[i] = numpy.mean(zcr)
+                continue
             all_means[i] = numpy.mean(samples)
             all_weights[i] = sample_indices.size
 
@@ -139,40 +317,44 @@ class ZeroCrossingEngine(Engine):
 
     @classmethod
     def measure_similarity(cls, sig1, sig2):
-        n_cols = cls.n_clusters
-        dist_matrix = numpy.ndarray((cls.n_clusters, n_cols))
-
         sum_weights_1 = numpy.sum(sig1['zcr_weights'])
         sum_weights_2 = numpy.sum(sig2['zcr_weights'])
 
         if sum_weights_1 < sum_weights_2:  # Make sure sig1 is always the larger one (supply > demand)
             sig1, sig2 =  sig2, sig1
 
-        for i in range(cls.n_clusters):
-            for j in range(n_cols):
-                dist_matrix[i][j] = sqrt((sig1['zcr_means'][i] - sig2['zcr_means'][j])**2)
+        dist_matrix = numpy.abs(numpy.subtract.outer(sig1['zcr_means'], sig2['zcr_means']))
 
-        weights1 = numpy.copy(sig1['zcr_weights'])
-        weights2 = numpy.copy(sig2['zcr_weights'])
+        dist = distance.quadratic_chi_distance(sig1['zcr_weights'], sig2['zcr_weights'], dist_matrix)
+        return 1 / (1 + dist)
 
-        dist = distance.quadratic_chi_distance(weights1, weights2, dist_matrix)
+    @classmethod
+    def measure_similarity_batch(cls, sig, signatures):
+        dist = _cluster_histogram_distance_batch(sig['zcr_means'], sig['zcr_weights'],
+                                                 signatures['zcr_means'], signatures['zcr_weights'])
         return 1 / (1 + dist)
 
 
+    @classmethod
+    def proxy_vectors(cls, signatures):
+        return _weighted_moments(signatures['zcr_means'], signatures['zcr_weights'])
+
     @classmethod
     def get_engine_identifier(cls):
-        return "ZCR_engine_v01"
+        return "ZCR_engine_v02"
 
 
 class SpectralCentroidEngine(Engine):
 
     n_clusters = 8
+    clustering_backend = 'optimal1d'  # See clustering.BACKENDS
 
     @classmethod
-    def extract_signature(cls, track_data, track_rate):
-        sc = librosa.feature.spectral_centroid(track_data, track_rate)
-        kmeans = cluster.KMeans(n_clusters=cls.n_clusters, precompute_distances=True, n_jobs=-1)
-        labels = kmeans.fit_predict(sc.T)
+    def extract_signature(cls, track_data, track_rate, features=None):
+        if features is None:
+            features = engine_features.FeatureContext(track_data, track_rate)
+        sc = librosa.feature.spectral_centroid(sr=track_rate, S=features.magnitude())
+        labels = clustering.cluster_labels(sc.T, cls.n_clusters, cls.clustering_backend)
 
         all_means = numpy.zeros(cls.n_clusters)
         all_variances = numpy.zeros(cls.n_clusters)
@@ -181,6 +363,10 @@ class SpectralCentroidEngine(Engine):
         for i in range(cls.n_clusters):
             sample_indices = numpy.where(labels == i)[0]  # Indices of frames belonging to cluster i
             samples = sc.T[sample_indices]  # The frames themselves
+            if sample_indices.size == 0:
+                # Fewer distinct frames than clusters: the empty cluster gets no weight
+                all_means[i] = numpy.mean(sc)
+                continue
             all_means[i] = numpy.mean(samples)
             all_variances[i] = numpy.var(samples)
             all_weights[i] = sample_indices.size
@@ -189,46 +375,59 @@ class SpectralCentroidEngine(Engine):
 
     @classmethod
     def measure_similarity(cls, sig1, sig2):
-        n_cols = cls.n_clusters
-        dist_matrix = numpy.ndarray((cls.n_clusters, n_cols))
-
         sum_weights_1 = numpy.sum(sig1['sc_weights'])
         sum_weights_2 = numpy.sum(sig2['sc_weights'])
 
         if sum_weights_1 < sum_weights_2:  # Make sure sig1 is always the larger one (supply > demand)
             sig1, sig2 =  sig2, sig1
 
-        for i in range(cls.n_clusters):
-            for j in range(n_cols):
-                dist_matrix[i][j] = sqrt((numpy.log(sig1['sc_means'][i]) - numpy.log(sig2['sc_means'][j]))**2)
-
-        weights1 = numpy.copy(sig1['sc_weights'])
-        weights2 = numpy.copy(sig2['sc_weights'])
+        dist_matrix = numpy.abs(numpy.subtract.outer(numpy.log(sig1['sc_means']), numpy.log(sig2['sc_means'])))
 
-        dist = distance.quadratic_chi_distance(weights1, weights2, dist_matrix)
+        dist = distance.quadratic_chi_distance(sig1['sc_weights'], sig2['sc_weights'], dist_matrix)
 
         sim = 1 / (1 + dist)
         if sim == numpy.nan or math.isnan(sim):
             return 0
         return sim
 
+    @classmethod
+    def measure_similarity_batch(cls, sig, signatures):
+        dist = _cluster_histogram_distance_batch(numpy.log(sig['sc_means']), sig['sc_weights'],
+                                                 numpy.log(signatures['sc_means']), signatures['sc_weights'])
+        sim = 1 / (1 + dist)
+        return numpy.where(numpy.isnan(sim), 0, sim)
 
 
+    @classmethod
+    def proxy_vectors(cls, signatures):
+        return _weighted_moments(numpy.log(signatures['sc_means']), signatures['sc_weights'])
+
     @classmethod
     def get_engine_identifier(cls):
-        return "SC_engine_v01"
+        return "SC_engine_v02"
 
 
 
-class MandelEllisEngine(Engine):
+class MandelEllisEngine(MetricEngine, StreamingEngine, Engine):
 
     @classmethod
-    def extract_signature(cls, track_data, track_rate):
-        harmonic_data = librosa.effects.harmonic(track_data)
-        mfccs = librosa.feature.mfcc(harmonic_data, track_rate, n_mfcc=20)[1:]  # TODO: Back to no harmonic
+    def extract_signature(cls, track_data, track_rate, features=None):
+        if features is None:
+            features = engine_features.FeatureContext(track_data, track_rate)
+        mfccs = cls.frame_features(features)
         means = numpy.mean(mfccs, axis=1)
         covariance = numpy.cov(mfccs)
-        return {'me_means': means, 'me_covariance': covariance}
+        return add_gaussian_precomputations({'me_means': means, 'me_covariance': covariance}, 'me_covariance')
+
+    @classmethod
+    def frame_features(cls, features):
+        harmonic_data = features.harmonic()
+        return librosa.feature.mfcc(y=harmonic_data, sr=features.track_rate, n_mfcc=20)[1:]  # TODO: Back to no harmonic
+
+    @classmethod
+    def signature_from_statistics(cls, statistics):
+        return add_gaussian_precomputations({'me_means': statistics.mean, 'me_covariance': statistics.covariance()},
+                                            'me_covariance')
 
     @classmethod
     def measure_similarity(cls, sig1, sig2):
@@ -244,8 +443,8 @@ class MandelEllisEngine(Engine):
         m2 = sig2['me_means']
         d = len(m1)
 
-        e1_inv = linalg.inv(e1)
-        e2_inv = linalg.inv(e2)
+        e1_inv = sig1['me_covariance_inv'] if 'me_covariance_inv' in sig1 else linalg.inv(e1)
+        e2_inv = sig2['me_covariance_inv'] if 'me_covariance_inv' in sig2 else linalg.inv(e2)
 
         inv_trace = (numpy.dot(e2_inv, e1) + numpy.dot(e1_inv, e2)).trace()
         mean_product = numpy.dot(numpy.dot((m1 - m2).T, (e2_inv + e1_inv)), (m1 - m2))
@@ -258,6 +457,56 @@ class MandelEllisEngine(Engine):
         # return numpy.exp(-cls.gamma * div)
         return 1 / (1 + div)
 
+    @classmethod
+    def measure_similarity_batch(cls, sig, signatures):
+        return 1 / (1 + cls.divergence_batch(sig, signatures))
+
+    @classmethod
+    def divergence_batch(cls, sig, signatures):
+        """
+        Computes the symmetrized KL divergence between one Gaussian and N stacked Gaussians at once.
+        :param sig: Signature of the query track (means, covariance matrix).
+        :param signatures: Stacked signatures with me_means (N x d), me_covariance (N x d x d)
+        and me_covariance_inv (N x d x d), see prepare_signatures.
+        :return: Array of N divergences, matching measure_similarity for every pair
+        """
+        e1 = sig['me_covariance']
+        m1 = sig['me_means']
+        e2 = signatures['me_covariance']
+        e2_inv = signatures['me_covariance_inv']
+        m2 = signatures['me_means']
+        d = len(m1)
+
+        e1_inv = sig['me_covariance_inv'] if 'me_covariance_inv' in sig else linalg.inv(e1)
+
+        inv_trace = numpy.einsum('nij,ji->n', e2_inv, e1) + numpy.einsum('ij,nji->n', e1_inv, e2)
+        diff = m1 - m2
+        mean_product = numpy.einsum('ni,nij,nj->n', diff, e2_inv, diff) + numpy.einsum('ni,ij,nj->n', diff, e1_inv, diff)
+        result = inv_trace - 2 * d + mean_product
+
+        # A reference equal to the query has divergence 0 up to rounding, which can fall slightly below it
+        if (result < -1e-9 * d).any():
+            print("KL divergence is negative!!!")
+
+        return result / 2
+
+    @classmethod
+    def measure_distance_batch(cls, sig, signatures):
+        # The square root of the symmetrized KL divergence; not a metric, so the index can miss tracks a scan finds
+        return numpy.sqrt(numpy.maximum(cls.divergence_batch(sig, signatures), 0))
+
+    @classmethod
+    def prepare_signatures(cls, signatures):
+        return add_gaussian_precomputations(signatures, 'me_covariance')
+
+    @classmethod
+    def proxy_vectors(cls, signatures):
+        return signatures['me_means']
+
+    @classmethod
+    def get_gaussian_keys(cls):
+        return 'me_means', 'me_covariance'
+
     @classmethod
     def get_engine_identifier(cls):
         return "Mandel_Ellis_v01"
@@ -266,18 +515,18 @@ class MandelEllisEngine(Engine):
 class LoganEngine(Engine):
 
     n_clusters = 8
+    clustering_backend = 'minibatch'  # See clustering.BACKENDS
 
     @classmethod
     def get_engine_identifier(cls):
-        return "Logan_Engine_v01"
+        return "Logan_Engine_v02"
 
     @classmethod
-    def extract_signature(cls, track_data, track_rate):
+    def extract_signature(cls, track_data, track_rate, features=None):
         n_clusters = cls.n_clusters
         n_mfccs = 20
-        mfccs = librosa.feature.mfcc(track_data, track_rate, n_mfcc=n_mfccs, hop_length=512)[1:]
-        kmeans = cluster.KMeans(n_clusters=n_clusters, precompute_distances=True, n_jobs=-1)
-        labels = kmeans.fit_predict(mfccs.T)
+        mfccs = librosa.feature.mfcc(y=track_data, sr=track_rate, n_mfcc=n_mfccs, hop_length=512)[1:]
+        labels = clustering.cluster_labels(mfccs.T, n_clusters, cls.clustering_backend)
 
         all_means = numpy.ndarray((n_clusters, n_mfccs - 1))
         all_covs = numpy.ndarray((n_clusters, n_mfccs - 1, n_mfccs - 1))
@@ -286,6 +535,13 @@ class LoganEngine(Engine):
         for i in range(n_clusters):
             sample_indices = numpy.where(labels == i)[0]  # Indices of frames belonging to cluster i
             samples = mfccs.T[sample_indices]  # The frames themselves
+            if sample_indices.size < 2:
+                # An empty or single-frame cluster has no covariance: it gets no weight and the statistics of
+                # the whole track, so that its divergences stay finite
+                all_means[i] = numpy.mean(mfccs, axis=1)
+                all_covs[i] = numpy.cov(mfccs)
+                all_weights[i] = 0
+                continue
 
             cluster_mean = numpy.mean(samples, axis=0)  # 1D array
             cluster_covariance = numpy.cov(samples, rowvar=0)  # 2D array (should be 19 by 19)
@@ -300,58 +556,86 @@ class LoganEngine(Engine):
             all_covs[i:] = cluster_covariance
             all_weights[i] = sample_indices.size
 
-        return {'means': all_means, 'covariances': all_covs, 'weights': all_weights}
+        return add_gaussian_precomputations({'means': all_means, 'covariances': all_covs, 'weights': all_weights},
+                                            'covariances')
 
     @classmethod
     def measure_similarity(cls, sig1, sig2):
-        n_clusters = cls.n_clusters
-        n_cols = n_clusters
-        dist_matrix = numpy.ndarray((n_clusters, n_cols))
-
         sum_weights_1 = numpy.sum(sig1['weights'])
         sum_weights_2 = numpy.sum(sig2['weights'])
 
         if sum_weights_1 < sum_weights_2:  # Make sure sig1 is always the larger one (supply > demand)
             sig1, sig2 = sig2, sig1
 
-        for i in range(n_clusters):
-            for j in range(n_clusters):
-                dist_matrix[i][j] = distance.kl_divergence(sig1['means'][i],
-                                                           sig1['covariances'][i],
-                                                           sig2['means'][j],
-                                                           sig2['covariances'][j])
+        sig1 = add_gaussian_precomputations(dict(sig1), 'covariances')
+        sig2 = add_gaussian_precomputations(dict(sig2), 'covariances')
+        dist_matrix = distance.kl_divergence_matrix(sig1['means'], sig1['covariances'], sig1['covariances_inv'],
+                                                    sig2['means'], sig2['covariances'], sig2['covariances_inv'])
 
-        weights1 = numpy.copy(sig1['weights'])
-        weights2 = numpy.copy(sig2['weights'])
+        emd = distance.earth_movers_distance(sig1['weights'], sig2['weights'], dist_matrix)
+        return 1 / (1 + emd)
+
+    @classmethod
+    def measure_similarity_batch(cls, sig, signatures):
+        sig = add_gaussian_precomputations(dict(sig), 'covariances')
+        dist_matrices = distance.kl_divergence_matrix(sig['means'], sig['covariances'], sig['covariances_inv'],
+                                                      signatures['means'], signatures['covariances'],
+                                                      signatures['covariances_inv'])
 
-        emd = distance.earth_movers_distance(weights1, weights2, dist_matrix)
+        # The symmetric divergence makes the flow problem the same whichever histogram supplies it
+        emd = distance.earth_movers_distance_batch(sig['weights'], signatures['weights'], dist_matrices)
         return 1 / (1 + emd)
 
+    @classmethod
+    def prepare_signatures(cls, signatures):
+        return add_gaussian_precomputations(signatures, 'covariances')
 
-class TempogramEngine(Engine):
+    @classmethod
+    def proxy_vectors(cls, signatures):
+        # Mean MFCC vector of the whole track, the cluster means weighted by cluster size
+        weights = signatures['weights'] / numpy.sum(signatures['weights'], axis=-1, keepdims=True)
+        return numpy.einsum('nk,nkd->nd', weights, signatures['means'])
+
+
+class TempogramEngine(StreamingEngine, Engine):
 
     win_length = 30
+    _ground_similarity = None
 
     @classmethod
     def get_engine_identifier(cls):
         return "Tempogram_Engine_v01"
 
     @classmethod
-    def extract_signature(cls, track_data, track_rate):
-        win_length = cls.win_length
-        onset_env = librosa.onset.onset_strength(track_data, track_rate)
-        tempogram = librosa.feature.tempogram(sr=track_rate, onset_envelope=onset_env, win_length=win_length,
-                                              hop_length=2048)
+    def extract_signature(cls, track_data, track_rate, features=None):
+        if features is None:
+            features = engine_features.FeatureContext(track_data, track_rate)
+        tempogram = cls.frame_features(features)
 
         means = numpy.mean(tempogram, axis=1)
 
         return {'tempogram_means': means}
 
+    @classmethod
+    def frame_features(cls, features):
+        onset_env = features.onset_strength()
+        return librosa.feature.tempogram(sr=features.track_rate, onset_envelope=onset_env, win_length=cls.win_length,
+                                         hop_length=2048)
+
+    @classmethod
+    def signature_from_statistics(cls, statistics):
+        return {'tempogram_means': statistics.mean}
+
+    @classmethod
+    def ground_similarity(cls):
+        # The ground distance between tempogram bins is |i - j|, the same for every pair of tracks
+        if cls._ground_similarity is None:
+            bins = numpy.arange(cls.win_length)
+            cls._ground_similarity = distance.ground_similarity_matrix(numpy.abs(numpy.subtract.outer(bins, bins)))
+        return cls._ground_similarity
+
     @classmethod
     def measure_similarity(cls, sig1, sig2):
-        win_length = cls.win_length
-        n_cols = win_length
-        dist_matrix = numpy.ndarray((win_length, n_cols))
         means_1 = numpy.round(sig1['tempogram_means'] * 1000)
         means_2 = numpy.round(sig2['tempogram_means'] * 1000)
 
@@ -361,17 +645,64 @@ class TempogramEngine(Engine):
         if sum_weights_1 < sum_weights_2:  # Make sure sig1 is always the larger one (supply > demand)
             means_1, means_2 =  means_2, means_1
 
-        for i in range(win_length):
-            for j in range(n_cols):
-                dist_matrix[i][j] = sqrt((i - j)**2)
+        dist = distance.quadratic_chi_distance_batch(means_1, means_2, cls.ground_similarity())
+        return 1 / (1 + float(dist))
 
-        weights1 = numpy.copy(means_1)
-        weights2 = numpy.copy(means_2)
+    @classmethod
+    def proxy_vectors(cls, signatures):
+        return signatures['tempogram_means']
 
-        dist = distance.quadratic_chi_distance(weights1, weights2, dist_matrix)
+    @classmethod
+    def measure_similarity_batch(cls, sig, signatures):
+        # The ground similarity is symmetric, so the order of the histograms in a pair does not matter
+        means_1 = numpy.round(sig['tempogram_means'] * 1000)
+        means_2 = numpy.round(signatures['tempogram_means'] * 1000)
+
+        dist = distance.quadratic_chi_distance_batch(means_1, means_2, cls.ground_similarity())
         return 1 / (1 + dist)
 
 
+def add_gaussian_precomputations(signature, key):
+    """
+    Stores the inverse of the covariance matrices under signature[key] next to them, unless the signature
+    already has it (signatures saved before it was introduced do not).
+    :param signature: Signature dictionary, single or stacked
+    :param key: Key of the covariance matrix
+    :return: The same dictionary
+    """
+    if key in signature and key + '_inv' not in signature:
+        signature[key + '_inv'] = distance.gaussian_precomputations(signature[key])
+    return signature
+
+
+def _weighted_moments(means, weights):
+    # Weighted mean and standard deviation of 1-D cluster centres, independent of the order of the clusters
+    weights = weights / numpy.sum(weights, axis=-1, keepdims=True)
+    mean = numpy.sum(weights * means, axis=-1)
+    std = numpy.sqrt(numpy.sum(weights * (means - mean[..., None]) ** 2, axis=-1))
+    return numpy.stack([mean, std], axis=-1)
+
+
+def _cluster_histogram_distance_batch(means, weights, ref_means, ref_weights):
+    """
+    Quadratic-chi distance between one clustered 1-D signature and N stacked ones.
+    Like the per-pair measures, the signature with the larger total weight provides the rows of the ground distance.
+    :param means: Cluster centres of the query (n,)
+    :param weights: Cluster sizes of the query (n,)
+    :param ref_means: Cluster centres of the references (N x n)
+    :param ref_weights: Cluster sizes of the references (N x n)
+    :return: Array of N distances
+    """
+    swap = numpy.sum(weights) < numpy.sum(ref_weights, axis=1)
+
+    dist_matrices = numpy.abs(means[None, :, None] - ref_means[:, None, :])
+    dist_matrices = numpy.where(swap[:, None, None], dist_matrices.transpose(0, 2, 1), dist_matrices)
+    hist1 = numpy.where(swap[:, None], ref_weights, weights)
+    hist2 = numpy.where(swap[:, None], weights, ref_weights)
+
+    return distance.quadratic_chi_distance_batch(hist1, hist2, distance.ground_similarity_matrix(dist_matrices))
+
+
 class BeatEngine(Engine):
     @classmethod
     def euclidean_distance(cls, x, y):
@@ -385,11 +716,16 @@ class BeatEngine(Engine):
         return sqrt(sum(pow(a - b, 2) for a, b in zip(x_sliced, y_sliced)) / pow(length, 2))
 
     @classmethod
-    def extract_signature(cls, track_data, track_rate):
+    def extract_signature(cls, track_data, track_rate, features=None):
         tempo, beats = librosa.beat.beat_track(y=track_data, sr=track_rate)
 
         return {'tempo': tempo, 'beats': beats}
 
+    @classmethod
+    def has_fixed_shape_signatures(cls):
+        # The number of beats depends on the track
+        return False
+
     @classmethod
     def measure_similarity(cls, sig1, sig2):
         dist = cls.euclidean_distance(sig1['beats'] / sig1['tempo'], sig2['beats'] / sig2[
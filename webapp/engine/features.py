@@ -0,0 +1,52 @@
+__author__ = 'dm'
+
+import librosa
+import numpy
+
+
+class FeatureContext:
+    """
+    Intermediate representations of one track shared by the engines that extract its signature.
+    Each representation is computed on first use and at most once; the parameters are the librosa defaults,
+    so features computed from them are identical to those librosa computes from the samples.
+    """
+    def __init__(self, track_data, track_rate):
+        self.track_data = track_data
+        self.track_rate = track_rate
+        self._cache = {}
+
+    def _memoize(self, key, compute):
+        if key not in self._cache:
+            self._cache[key] = compute()
+        return self._cache[key]
+
+    def stft(self):
+        return self._memoize('stft', lambda: librosa.stft(self.track_data))
+
+    def magnitude(self):
+        return self._memoize('magnitude', lambda: numpy.abs(self.stft()))
+
+    def power(self):
+        return self._memoize('power', lambda: self.magnitude() ** 2)
+
+    def mel(self):
+        return self._memoize('mel', lambda: librosa.feature.melspectrogram(S=self.power(), sr=self.track_rate))
+
+    def onset_strength(self):
+        return self._memoize('onset_strength', lambda: librosa.onset.onset_strength(
+            y=self.track_data, sr=self.track_rate, feature=lambda **kwargs: self.mel()))
+
+    def harmonic(self):
+        """
+        The harmonic part of the signal, as librosa.effects.harmonic returns it.
+        """
+        def compute():
+            stft_harmonic = librosa.decompose.hpss(self.stft())[0]
+            try:
+                return librosa.istft(stft_harmonic, dtype=self.track_data.dtype, length=len(self.track_data))
+            except TypeError:
+                # librosa before 0.6 has no length argument and trims the inverse like this
+                y_harmonic = librosa.istft(stft_harmonic, dtype=self.track_data.dtype)
+                return librosa.util.fix_length(y_harmonic, size=len(self.track_data))
+
+        return self._memoize('harmonic', compute)
@@ -0,0 +1,134 @@
+__author__ = 'dm'
+
+import os
+import threading
+import numpy
+import engine.store as signature_store
+
+INDEX_FILENAME = "metric_index.npz"
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+class PivotIndex:
+    """
+    LAESA-style pivot table: the distances of every signature to a few pivot signatures.
+    Lower bounds |d(q, p) - d(x, p)| from the triangle inequality let a search skip most exact distance evaluations.
+    """
+    def __init__(self, track_ids, pivot_rows, table):
+        self.track_ids = track_ids
+        self.pivot_rows = pivot_rows
+        self.table = table  # N x P distances
+
+    @classmethod
+    def build(cls, engine_class, store, n_pivots=16):
+        """
+        Picks pivots by farthest-first traversal and computes the pivot table.
+        :param engine_class: Engine class that allows metric indexing
+        :param store: Signature store of the dataset
+        :param n_pivots: Maximum number of pivots
+        :return: PivotIndex
+        """
+        n_rows = len(store)
+        n_pivots = min(n_pivots, n_rows)
+        pivot_rows = []
+        table = numpy.zeros((n_rows, n_pivots))
+        nearest_pivot = numpy.full(n_rows, numpy.inf)
+
+        row = 0
+        for p in range(n_pivots):
+            pivot_rows.append(row)
+            table[:, p] = engine_class.measure_distance_batch(store.signature(row), store.arrays)
+            nearest_pivot = numpy.minimum(nearest_pivot, table[:, p])
+            nearest_pivot[pivot_rows] = -1
+            row = int(numpy.argmax(nearest_pivot))
+
+        return cls(store.track_ids.copy(), numpy.array(pivot_rows, dtype=numpy.int64), table)
+
+    @classmethod
+    def load(cls, path):
+        with numpy.load(path) as index_file:
+            return cls(index_file['track_ids'], index_file['pivot_rows'], index_file['table'])
+
+    def save(self, path):
+        numpy.savez(path, track_ids=self.track_ids, pivot_rows=self.pivot_rows, table=self.table)
+
+    def matches(self, store):
+        return numpy.array_equal(self.track_ids, store.track_ids)
+
+    def search(self, engine_class, sig, signatures, n_tracks=10, chunk_size=32):
+        """
+        Exact top-k search, as far as the engine distance satisfies the triangle inequality.
+        :param engine_class: Engine class the index was built with
+        :param sig: Signature of the query
+        :param signatures: Stacked signatures the index was built over (store.arrays)
+        :param n_tracks: Number of nearest rows to return
+        :param chunk_size: Number of candidates whose exact distance is evaluated in one batch
+        :return: Tuple (rows, distances, number of distance evaluations), nearest first
+        """
+        n_rows = len(self.table)
+        pivot_signatures = {key: signatures[key][self.pivot_rows] for key in signatures}
+        query_pivot_distances = engine_class.measure_distance_batch(sig, pivot_signatures)
+        n_evaluations = len(self.pivot_rows)
+
+        distances = numpy.full(n_rows, numpy.inf)
+        evaluated = numpy.zeros(n_rows, dtype=bool)
+        distances[self.pivot_rows] = query_pivot_distances
+        evaluated[self.pivot_rows] = True
+
+        lower_bounds = numpy.amax(numpy.abs(self.table - query_pivot_distances), axis=1)
+        order = numpy.argsort(lower_bounds, kind='stable')
+        order = order[~evaluated[order]]
+
+        for start in range(0, len(order), chunk_size):
+            if evaluated.sum() >= n_tracks:
+                kth_distance = numpy.partition(distances[evaluated], n_tracks - 1)[n_tracks - 1]
+                if lower_bounds[order[start]] > kth_distance:
+                    break
+
+            rows = order[start:start + chunk_size]
+            distances[rows] = engine_class.measure_distance_batch(sig, {key: signatures[key][rows] for key in signatures})
+            evaluated[rows] = True
+            n_evaluations += len(rows)
+
+        candidates = numpy.nonzero(evaluated)[0]
+        nearest = candidates[numpy.argsort(distances[candidates], kind='stable')][:n_tracks]
+        return nearest, distances[nearest], n_evaluations
+
+
+def index_path_for(dataset_name, engine_class, signature_dir=signature_store.SIGNATURE_PARENT_DIR):
+    return os.path.join(signature_store.signature_dir_for(dataset_name, engine_class, signature_dir), INDEX_FILENAME)
+
+
+def build_index(dataset_name, engine_class, signature_dir=signature_store.SIGNATURE_PARENT_DIR, n_pivots=16):
+    """
+    Builds the metric index of a dataset and persists it next to its signatures.
+    """
+    store = signature_store.get_store(dataset_name, engine_class, signature_dir)
+    index = PivotIndex.build(engine_class, store, n_pivots)
+    index.save(index_path_for(dataset_name, engine_class, signature_dir))
+
+    with _indexes_lock:
+        _indexes[(dataset_name, engine_class.__name__, signature_dir)] = (store, index)
+
+    return index
+
+
+def get_index(dataset_name, engine_class, store, signature_dir=signature_store.SIGNATURE_PARENT_DIR):
+    """
+    Returns the persisted metric index matching the given store, or None if there is none or it is out of date.
+    """
+    key = (dataset_name, engine_class.__name__, signature_dir)
+    with _indexes_lock:
+        cached = _indexes.get(key)
+        if cached is not None and cached[0] is store:
+            return cached[1]
+
+        path = index_path_for(dataset_name, engine_class, signature_dir)
+        index = PivotIndex.load(path) if os.path.isfile(path) else None
+        if index is not None and not index.matches(store):
+            index = None
+
+        _indexes[key] = (store, index)
+        return index
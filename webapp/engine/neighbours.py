@@ -0,0 +1,303 @@
+__author__ = 'dm'
+
+import hashlib
+import os
+import threading
+import numpy
+import engine.engine as engine
+import engine.store as signature_store
+import engine.index as metric_index
+import engine.ann as ann
+import engine.parallel as parallel
+import engine.search as search
+
+GRAPH_FILENAME = "neighbours.npz"
+DEFAULT_N_NEIGHBOURS = 20
+BLOCK_SIZE = 256
+INDEX_THRESHOLD = 20000  # Stores of at least this many signatures shortlist neighbours by an index if one was built
+INDEX_CANDIDATES = 200
+
+_graphs = {}
+_graphs_lock = threading.Lock()
+
+
+class NeighbourGraph:
+    """
+    The most similar other tracks of every track of a dataset, by one engine. Neighbours are stored as rows of
+    the graph's own track and signature id arrays, most similar first, padded with -1 where a dataset has fewer
+    tracks. Every row also keeps a digest of the signature it was computed from, so that an update recomputes
+    only what the changed signatures affect. The stamp of the store the graph was computed from tells whether
+    signatures were written since.
+    """
+    def __init__(self, track_ids, signature_ids, digests, neighbour_rows, similarities, store_stamp=None):
+        self.track_ids = track_ids
+        self.signature_ids = signature_ids
+        self.digests = digests
+        self.neighbour_rows = neighbour_rows  # N x k
+        self.similarities = similarities  # N x k
+        self.store_stamp = store_stamp
+        self.stale = False  # Set by get_graph when the signatures changed after the graph was built
+        self._rows = None
+
+    @property
+    def n_neighbours(self):
+        return self.neighbour_rows.shape[1]
+
+    @classmethod
+    def build(cls, engine_class, store, n_neighbours=DEFAULT_N_NEIGHBOURS, searcher=None, find_candidates=None):
+        """
+        Computes the neighbours of every signature of a store, in blocks of rows.
+        :param searcher: Optional parallel.ShardedSearcher of the store to score the blocks on
+        :param find_candidates: Optional function returning the candidate rows of a row, which are then the only
+        ones scored; None scores all rows
+        :return: NeighbourGraph
+        """
+        rows = numpy.arange(len(store))
+        neighbour_rows, similarities = _score_blocks(engine_class, store, rows, n_neighbours, None,
+                                                     searcher, find_candidates)
+        return cls(store.track_ids.copy(), store.signature_ids.copy(), signature_digests(store),
+                   neighbour_rows, similarities, store.stamp)
+
+    def update(self, engine_class, store, searcher=None, find_candidates=None):
+        """
+        Brings the graph up to date with a store whose signatures were added, changed or removed.
+        New and changed signatures get their neighbours computed anew, as do the rows that had one of the changed
+        or removed signatures among their neighbours. All other rows only need to be compared with the new and
+        changed signatures. Compound engines normalize similarities over the whole dataset, so their graphs
+        are always rebuilt.
+        :return: Updated NeighbourGraph
+        """
+        if issubclass(engine_class, engine.CompoundEngine):
+            return NeighbourGraph.build(engine_class, store, self.n_neighbours, searcher, find_candidates)
+
+        digests = signature_digests(store)
+        old_rows = {int(track_id): row for row, track_id in enumerate(self.track_ids)}
+        old_of_new = numpy.full(len(store), -1, dtype=numpy.int64)
+        for row, track_id in enumerate(store.track_ids):
+            old_row = old_rows.get(int(track_id))
+            if old_row is not None and self.digests[old_row] == digests[row]:
+                old_of_new[row] = old_row
+
+        unchanged = numpy.nonzero(old_of_new >= 0)[0]
+        changed = numpy.nonzero(old_of_new < 0)[0]
+        new_of_old = numpy.full(len(self.track_ids) + 1, -1, dtype=numpy.int64)  # The extra -1 maps padding
+        new_of_old[old_of_new[unchanged]] = unchanged
+
+        old_neighbours = self.neighbour_rows[old_of_new[unchanged]]
+        kept = new_of_old[old_neighbours]
+        lost = numpy.any((old_neighbours >= 0) & (kept < 0), axis=1)
+
+        k = self.n_neighbours
+        neighbour_rows = numpy.full((len(store), k), -1, dtype=numpy.int64)
+        similarities = numpy.full((len(store), k), -numpy.inf)
+
+        stale = numpy.concatenate([changed, unchanged[lost]])
+        if len(stale) > 0:
+            neighbour_rows[stale], similarities[stale] = _score_blocks(engine_class, store, stale, k, None,
+                                                                       searcher, find_candidates)
+
+        fresh = unchanged[~lost]
+        fresh_rows, fresh_similarities = kept[~lost], self.similarities[old_of_new[fresh]]
+        if len(changed) > 0 and len(fresh) > 0:
+            new_rows, new_similarities = _score_blocks(engine_class, store, fresh, k, changed, searcher)
+            fresh_rows, fresh_similarities = _merge(fresh_rows, fresh_similarities, new_rows, new_similarities, k)
+        neighbour_rows[fresh], similarities[fresh] = fresh_rows, fresh_similarities
+
+        return NeighbourGraph(store.track_ids.copy(), store.signature_ids.copy(), digests, neighbour_rows, similarities,
+                              store.stamp)
+
+    @classmethod
+    def load(cls, path):
+        with numpy.load(path) as graph_file:
+            # Graphs saved before the store stamp was kept count as stale; an empty stamp is a store never stamped
+            store_stamp = graph_file['store_stamp'] if 'store_stamp' in graph_file.files else numpy.array([-1])
+            store_stamp = int(store_stamp[0]) if len(store_stamp) > 0 else None
+            return cls(graph_file['track_ids'], graph_file['signature_ids'], graph_file['digests'],
+                       graph_file['neighbour_rows'], graph_file['similarities'], store_stamp)
+
+    def save(self, path):
+        tmp_path = path + "." + str(os.getpid()) + ".tmp.npz"
+        store_stamp = numpy.array([] if self.store_stamp is None else [self.store_stamp], dtype=numpy.int64)
+        numpy.savez(tmp_path, track_ids=self.track_ids, signature_ids=self.signature_ids, digests=self.digests,
+                    neighbour_rows=self.neighbour_rows, similarities=self.similarities, store_stamp=store_stamp)
+        os.replace(tmp_path, path)
+
+    def neighbours(self, track_id, n=None):
+        """
+        :param n: Number of neighbours to return, at most the number the graph was built with
+        :return: List of (signature id, similarity), most similar first, or None if the track is not in the graph
+        """
+        if self._rows is None:
+            self._rows = {int(track_id): row for row, track_id in enumerate(self.track_ids)}
+        row = self._rows.get(int(track_id))
+        if row is None:
+            return None
+
+        rows, similarities = self.neighbour_rows[row][:n], self.similarities[row][:n]
+        return [(int(self.signature_ids[r]), float(s)) for r, s in zip(rows, similarities) if r >= 0]
+
+
+def signature_digests(store):
+    """
+    Digest of every signature of a store, to tell which signatures changed since a graph was built.
+    """
+    keys = sorted(store.arrays)
+    digests = numpy.empty(len(store), dtype=numpy.uint64)
+    for row in range(len(store)):
+        digest = hashlib.blake2b(digest_size=8)
+        for key in keys:
+            digest.update(numpy.ascontiguousarray(store.arrays[key][row]).tobytes())
+        digests[row] = int.from_bytes(digest.digest(), 'little')
+    return digests
+
+
+def score_rows(engine_class, arrays, task):
+    """
+    Finds the most similar other rows of a block of rows. Runs in this process or on the workers of a
+    parallel.ShardedSearcher.
+    :param task: Tuple (rows, number of neighbours, columns): columns are the rows to compare with, either one
+    array shared by the block, a list of one array per row, or None for all rows
+    :return: Tuple (neighbour rows, similarities), each of shape len(rows) x number of neighbours
+    """
+    rows, n_neighbours, columns = task
+    neighbour_rows = numpy.full((len(rows), n_neighbours), -1, dtype=numpy.int64)
+    similarities = numpy.full((len(rows), n_neighbours), -numpy.inf)
+
+    for i, row in enumerate(rows):
+        row_columns = columns[i] if isinstance(columns, list) else columns
+        if row_columns is None:
+            candidates, compared = None, arrays
+        else:
+            candidates = numpy.asarray(row_columns, dtype=numpy.int64)
+            compared = {key: arrays[key][candidates] for key in arrays}
+
+        sig = {key: arrays[key][row] for key in arrays}
+        measures = search.normalize_similarities(engine_class.measure_similarity_batch(sig, compared), engine_class)
+        measures = numpy.array(measures, dtype=float)
+        if candidates is None:
+            candidates = numpy.arange(len(measures))
+        measures[candidates == row] = -numpy.inf
+
+        n = min(n_neighbours, len(measures))
+        if n == 0:
+            continue
+        top = numpy.argpartition(-measures, n - 1)[:n]
+        top = top[numpy.argsort(-measures[top], kind='stable')]
+        top = top[numpy.isfinite(measures[top])]
+        neighbour_rows[i, :len(top)] = candidates[top]
+        similarities[i, :len(top)] = measures[top]
+
+    return neighbour_rows, similarities
+
+
+def _score_blocks(engine_class, store, rows, n_neighbours, columns=None, searcher=None, find_candidates=None):
+    tasks = []
+    for start in range(0, len(rows), BLOCK_SIZE):
+        block = rows[start:start + BLOCK_SIZE]
+        if find_candidates is not None:
+            tasks.append((block, n_neighbours, [find_candidates(row) for row in block]))
+        else:
+            tasks.append((block, n_neighbours, columns))
+
+    if searcher is None:
+        results = [score_rows(engine_class, store.arrays, task) for task in tasks]
+    else:
+        results = list(searcher.map_rows(score_rows, tasks))
+
+    if len(results) == 0:
+        return numpy.zeros((0, n_neighbours), dtype=numpy.int64), numpy.zeros((0, n_neighbours))
+    return numpy.concatenate([r for r, s in results]), numpy.concatenate([s for r, s in results])
+
+
+def _merge(rows_a, similarities_a, rows_b, similarities_b, k):
+    # Both lists are sorted and disjoint; padding has similarity -inf and sorts last
+    rows = numpy.concatenate([rows_a, rows_b], axis=1)
+    similarities = numpy.concatenate([similarities_a, similarities_b], axis=1)
+    order = numpy.argsort(-similarities, axis=1, kind='stable')[:, :k]
+    return numpy.take_along_axis(rows, order, axis=1), numpy.take_along_axis(similarities, order, axis=1)
+
+
+def candidate_finder(dataset_name, engine_class, store, signature_dir=signature_store.SIGNATURE_PARENT_DIR,
+                     n_candidates=INDEX_CANDIDATES):
+    """
+    Returns a function shortlisting the candidate neighbours of a row by the dataset's ANN or metric index,
+    or None if the store is small enough to compare all pairs or no index was built.
+    """
+    if len(store) < INDEX_THRESHOLD or issubclass(engine_class, engine.CompoundEngine):
+        return None
+
+    if engine_class.get_gaussian_keys() is not None:
+        index = ann.get_index(dataset_name, engine_class, store, signature_dir)
+        if index is not None:
+            means_key, covariance_key = engine_class.get_gaussian_keys()
+            return lambda row: index.search(store.arrays[means_key][row], store.arrays[covariance_key][row],
+                                            n_candidates + 1)
+
+    if engine_class.allows_metric_indexing():
+        index = metric_index.get_index(dataset_name, engine_class, store, signature_dir)
+        if index is not None:
+            return lambda row: index.search(engine_class, store.signature(row), store.arrays, n_candidates + 1)[0]
+
+    return None
+
+
+def graph_path_for(dataset_name, engine_class, signature_dir=signature_store.SIGNATURE_PARENT_DIR):
+    return os.path.join(signature_store.signature_dir_for(dataset_name, engine_class, signature_dir), GRAPH_FILENAME)
+
+
+def build_graph(dataset_name, engine_class, signature_dir=signature_store.SIGNATURE_PARENT_DIR,
+                n_neighbours=DEFAULT_N_NEIGHBOURS, workers=None, incremental=True):
+    """
+    Builds the neighbour graph of a dataset, or updates the persisted one, and persists it next to the signatures.
+    :param workers: Number of processes to score on; None uses all cores, 1 scores in this process
+    :param incremental: Update the persisted graph if it was built with the same number of neighbours
+    """
+    store = signature_store.get_store(dataset_name, engine_class, signature_dir)
+    path = graph_path_for(dataset_name, engine_class, signature_dir)
+    find_candidates = candidate_finder(dataset_name, engine_class, store, signature_dir)
+
+    old = NeighbourGraph.load(path) if incremental and os.path.isfile(path) else None
+    if old is not None and old.n_neighbours != n_neighbours:
+        old = None
+
+    searcher = None
+    if workers != 1 and len(store) > BLOCK_SIZE:
+        searcher = parallel.ShardedSearcher(engine_class, store, workers)
+    try:
+        if old is not None:
+            graph = old.update(engine_class, store, searcher, find_candidates)
+        else:
+            graph = NeighbourGraph.build(engine_class, store, n_neighbours, searcher, find_candidates)
+    finally:
+        if searcher is not None:
+            searcher.close()
+
+    graph.save(path)
+    with _graphs_lock:
+        _graphs[(dataset_name, engine_class.__name__, signature_dir)] = (os.path.getmtime(path), graph)
+    return graph
+
+
+def get_graph(dataset_name, engine_class, signature_dir=signature_store.SIGNATURE_PARENT_DIR):
+    """
+    Returns the persisted neighbour graph of a dataset, reloaded when it was rebuilt, or None if none was built.
+    The graph's stale attribute is set when preprocess.py wrote signatures after the graph was built, e.g. when it
+    was run without --neighbours.
+    """
+    key = (dataset_name, engine_class.__name__, signature_dir)
+    path = graph_path_for(dataset_name, engine_class, signature_dir)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    stamp = signature_store.read_stamp(dataset_name, engine_class, signature_dir)
+
+    with _graphs_lock:
+        cached = _graphs.get(key)
+        if cached is not None and cached[0] == mtime:
+            graph = cached[1]
+        else:
+            graph = NeighbourGraph.load(path)
+            _graphs[key] = (mtime, graph)
+        graph.stale = graph.store_stamp != stamp
+        return graph
@@ -0,0 +1,160 @@
+__author__ = 'dm'
+
+import atexit
+import contextlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import numpy
+import engine.engine as engine
+
+_searchers = {}
+_searchers_lock = threading.Lock()
+
+# Workers are started from a fresh interpreter: forking the threaded web application would copy the locks other
+# threads hold at that moment
+MP_CONTEXT = multiprocessing.get_context("spawn")
+
+# Signature arrays of the (dataset, engine) pair a worker process serves, see _attach
+_worker_state = {}
+
+
+class ShardedSearcher:
+    """
+    Scores queries against a signature store on a persistent pool of worker processes, one shard per worker.
+    The stacked signatures are written once to memory-mapped files, so all workers share the same pages
+    instead of holding a copy each.
+    Searchers shared through get_searcher count their users, so that a replaced one is closed only once no search
+    uses it any more.
+    """
+    def __init__(self, engine_class, store, n_workers=None):
+        self.engine_class = engine_class
+        self.n_rows = len(store)
+        n_workers = n_workers or os.cpu_count() or 1
+
+        self.array_dir = tempfile.mkdtemp(prefix="msse_signatures_")
+        for key in store.arrays:
+            numpy.save(os.path.join(self.array_dir, key + ".npy"), store.arrays[key])
+
+        bounds = numpy.linspace(0, self.n_rows, n_workers + 1).astype(int)
+        self.shards = [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+        self.pool = MP_CONTEXT.Pool(len(self.shards) or 1, initializer=_attach,
+                                    initargs=(engine_class.__name__, self.array_dir, list(store.arrays)))
+        self.users = 0
+        self.retired = False
+
+    def search(self, sig, n_tracks=10, normalize=None):
+        """
+        :param sig: Signature of the query
+        :param n_tracks: Number of most similar rows to return
+        :param normalize: Function combining the partial similarities of a compound engine over the whole store
+        :return: Tuple (rows, similarities), most similar first
+        """
+        tasks = [(sig, start, stop, n_tracks) for start, stop in self.shards]
+        shard_results = self.pool.map(_score_shard, tasks)
+
+        if issubclass(self.engine_class, engine.CompoundEngine):
+            # Rank normalization needs the raw partial similarities of the whole store
+            measures = {key: numpy.concatenate([measures[key] for measures in shard_results])
+                        for key in shard_results[0]}
+            similarities = normalize(measures, self.engine_class)
+            rows = numpy.arange(self.n_rows)
+        else:
+            rows = numpy.concatenate([r for r, s in shard_results])
+            similarities = numpy.concatenate([s for r, s in shard_results])
+
+        top = _top_k(similarities, n_tracks)
+        return rows[top], similarities[top]
+
+    def map_rows(self, fn, tasks):
+        """
+        Runs fn(engine class, signature arrays, task) for every task on the worker processes, which hold all of
+        the store's arrays, and yields the results in order. fn must be a module-level function.
+        """
+        return self.pool.imap(_call_attached, ((fn, task) for task in tasks))
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        shutil.rmtree(self.array_dir, ignore_errors=True)
+
+
+def _top_k(similarities, n_tracks):
+    n_tracks = min(n_tracks, len(similarities))
+    if n_tracks == 0:
+        return numpy.array([], dtype=int)
+    top = numpy.argpartition(-similarities, n_tracks - 1)[:n_tracks]
+    return top[numpy.argsort(-similarities[top], kind='stable')]
+
+
+def _attach(engine_classname, array_dir, keys):
+    _worker_state['engine_class'] = getattr(engine, engine_classname)
+    arrays = {}
+    for key in keys:
+        path = os.path.join(array_dir, key + ".npy")
+        try:
+            arrays[key] = numpy.load(path, mmap_mode='r')
+        except ValueError:
+            # Arrays of Python objects (e.g. beat positions of varying length) cannot be memory-mapped
+            arrays[key] = numpy.load(path, allow_pickle=True)
+    _worker_state['arrays'] = arrays
+
+
+def _call_attached(job):
+    fn, task = job
+    return fn(_worker_state['engine_class'], _worker_state['arrays'], task)
+
+
+def _score_shard(task):
+    sig, start, stop, n_tracks = task
+    engine_class = _worker_state['engine_class']
+    shard = {key: value[start:stop] for key, value in _worker_state['arrays'].items()}
+    measures = engine_class.measure_similarity_batch(sig, shard)
+
+    if isinstance(measures, dict):
+        return measures
+
+    measures = numpy.asarray(measures)
+    top = _top_k(measures, n_tracks)
+    return top + start, measures[top]
+
+
+@contextlib.contextmanager
+def get_searcher(dataset_name, engine_class, store, signature_dir, n_workers=None):
+    """
+    Lends the persistent sharded searcher of a dataset to a with block, replacing it when the store was reloaded.
+    A replaced searcher keeps serving the blocks that were already using it and is closed when the last one ends.
+    """
+    key = (dataset_name, engine_class.__name__, signature_dir)
+    retired = None
+    with _searchers_lock:
+        cached = _searchers.get(key)
+        if cached is None or cached[0] is not store:
+            if cached is not None:
+                cached[1].retired = True
+                retired = cached[1] if cached[1].users == 0 else None
+            cached = (store, ShardedSearcher(engine_class, store, n_workers))
+            _searchers[key] = cached
+        searcher = cached[1]
+        searcher.users += 1
+    if retired is not None:
+        retired.close()
+
+    try:
+        yield searcher
+    finally:
+        with _searchers_lock:
+            searcher.users -= 1
+            unused = searcher.retired and searcher.users == 0
+        if unused:
+            searcher.close()
+
+
+@atexit.register
+def close_searchers():
+    with _searchers_lock:
+        for store, searcher in _searchers.values():
+            searcher.close()
+        _searchers.clear()
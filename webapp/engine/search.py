@@ -1,86 +1,373 @@
 __author__ = 'dm'
 
 import os
-import heapq
+import logging
 import numpy
 import scipy.stats as stats
+from sqlalchemy.orm import joinedload
 import db.database as db
 import engine.engine as engine
+import engine.store as signature_store
+import engine.index as metric_index
+import engine.ann as ann
+import engine.parallel as parallel
+import engine.streaming as streaming
+import util.audio as audio
+import util.cache as cache
+import util.metrics as metrics
 
-SIGNATURE_PARENT_DIR = os.path.join("data", "signatures")
+SIGNATURE_PARENT_DIR = signature_store.SIGNATURE_PARENT_DIR
+SCORING_CHUNK_SIZE = 4096
+
+# Search options that change the results of a search, and so belong to the key of cached results
+RESULT_OPTIONS = ('n_tracks', 'use_index', 'n_candidates', 'ann_candidates', 'ann_probe')
+
+# Query signatures by (query hash, query window, engine), ranked results by (query hash, query window, engine,
+# dataset, directory, options)
+signature_cache = cache.LRUCache(max_bytes=64 * 1024 * 1024)
+result_cache = cache.LRUCache(max_entries=1024)
+
+logger = logging.getLogger(__name__)
 
 
 class Similarity:
-    def __init__(self, signature, similarity_measure):
-        self.signature = signature
+    def __init__(self, row, similarity_measure):
+        self.row = row
         self.similarity_measure = similarity_measure
 
     def __lt__(self, other):
         return self.similarity_measure < other.similarity_measure
 
 
-def search_greatest_similarity(data, rate, engine_classname, dataset_id, signature_dir=SIGNATURE_PARENT_DIR, n_tracks=10):
+def search_greatest_similarity(data, rate, engine_classname, dataset_id, signature_dir=SIGNATURE_PARENT_DIR, n_tracks=10,
+                               use_index=False, search_stats=None, dump_path=None, workers=None, n_candidates=None,
+                               measure_recall=False, ann_candidates=None, ann_probe=16, sig_track=None, progress=None,
+                               offset=0.0, duration=None, n_segments=1):
+    """
+    Finds the tracks of a dataset most similar to the given audio.
+    :param data: Samples of the query, or a list of sample arrays of several windows of it
+    :param use_index: Use the dataset's metric index when the engine allows metric indexing and one was built.
+    The index prunes with the triangle inequality, which the divergences of the engines do not strictly satisfy,
+    so it can miss tracks a full scan finds; measure_recall reports how many
+    :param search_stats: Optional dictionary receiving the number of distance evaluations the search performed
+    :param dump_path: Optional path to save the normalized partial similarities of compound engines to
+    :param workers: Number of processes to shard a full scan across; None or 1 scans in this process
+    :param n_candidates: Shortlist this many candidates by the engine's proxy vectors and score only those exactly;
+    ignored for compound engines and engines without proxy vectors
+    :param measure_recall: Also run the exact search and report the recall of the shortlist or of the metric index
+    in search_stats
+    :param ann_candidates: Shortlist this many candidates from the dataset's approximate nearest-neighbour index
+    and rerank them exactly; ignored when the engine has no Gaussian signature or no index was built
+    :param ann_probe: Number of inverted lists of the approximate nearest-neighbour index to scan
+    :param sig_track: Signature of the query, if it was already extracted; data and rate are then ignored
+    :param progress: Optional function progress(stage, fraction) called as extraction and scoring proceed
+    :param offset: Start of the part of the samples to extract the query from, in seconds
+    :param duration: Length of that part in seconds, or None for the rest of the samples
+    :param n_segments: Extract from this many windows of the given duration spread over the samples, pooled into
+    one signature
+    :return: List of {"absolute_similarity", "signature"} dictionaries, most similar first
+    """
     engine_class = getattr(engine, engine_classname)
-    sig_track = engine_class.extract_signature(data, rate)
-    signatures = db.TrackSignature.query.filter(db.TrackSignature.audio_track.has(dataset_name=dataset_id))\
-        .filter_by(engine_class=engine_classname)
+    labels = {'engine': engine_classname, 'dataset': dataset_id}
+    metrics.increment("searches_total", **labels)
+
+    if sig_track is None:
+        _report(progress, "extraction", 0)
+        if not isinstance(data, list) and (offset > 0 or duration is not None):
+            data = audio.slice_segments(data, rate, offset, duration, n_segments)
+        with metrics.timed("extraction", **labels):
+            sig_track = extract_query_signature(engine_class, data, rate)
+    _report(progress, "scoring", 0)
+    store = signature_store.get_store(dataset_id, engine_class, signature_dir)
+
+    index = None
+    if use_index and engine_class.allows_metric_indexing():
+        index = metric_index.get_index(dataset_id, engine_class, store, signature_dir)
+
+    ann_index = None
+    if ann_candidates is not None and engine_class.get_gaussian_keys() is not None:
+        ann_index = ann.get_index(dataset_id, engine_class, store, signature_dir)
+
+    cascade = n_candidates is not None and not issubclass(engine_class, engine.CompoundEngine) \
+        and engine_class.proxy_vectors(stack_signature(sig_track)) is not None
+
+    if ann_index is not None:
+        means_key, covariance_key = engine_class.get_gaussian_keys()
+        with metrics.timed("ann_search", **labels):
+            candidates = ann_index.search(sig_track[means_key], sig_track[covariance_key], ann_candidates, ann_probe)
+            h = rerank_candidates(engine_class, sig_track, store, candidates, n_tracks)
+        n_evaluations = len(candidates)
+        if measure_recall and search_stats is not None:
+            exact = scan_greatest_similarity(engine_class, sig_track, store, n_tracks, labels=labels)
+            search_stats['shortlist_recall'] = shortlist_recall([s.row for s in exact], candidates)
+    elif cascade:
+        with metrics.timed("cascade_search", **labels):
+            h, candidates = cascade_greatest_similarity(engine_class, sig_track, store, n_tracks, n_candidates)
+        n_evaluations = len(candidates)
+        if measure_recall and search_stats is not None:
+            exact = scan_greatest_similarity(engine_class, sig_track, store, n_tracks, labels=labels)
+            search_stats['shortlist_recall'] = shortlist_recall([s.row for s in exact], candidates)
+    elif index is not None:
+        with metrics.timed("index_search", **labels):
+            rows, distances, n_evaluations = index.search(engine_class, sig_track, store.arrays, n_tracks)
+            # Scored by the similarity measure, so that the rows found rank and score as in a scan
+            h = rerank_candidates(engine_class, sig_track, store, rows, n_tracks)
+        metrics.increment("distance_evaluations_total", n_evaluations, **labels)
+        logger.info("metric index evaluated %d of %d distances", n_evaluations, len(store))
+        if measure_recall and search_stats is not None:
+            exact = scan_greatest_similarity(engine_class, sig_track, store, n_tracks, labels=labels)
+            search_stats['shortlist_recall'] = shortlist_recall([s.row for s in exact], rows)
+    elif workers is not None and workers > 1:
+        with parallel.get_searcher(dataset_id, engine_class, store, signature_dir, workers) as searcher, \
+                metrics.timed("sharded_search", **labels):
+            rows, similarities = searcher.search(sig_track, n_tracks,
+                                                 lambda measures, cls: normalize_similarities(measures, cls, dump_path))
+        h = [Similarity(row, similarity) for row, similarity in zip(rows, similarities)]
+        n_evaluations = len(store)
+    else:
+        h = scan_greatest_similarity(engine_class, sig_track, store, n_tracks, dump_path, labels, progress)
+        n_evaluations = len(store)
+
+    _report(progress, "scoring", 1)
+
+    if search_stats is not None:
+        search_stats['distance_evaluations'] = n_evaluations
+        search_stats['catalog_size'] = len(store)
+
+    return fetch_results([(int(store.signature_ids[s.row]), s.similarity_measure) for s in h], labels)
+
+
+def extract_query_signature(engine_class, data, rate):
+    # A list holds several windows of the query, which are pooled
+    if isinstance(data, list):
+        return streaming.extract_segments(data, rate, [engine_class])[engine_class]
+    return engine_class.extract_signature(data, rate)
+
+
+def fetch_results(ranked, labels=None):
+    """
+    Loads the signature records of ranked search results, with their tracks.
+    :param ranked: List of (signature id, similarity), most similar first
+    :return: List of {"absolute_similarity", "signature"} dictionaries in the same order
+    """
+    with metrics.timed("db_query", **(labels or {})):
+        records = {r.id: r for r in db.TrackSignature.query.options(joinedload(db.TrackSignature.audio_track))
+                   .filter(db.TrackSignature.id.in_([signature_id for signature_id, similarity in ranked]))}
+
+    return [{"absolute_similarity": similarity, "signature": records[signature_id]}
+            for signature_id, similarity in ranked if signature_id in records]
+
+
+def search_cached(load_audio, query_key, engine_classname, dataset_id, signature_dir=SIGNATURE_PARENT_DIR,
+                  progress=None, query_window=None, **search_options):
+    """
+    Like search_greatest_similarity, but reuses the signature and the results of earlier searches of the same query.
+    Cached results are discarded once preprocess.py has changed the signatures of the dataset.
+    :param load_audio: Function returning the query audio as (data, rate), only called if its signature is not cached;
+    data may be a list of sample arrays of several windows of the query
+    :param query_key: Hash of the query's contents, e.g. util.cache.content_hash of the uploaded file
+    :param query_window: Hashable description of the part of the query load_audio decodes, e.g.
+    (offset, duration, n_segments, sampling rate), or None for all of it
+    :param progress: Optional function progress(stage, fraction) called as decoding, extraction and scoring proceed
+    :param search_options: Further arguments of search_greatest_similarity
+    """
+    engine_class = getattr(engine, engine_classname)
+    labels = {'engine': engine_classname, 'dataset': dataset_id}
+    stamp = signature_store.read_stamp(dataset_id, engine_class, signature_dir)
+    signature_key = (query_key, query_window, engine_classname)
+    result_key = (query_key, query_window, engine_classname, dataset_id, signature_dir,
+                  tuple(sorted((k, v) for k, v in search_options.items() if k in RESULT_OPTIONS)))
+
+    cached = result_cache.get(result_key)
+    if cached is not None and cached[0] == stamp:
+        metrics.increment("cache_hits_total", cache="results", **labels)
+        return fetch_results(cached[1], labels)
+    metrics.increment("cache_misses_total", cache="results", **labels)
+
+    sig_track = signature_cache.get(signature_key)
+    if sig_track is None:
+        metrics.increment("cache_misses_total", cache="signatures", **labels)
+        _report(progress, "decode", 0)
+        data, rate = load_audio()
+        _report(progress, "extraction", 0)
+        with metrics.timed("extraction", **labels):
+            sig_track = extract_query_signature(engine_class, data, rate)
+        signature_cache.put(signature_key, sig_track)
+    else:
+        metrics.increment("cache_hits_total", cache="signatures", **labels)
+
+    results = search_greatest_similarity(None, None, engine_classname, dataset_id, signature_dir,
+                                         sig_track=sig_track, progress=progress, **search_options)
+    result_cache.put(result_key, (stamp, [(r["signature"].id, r["absolute_similarity"]) for r in results]))
+    return results
+
+
+def _report(progress, stage, fraction):
+    if progress is not None:
+        progress(stage, fraction)
+
 
-    h = []
-    similarities = []
-    for signature_record in signatures:
-        sig_file = signature_record.path + ".npz"
-        signature = numpy.load(sig_file)
+def scan_greatest_similarity(engine_class, sig_track, store, n_tracks=10, dump_path=None, labels=None, progress=None):
+    """
+    Scores the query against every signature in the store.
+    :param dump_path: Optional path to save the normalized partial similarities of compound engines to, for debugging
+    :param labels: Labels of the recorded stage timings, e.g. engine and dataset
+    :param progress: Optional function progress("scoring", fraction); the store is then scored in chunks
+    :return: List of Similarity objects of the n_tracks most similar rows, most similar first
+    """
+    labels = labels or {'engine': engine_class.__name__}
 
-        print("measuring similarity with track " + signature_record.audio_track.name)
-        similarity_measure = engine_class.measure_similarity(sig_track, signature)
-        print("similarity is " + str(similarity_measure))
+    with metrics.timed("scoring", **labels):
+        measures = measure_store(engine_class, sig_track, store, progress)
 
-        sim_object = Similarity(signature_record, similarity_measure)
-        similarities.append(sim_object)
+    if logger.isEnabledFor(logging.DEBUG):
+        for row in range(len(store)):
+            if isinstance(measures, dict):
+                similarity_measure = {key: measures[key][row] for key in measures}
+            else:
+                similarity_measure = measures[row]
+            logger.debug("similarity with signature %d is %s", store.signature_ids[row], similarity_measure)
 
-    similarities = normalize_similarities(similarities, engine_class)
+    with metrics.timed("normalization", **labels):
+        similarities = normalize_similarities(measures, engine_class, dump_path)
 
-    for sim_object in similarities:
-        if len(h) < n_tracks:
-            heapq.heappush(h, sim_object)
+    n_tracks = min(n_tracks, len(similarities))
+    if n_tracks == 0:
+        return []
+    with metrics.timed("top_k", **labels):
+        rows = numpy.argpartition(-similarities, n_tracks - 1)[:n_tracks]
+        rows = rows[numpy.argsort(-similarities[rows], kind='stable')]
 
-        elif sim_object > h[0]:
-            heapq.heappushpop(h, sim_object)
+    return [Similarity(row, similarities[row]) for row in rows]
 
-    h.sort()
-    h = h[::-1]
 
-    ret = []
-    for s in h:
-        ret.append({
-            "absolute_similarity": s.similarity_measure,
-            "signature": s.signature
-        })
+def measure_store(engine_class, sig_track, store, progress=None, chunk_size=SCORING_CHUNK_SIZE):
+    """
+    Measures the similarity of the query to every signature in the store, reporting progress after every chunk
+    if a progress function is given.
+    :return: Array of similarities, or dictionary {key: array} of partial similarities of a compound engine
+    """
+    if progress is None or len(store) <= chunk_size:
+        return engine_class.measure_similarity_batch(sig_track, store.arrays)
 
-    return ret
+    chunks = []
+    for start in range(0, len(store), chunk_size):
+        chunk = {key: value[start:start + chunk_size] for key, value in store.arrays.items()}
+        chunks.append(engine_class.measure_similarity_batch(sig_track, chunk))
+        progress("scoring", min(start + chunk_size, len(store)) / len(store))
 
+    if isinstance(chunks[0], dict):
+        return {key: numpy.concatenate([chunk[key] for chunk in chunks]) for key in chunks[0]}
+    return numpy.concatenate(chunks)
 
-def normalize_similarities(similarities, engine_class):
-    if isinstance(similarities[0].similarity_measure, dict):
-        # For every key in the dictionary, make minimum, maximum and range
+
+def stack_signature(sig_track):
+    return {key: numpy.asarray(sig_track[key])[None] for key in sig_track}
+
+
+def get_proxies(engine_class, store):
+    if store.proxies is None:
+        store.proxies = engine_class.proxy_vectors(store.arrays)
+    return store.proxies
+
+
+def cascade_greatest_similarity(engine_class, sig_track, store, n_tracks=10, n_candidates=100):
+    """
+    Shortlists the n_candidates rows nearest to the query by the engine's proxy vectors
+    and scores only those with the engine's similarity measure.
+    :return: Tuple (list of Similarity objects of the n_tracks most similar rows, most similar first;
+    rows of the shortlist)
+    """
+    proxies = get_proxies(engine_class, store)
+    query_proxy = engine_class.proxy_vectors(stack_signature(sig_track))[0]
+    proxy_distances = numpy.sum((proxies - query_proxy) ** 2, axis=1)
+
+    n_candidates = min(n_candidates, len(store))
+    if n_candidates == 0:
+        return [], numpy.array([], dtype=int)
+    candidates = numpy.argpartition(proxy_distances, n_candidates - 1)[:n_candidates]
+
+    return rerank_candidates(engine_class, sig_track, store, candidates, n_tracks), candidates
+
+
+def rerank_candidates(engine_class, sig_track, store, candidates, n_tracks=10):
+    """
+    Scores the query against the shortlisted rows only with the engine's similarity measure.
+    :return: List of Similarity objects of the n_tracks most similar candidates, most similar first
+    """
+    n_tracks = min(n_tracks, len(candidates))
+    if n_tracks == 0:
+        return []
+
+    shortlist = {key: store.arrays[key][candidates] for key in store.arrays}
+    similarities = numpy.asarray(engine_class.measure_similarity_batch(sig_track, shortlist))
+
+    top = numpy.argpartition(-similarities, n_tracks - 1)[:n_tracks]
+    top = top[numpy.argsort(-similarities[top], kind='stable')]
+
+    return [Similarity(candidates[i], similarities[i]) for i in top]
+
+
+def shortlist_recall(exact_rows, candidates):
+    """
+    Fraction of the exact top rows that made it into the shortlist.
+    """
+    if len(exact_rows) == 0:
+        return 1.0
+    return len(set(int(r) for r in exact_rows) & set(int(c) for c in candidates)) / len(exact_rows)
+
+
+def measure_cascade_recall(engine_class, queries, store, n_tracks=10, candidate_counts=(50, 100, 200, 500)):
+    """
+    Measures the mean shortlist recall of cascade search for several shortlist sizes, to tune n_candidates.
+    :param queries: List of query signatures
+    :return: Dictionary {n_candidates: mean recall}
+    """
+    recalls = {n_candidates: [] for n_candidates in candidate_counts}
+    for sig_track in queries:
+        exact_rows = [s.row for s in scan_greatest_similarity(engine_class, sig_track, store, n_tracks)]
+        for n_candidates in candidate_counts:
+            h, candidates = cascade_greatest_similarity(engine_class, sig_track, store, n_tracks, n_candidates)
+            recalls[n_candidates].append(shortlist_recall(exact_rows, candidates))
+
+    return {n_candidates: float(numpy.mean(recalls[n_candidates])) for n_candidates in candidate_counts}
+
+
+def rank_normalize(measures):
+    """
+    Replaces every measure by its rank divided by the number of measures.
+    Tied measures all get the rank of the first of them in sorted order; NaN measures rank lowest.
+    """
+    measures = numpy.asarray(measures, dtype=float)
+    measures = numpy.where(numpy.isnan(measures), -numpy.inf, measures)
+    sorted_measures = numpy.sort(measures)
+    return numpy.searchsorted(sorted_measures, measures, side='left') / len(measures)
+
+
+def normalize_similarities(measures, engine_class, dump_path=None):
+    """
+    Combines the partial similarities of a compound engine into one similarity per track.
+    Every partial similarity is rank-normalized over the whole dataset and weighted by the engine's partial weights.
+    :param measures: Array of similarities, or dictionary {key: array} of partial similarities
+    :param engine_class: Engine the measures come from
+    :param dump_path: Optional path to save the normalized partial similarities to, for debugging
+    :return: Array of similarities
+    """
+    if isinstance(measures, dict):
         weights = engine_class.get_partial_weights()
         weight_sum = numpy.sum([weights[k] for k in weights])
+
+        normalized = {}
         for key in weights:
-            print("Normalizing " + key)
-            all_meaures = [s.similarity_measure[key] for s in similarities]
-            am_max = numpy.amax(all_meaures)
-            am_min = numpy.amin(all_meaures)
-            print("am_max: " + str(am_max) + "\t am_min: " + str(am_min))
-            sorted_measures = sorted(all_meaures)
-            for s in similarities:
-                # s.similarity_measure[key] = ((s.similarity_measure[key] - am_min) / (am_max - am_min))\
-                s.similarity_measure[key] = (sorted_measures.index(s.similarity_measure[key]) / len(sorted_measures))\
-                                            * weights[key] / weight_sum
-                if s.similarity_measure[key] == numpy.nan:
-                    s.similarity_measure[key] = 0
-
-        numpy.savez("similarities", similarities)
-        for s in similarities:
-            s.similarity_measure = numpy.sum([s.similarity_measure[key] for key in s.similarity_measure])
-
-    return similarities
+            all_measures = numpy.asarray(measures[key])
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Normalizing %s, am_max: %s, am_min: %s",
+                             key, numpy.amax(all_measures), numpy.amin(all_measures))
+            normalized[key] = rank_normalize(all_measures) * weights[key] / weight_sum
+
+        if dump_path is not None:
+            numpy.savez(dump_path, **normalized)
+
+        return numpy.sum([normalized[key] for key in normalized], axis=0)
+
+    return numpy.asarray(measures)
@@ -0,0 +1,155 @@
+__author__ = 'dm'
+
+import json
+import os
+import numpy
+
+RECORDS_FILENAME = "signatures.bin"
+DTYPE_FILENAME = "signatures.json"
+
+
+def records_path(dest_dir):
+    return os.path.join(dest_dir, RECORDS_FILENAME)
+
+
+def is_signature_file(path):
+    return os.path.basename(path) == RECORDS_FILENAME
+
+
+def record_dtype(signature, float32=False):
+    """
+    Record type holding a track id and every key of the given signature.
+    :param signature: Dictionary {key: array} whose shapes all later signatures share
+    :param float32: Store double precision values in single precision to halve the file size
+    """
+    fields = [('track_id', '<i8', ())]
+    for key in sorted(signature):
+        value = numpy.asarray(signature[key])
+        dtype = value.dtype
+        if float32 and dtype == numpy.float64:
+            dtype = numpy.dtype(numpy.float32)
+        fields.append((key, dtype.str, value.shape))
+    return numpy.dtype(fields)
+
+
+def save_dtype(dest_dir, dtype):
+    fields = [[name, dtype.fields[name][0].base.str, list(dtype.fields[name][0].shape)] for name in dtype.names]
+    path = os.path.join(dest_dir, DTYPE_FILENAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"fields": fields}, f)
+    os.replace(path + ".tmp", path)
+
+
+def read_dtype(dest_dir):
+    path = os.path.join(dest_dir, DTYPE_FILENAME)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return numpy.dtype([(name, dtype, tuple(shape)) for name, dtype, shape in json.load(f)["fields"]])
+
+
+def append(dest_dir, signatures, float32=False):
+    """
+    Appends signatures to the record file of a directory, creating it on first use.
+    A track appended again supersedes its earlier records. A record cut short by an interrupted append is dropped.
+    :param signatures: List of (track id, signature dictionary)
+    :param float32: Single precision for a new file; an existing file keeps its precision
+    :raise ValueError: If a signature does not have the keys and shapes of the file's records
+    """
+    if len(signatures) == 0:
+        return
+
+    dtype = read_dtype(dest_dir)
+    if dtype is None:
+        dtype = record_dtype(signatures[0][1], float32)
+        save_dtype(dest_dir, dtype)
+    else:
+        dtype = _drop_derived_fields(dest_dir, dtype, signatures[0][1])
+
+    records = numpy.zeros(len(signatures), dtype=dtype)
+    for i, (track_id, sig) in enumerate(signatures):
+        if sorted(sig) != sorted(dtype.names[1:]):
+            raise ValueError("Signature keys " + str(sorted(sig)) + " do not match the record file")
+        records[i]['track_id'] = track_id
+        for key in sig:
+            value = numpy.asarray(sig[key])
+            if value.shape != dtype.fields[key][0].shape:
+                raise ValueError("Shape " + str(value.shape) + " of " + key + " does not match the record file")
+            records[i][key] = value
+
+    path = records_path(dest_dir)
+    if os.path.isfile(path):
+        # A record cut short by an interrupted append would shift every record appended after it
+        size = os.path.getsize(path)
+        if size % dtype.itemsize != 0:
+            os.truncate(path, size - size % dtype.itemsize)
+    with open(path, "ab") as f:
+        records.tofile(f)
+
+
+def _drop_derived_fields(dest_dir, dtype, signature):
+    # Fields derived from another field, e.g. me_covariance_chol of me_covariance, that the engine no longer
+    # stores are dropped from the file, so records written by earlier versions stay appendable
+    keys = set(signature)
+    dropped = [name for name in dtype.names[1:] if name not in keys and
+               any(name.startswith(key + '_') for key in keys)]
+    if len(dropped) == 0 or set(dtype.names[1:]) - set(dropped) != keys:
+        return dtype
+
+    records = load(dest_dir)
+    kept_dtype = numpy.dtype([(name, dtype.fields[name][0]) for name in dtype.names if name not in dropped])
+    kept = numpy.zeros(len(records), dtype=kept_dtype)
+    for name in kept_dtype.names:
+        kept[name] = records[name]
+    del records
+
+    tmp_path = records_path(dest_dir) + ".tmp"
+    kept.tofile(tmp_path)
+    os.replace(tmp_path, records_path(dest_dir))
+    save_dtype(dest_dir, kept_dtype)
+    return kept_dtype
+
+
+def load(dest_dir):
+    """
+    Memory-maps the record file of a directory. A record cut short by an interrupted append is ignored.
+    :return: Structured array of records, or None if there is no record file
+    """
+    dtype = read_dtype(dest_dir)
+    path = records_path(dest_dir)
+    if dtype is None or not os.path.isfile(path):
+        return None
+
+    n_records = os.path.getsize(path) // dtype.itemsize
+    if n_records == 0:
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.memmap(path, dtype=dtype, mode='r', shape=(n_records,))
+
+
+def latest_rows(records):
+    """
+    :return: Tuple (sorted track ids, row of the latest record of each of them)
+    """
+    reversed_ids = numpy.asarray(records['track_id'])[::-1]
+    track_ids, reversed_rows = numpy.unique(reversed_ids, return_index=True)
+    return track_ids, len(records) - 1 - reversed_rows
+
+
+def compact(dest_dir):
+    """
+    Rewrites the record file without superseded records.
+    :return: Number of records dropped
+    """
+    records = load(dest_dir)
+    if records is None:
+        return 0
+
+    track_ids, rows = latest_rows(records)
+    n_dropped = len(records) - len(rows)
+    if n_dropped > 0:
+        kept = numpy.array(records[numpy.sort(rows)])
+        del records
+        tmp_path = records_path(dest_dir) + ".tmp"
+        kept.tofile(tmp_path)
+        os.replace(tmp_path, records_path(dest_dir))
+    return n_dropped
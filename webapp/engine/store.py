@@ -0,0 +1,173 @@
+__author__ = 'dm'
+
+import os
+import threading
+import numpy
+import db.database as db
+import engine.signature_file as signature_file
+import util.metrics as metrics
+
+SIGNATURE_PARENT_DIR = os.path.join("data", "signatures")
+STAMP_FILENAME = ".stamp"
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class SignatureStore:
+    """
+    All signatures of one dataset extracted by one engine, kept resident in memory.
+    Every signature key is packed into a single array whose first axis is the row index.
+    """
+    def __init__(self, signature_ids, track_ids, arrays, stamp=None):
+        self.signature_ids = signature_ids
+        self.track_ids = track_ids
+        self.arrays = arrays
+        self.stamp = stamp
+        self.proxies = None  # Proxy vectors for cascade search, computed on first use
+
+    def __len__(self):
+        return len(self.signature_ids)
+
+    def signature(self, row):
+        """
+        Returns the signature stored at the given row in the same form numpy.load returns it for a single file.
+        :param row: Row index
+        :return: Dictionary {key: array}
+        """
+        return {key: self.arrays[key][row] for key in self.arrays}
+
+
+def signature_dir_for(dataset_name, engine_class, signature_dir=SIGNATURE_PARENT_DIR):
+    return os.path.join(signature_dir, dataset_name, engine_class.get_engine_identifier())
+
+
+def pack_signatures(signatures):
+    """
+    Packs a list of signature dictionaries into one array per key.
+    Keys whose values differ in shape between tracks (e.g. beat positions) are kept as object arrays.
+    :param signatures: List of dictionaries {key: array}
+    :return: Dictionary {key: array with the track as the first axis}
+    """
+    if len(signatures) == 0:
+        return {}
+
+    arrays = {}
+    for key in signatures[0]:
+        values = [numpy.asarray(s[key]) for s in signatures]
+        if all(v.shape == values[0].shape for v in values):
+            arrays[key] = numpy.stack(values)
+        else:
+            packed = numpy.empty(len(values), dtype=object)
+            for i, v in enumerate(values):
+                packed[i] = v
+            arrays[key] = packed
+
+    return arrays
+
+
+def read_stamp(dataset_name, engine_class, signature_dir=SIGNATURE_PARENT_DIR):
+    stamp_path = os.path.join(signature_dir_for(dataset_name, engine_class, signature_dir), STAMP_FILENAME)
+    try:
+        return os.stat(stamp_path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def invalidate(dataset_name, engine_class, signature_dir=SIGNATURE_PARENT_DIR):
+    """
+    Marks the signatures of a dataset as changed, so that every process holding them reloads on next access.
+    """
+    dest_dir = signature_dir_for(dataset_name, engine_class, signature_dir)
+    if os.path.isdir(dest_dir):
+        with open(os.path.join(dest_dir, STAMP_FILENAME), "w") as f:
+            f.write(engine_class.__name__)
+
+    with _stores_lock:
+        _stores.pop((dataset_name, engine_class.__name__, signature_dir), None)
+
+
+def load_store(dataset_name, engine_class, signature_dir=SIGNATURE_PARENT_DIR):
+    labels = {'engine': engine_class.__name__, 'dataset': dataset_name}
+    stamp = read_stamp(dataset_name, engine_class, signature_dir)
+    with metrics.timed("db_query", **labels):
+        records = db.db.session.query(db.TrackSignature.id, db.TrackSignature.audio_track_id, db.TrackSignature.path)\
+            .join(db.AudioTrack, db.TrackSignature.audio_track_id == db.AudioTrack.id)\
+            .filter(db.AudioTrack.dataset_name == dataset_name)\
+            .filter(db.TrackSignature.engine_class == engine_class.__name__)\
+            .order_by(db.TrackSignature.id).all()
+
+    signature_ids = numpy.array([r[0] for r in records], dtype=numpy.int64)
+    track_ids = numpy.array([r[1] for r in records], dtype=numpy.int64)
+    with metrics.timed("signature_load", **labels):
+        arrays = engine_class.prepare_signatures(load_arrays(records))
+    return SignatureStore(signature_ids, track_ids, arrays, stamp)
+
+
+def load_arrays(records):
+    """
+    Loads the signatures of the given records, from record files where they were saved to one
+    and from the older per-track .npz files otherwise.
+    :param records: List of (signature id, track id, path)
+    :return: Dictionary {key: array with the record as the first axis}
+    :raise ValueError: If a record file has no record of a track the database lists in it
+    """
+    record_files = {}
+    rows = []
+    for signature_id, track_id, path in records:
+        if not signature_file.is_signature_file(path):
+            rows.append(None)
+            continue
+        if path not in record_files:
+            file_records = signature_file.load(os.path.dirname(path))
+            record_files[path] = (file_records,) + signature_file.latest_rows(file_records)
+        file_records, file_track_ids, file_rows = record_files[path]
+        i = numpy.searchsorted(file_track_ids, track_id)
+        if i == len(file_track_ids) or file_track_ids[i] != track_id:
+            raise ValueError("No record of track " + str(track_id) + " in " + path +
+                             ", run preprocess.py with --force to extract it again")
+        rows.append(file_rows[i])
+
+    if len(record_files) == 1 and all(row is not None for row in rows):
+        # Everything comes from one file: use its fields in place, without copying them when possible
+        file_records = next(iter(record_files.values()))[0]
+        rows = numpy.array(rows, dtype=numpy.int64)
+        if numpy.array_equal(rows, numpy.arange(len(file_records))):
+            return {key: file_records[key] for key in file_records.dtype.names[1:]}
+        return {key: file_records[key][rows] for key in file_records.dtype.names[1:]}
+
+    signatures = []
+    for (signature_id, track_id, path), row in zip(records, rows):
+        if row is None:
+            with numpy.load(path + ".npz") as sig_file:
+                signatures.append({key: sig_file[key] for key in sig_file.files})
+        else:
+            file_records = record_files[path][0]
+            signatures.append({key: file_records[key][row] for key in file_records.dtype.names[1:]})
+    return pack_signatures(signatures)
+
+
+def signature_exists(path):
+    """
+    Tells whether the signature file a TrackSignature path refers to exists.
+    """
+    if signature_file.is_signature_file(path):
+        return os.path.isfile(path)
+    return os.path.isfile(path + ".npz")
+
+
+def get_store(dataset_name, engine_class, signature_dir=SIGNATURE_PARENT_DIR):
+    """
+    Returns the resident signature store for a dataset and engine, loading it on first use
+    or when preprocess.py has written new signatures since it was loaded.
+    """
+    key = (dataset_name, engine_class.__name__, signature_dir)
+    stamp = read_stamp(dataset_name, engine_class, signature_dir)
+
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None or store.stamp != stamp:
+            store = load_store(dataset_name, engine_class, signature_dir)
+            _stores[key] = store
+
+    return store
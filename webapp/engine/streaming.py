@@ -0,0 +1,224 @@
+__author__ = 'dm'
+
+import math
+import os
+import librosa
+import numpy
+import engine.features as engine_features
+import util.audio as audio
+
+HOP_LENGTH = 512
+DEFAULT_BLOCK_FRAMES = 2048  # About 48 seconds at 22050 Hz
+DEFAULT_MARGIN_FRAMES = 64
+READ_LENGTH = 65536
+RESAMPLE_CONTEXT = 8192
+
+
+class GaussianAccumulator:
+    """
+    Running mean and covariance of feature frames, merged block by block with Chan's parallel update,
+    so that the statistics of any number of frames take constant memory.
+    """
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        self.m2 = None  # Sum of the outer products of the deviations from the mean
+
+    def update(self, frames):
+        """
+        :param frames: Feature frames (d x k), one column per frame
+        """
+        frames = numpy.asarray(frames, dtype=numpy.float64)
+        k = frames.shape[1]
+        if k == 0:
+            return
+
+        block_mean = numpy.mean(frames, axis=1)
+        centered = frames - block_mean[:, None]
+        block_m2 = centered @ centered.T
+
+        if self.n == 0:
+            self.n, self.mean, self.m2 = k, block_mean, block_m2
+            return
+
+        n = self.n + k
+        delta = block_mean - self.mean
+        self.mean = self.mean + delta * (k / n)
+        self.m2 = self.m2 + block_m2 + numpy.outer(delta, delta) * (self.n * k / n)
+        self.n = n
+
+    def covariance(self):
+        # Normalized by n - 1 like numpy.cov
+        return self.m2 / (self.n - 1)
+
+
+def array_blocks(data, block_length=READ_LENGTH):
+    """
+    Yields consecutive blocks of samples that are already in memory or memory-mapped, e.g. from the PCM cache.
+    """
+    for start in range(0, len(data), block_length):
+        yield numpy.asarray(data[start:start + block_length], dtype=numpy.float32)
+
+
+def file_blocks(path, sr=audio.DEFAULT_RATE, block_length=READ_LENGTH, context=RESAMPLE_CONTEXT):
+    """
+    Reads an audio file block by block, mixed down to mono and resampled to sr like librosa.load does.
+    Every block is resampled together with some context on both sides, which is then cut off again,
+    so the samples match those of resampling the whole file within the resampling filter's precision.
+    """
+    import soundfile
+
+    with soundfile.SoundFile(path) as f:
+        native_sr = f.samplerate
+        n_native = f.frames
+
+        # Block boundaries fall on native samples that map to whole output samples
+        g = math.gcd(int(native_sr), int(sr))
+        native_unit, output_unit = native_sr // g, sr // g
+        native_block = max(1, block_length // output_unit) * native_unit
+        native_context = max(1, context // native_unit) * native_unit
+        n_output = int(math.ceil(n_native * sr / native_sr))
+
+        produced = 0
+        for start in range(0, n_native, native_block):
+            stop = min(start + native_block, n_native)
+            read_start = max(0, start - native_context)
+            read_stop = min(n_native, stop + native_context)
+
+            f.seek(read_start)
+            block = f.read(read_stop - read_start, dtype='float32', always_2d=True)
+            block = numpy.mean(block, axis=1) if block.shape[1] > 1 else block[:, 0]
+
+            if native_sr != sr:
+                block = librosa.resample(block, orig_sr=native_sr, target_sr=sr)
+                offset = (start - read_start) // native_unit * output_unit
+                length = n_output - produced if stop == n_native else (stop - start) // native_unit * output_unit
+            else:
+                offset, length = start - read_start, stop - start
+
+            block = block[offset:offset + length]
+            produced += len(block)
+            yield block
+
+
+def audio_blocks(path, sr=audio.DEFAULT_RATE, cache_dir=None):
+    """
+    Blocks of the samples of an audio file: from the PCM cache if it holds the file, read with file_blocks
+    if soundfile can read the format, and decoded as a whole otherwise.
+    """
+    if cache_dir is not None:
+        cache_path = audio.pcm_cache_path(path, sr, cache_dir)
+        if os.path.isfile(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+            return array_blocks(audio.load(path, sr, cache_dir)[0])
+
+    try:
+        import soundfile
+        soundfile.info(path)
+    except Exception:
+        return array_blocks(audio.load(path, sr, cache_dir)[0])
+
+    return file_blocks(path, sr)
+
+
+def windows(blocks, block_frames=DEFAULT_BLOCK_FRAMES, margin_frames=DEFAULT_MARGIN_FRAMES, hop_length=HOP_LENGTH):
+    """
+    Regroups consecutive blocks of samples into overlapping windows aligned to the STFT frame grid.
+    Every window reaches margin_frames frames beyond its core on each side, so that frame features which
+    depend on neighbouring frames (median filtering, onset differences, tempogram windows) are the same
+    for the core frames as over the whole signal. Windows at the ends of the signal include its true ends.
+    :return: Generator of (window samples, global index of the window's first frame, core frame range (start, stop))
+    """
+    buffer = numpy.zeros(0, dtype=numpy.float32)
+    buffer_start = 0  # Global index of the first buffered sample
+    core_start = 0
+    exhausted = False
+    blocks = iter(blocks)
+
+    while True:
+        core_stop = core_start + block_frames
+        needed = (core_stop + margin_frames) * hop_length
+        while not exhausted and buffer_start + len(buffer) < needed:
+            try:
+                buffer = numpy.concatenate([buffer, next(blocks)])
+            except StopIteration:
+                exhausted = True
+
+        n_samples = buffer_start + len(buffer)
+        if exhausted:
+            # librosa centers frames, so the last frame is centered on sample n_samples // hop_length * hop_length
+            core_stop = min(core_stop, n_samples // hop_length + 1)
+            if core_start >= core_stop:
+                return
+
+        window_start = max(0, core_start - margin_frames) * hop_length
+        window_stop = min(n_samples, needed)
+        yield buffer[window_start - buffer_start:window_stop - buffer_start], window_start // hop_length, \
+            (core_start, core_stop)
+
+        core_start = core_stop
+        next_start = max(0, core_start - margin_frames) * hop_length
+        buffer = buffer[next_start - buffer_start:]
+        buffer_start = next_start
+
+
+def extract_signatures(blocks, rate, engine_classes, block_frames=DEFAULT_BLOCK_FRAMES,
+                       margin_frames=DEFAULT_MARGIN_FRAMES, block_callback=None):
+    """
+    Extracts the signatures of engines that allow streaming extraction from a stream of sample blocks,
+    in memory bounded by the window size rather than the length of the track. All engines share the
+    intermediate features of every window.
+    The signatures match those extracted from the whole track up to the decibel floor librosa applies
+    relative to the loudest bin (80 dB below it), which is taken per window: frames of near silence
+    in a track with much louder parts elsewhere can differ slightly.
+    :param blocks: Iterable of consecutive sample blocks, e.g. from file_blocks or array_blocks
+    :param rate: Sampling rate of the samples
+    :param engine_classes: Engines whose allows_streaming() is true
+    :param block_callback: Optional function called with every block of samples as it is read
+    :return: Dictionary {engine class: signature}
+    """
+    if block_callback is not None:
+        blocks = _observed(blocks, block_callback)
+
+    accumulators = {engine_class: GaussianAccumulator() for engine_class in engine_classes}
+    for window, first_frame, (core_start, core_stop) in windows(blocks, block_frames, margin_frames):
+        features = engine_features.FeatureContext(window, rate)
+        for engine_class in engine_classes:
+            frames = engine_class.frame_features(features)
+            accumulators[engine_class].update(frames[:, core_start - first_frame:core_stop - first_frame])
+
+    return {engine_class: engine_class.signature_from_statistics(accumulators[engine_class])
+            for engine_class in engine_classes}
+
+
+def extract_segments(segments, rate, engine_classes):
+    """
+    Extracts signatures from several windows of a track as if they were one excerpt. Engines that allow
+    streaming extraction pool the frames of all windows; the others extract from the windows joined end to end.
+    :param segments: List of sample arrays
+    :return: Dictionary {engine class: signature}
+    """
+    segments = [numpy.asarray(segment, dtype=numpy.float32) for segment in segments]
+    if len(segments) == 1:
+        return {engine_class: engine_class.extract_signature(segments[0], rate) for engine_class in engine_classes}
+
+    streamed = [engine_class for engine_class in engine_classes if engine_class.allows_streaming()]
+    accumulators = {engine_class: GaussianAccumulator() for engine_class in streamed}
+    for segment in segments:
+        features = engine_features.FeatureContext(segment, rate)
+        for engine_class in streamed:
+            accumulators[engine_class].update(engine_class.frame_features(features))
+
+    ret = {engine_class: engine_class.signature_from_statistics(accumulators[engine_class])
+           for engine_class in streamed}
+    joined = None
+    for engine_class in engine_classes:
+        if engine_class not in ret:
+            joined = numpy.concatenate(segments) if joined is None else joined
+            ret[engine_class] = engine_class.extract_signature(joined, rate)
+    return ret
+
+
+def _observed(blocks, callback):
+    for block in blocks:
+        callback(block)
+        yield block
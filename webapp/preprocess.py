@@ -1,13 +1,21 @@
 __author__ = 'dm'
 
+import argparse
 import glob
-import sys
+import multiprocessing
 
 import engine.engine as engine
-import librosa
+import engine.store as signature_store
+import engine.signature_file as signature_file
+import engine.streaming as streaming
+import engine.index as metric_index
+import engine.ann as ann
+import engine.neighbours as neighbours
 import numpy
 import os
 import util
+import util.audio as audio
+import util.playback as playback
 import db.database as database
 
 
@@ -25,62 +33,354 @@ def get_all_files_in_tree(dir_path):
     return glob.glob(os.path.join(dir_path, "**/*.*"))
 
 
-if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        print("Usage: python3 preprocess.py source_audioset engine_class")
-        exit()
+def source_state(filename):
+    stat = os.stat(filename)
+    return stat.st_mtime, stat.st_size
+
+
+def is_up_to_date(track_signature, filename, dest_dir):
+    if track_signature is None or not signature_store.signature_exists(track_signature.path):
+        return False
+    # A signature outside the engine's directory was saved by an engine version with another identifier
+    if not os.path.abspath(track_signature.path).startswith(os.path.abspath(dest_dir) + os.sep):
+        return False
+    return (track_signature.source_mtime, track_signature.source_size) == source_state(filename)
+
+
+def extract_file(job):
+    """
+    Decodes one audio file once and extracts its signature for every requested engine.
+    Runs in a worker process.
+    :param job: Tuple (filename, list of (engine class name, destination path or None), PCM cache directory or None,
+    path to write the playback WAV file to or None, whether to extract in blocks if all engines allow it,
+    (window duration, number of windows) to extract a preview from or None)
+    :return: Tuple (filename, source state, list of (engine class name, destination path, signature, error message
+    or None)). Signatures with a destination path are saved to it and not returned; the others are returned
+    for the caller to append to the engine's record file.
+    """
+    filename, targets, cache_dir, playback_path, stream, preview = job
+    if preview is not None:
+        return extract_file_preview(filename, targets, cache_dir, preview)
+    if stream and all(getattr(engine, engine_classname).allows_streaming() for engine_classname, dest_path in targets):
+        return extract_file_streaming(filename, targets, cache_dir, playback_path)
+
+    try:
+        state = source_state(filename)
+        data, rate = audio.load(filename, cache_dir=cache_dir)
+    except Exception as e:
+        return filename, None, [(engine_classname, dest_path, None, repr(e)) for engine_classname, dest_path in targets]
+
+    if playback_path is not None:
+        try:
+            playback.write_wav(playback_path, data, rate)
+        except Exception as e:
+            print("Failed to write playback file of " + filename + ": " + repr(e))
+
+    outputs = []
+    for engine_classname, dest_path in targets:
+        try:
+            sig = getattr(engine, engine_classname).extract_signature(data, rate)
+            if dest_path is not None:
+                util.mkdir_p(os.path.dirname(dest_path))
+                save_signature(sig, dest_path)
+                sig = None
+            outputs.append((engine_classname, dest_path, sig, None))
+        except Exception as e:
+            outputs.append((engine_classname, dest_path, None, repr(e)))
+
+    return filename, state, outputs
+
+
+def extract_file_streaming(filename, targets, cache_dir, playback_path):
+    """
+    Like extract_file, but reads the file in blocks and extracts the signatures in memory independent of its length.
+    """
+    engine_classes = [getattr(engine, engine_classname) for engine_classname, dest_path in targets]
+    try:
+        state = source_state(filename)
+        blocks = streaming.audio_blocks(filename, audio.DEFAULT_RATE, cache_dir)
+        if playback_path is not None:
+            with playback.WavWriter(playback_path, audio.DEFAULT_RATE) as writer:
+                signatures = streaming.extract_signatures(blocks, audio.DEFAULT_RATE, engine_classes,
+                                                          block_callback=writer.write)
+        else:
+            signatures = streaming.extract_signatures(blocks, audio.DEFAULT_RATE, engine_classes)
+    except Exception as e:
+        return filename, None, [(engine_classname, dest_path, None, repr(e)) for engine_classname, dest_path in targets]
+
+    outputs = []
+    for (engine_classname, dest_path), engine_class in zip(targets, engine_classes):
+        sig = signatures[engine_class]
+        if dest_path is not None:
+            util.mkdir_p(os.path.dirname(dest_path))
+            save_signature(sig, dest_path)
+            sig = None
+        outputs.append((engine_classname, dest_path, sig, None))
+
+    return filename, state, outputs
+
+
+def extract_file_preview(filename, targets, cache_dir, preview):
+    """
+    Like extract_file, but decodes only the windows of a preview and pools them into one signature per engine.
+    """
+    duration, n_segments = preview
+    engine_classes = [getattr(engine, engine_classname) for engine_classname, dest_path in targets]
+    try:
+        state = source_state(filename)
+        segments, rate = audio.load_segments(filename, cache_dir=cache_dir, duration=duration, n_segments=n_segments)
+        signatures = streaming.extract_segments(segments, rate, engine_classes)
+    except Exception as e:
+        return filename, None, [(engine_classname, dest_path, None, repr(e)) for engine_classname, dest_path in targets]
 
-    dir_name = os.path.join("data", "audio", sys.argv[1])
+    outputs = []
+    for (engine_classname, dest_path), engine_class in zip(targets, engine_classes):
+        sig = signatures[engine_class]
+        if dest_path is not None:
+            util.mkdir_p(os.path.dirname(dest_path))
+            save_signature(sig, dest_path)
+            sig = None
+        outputs.append((engine_classname, dest_path, sig, None))
 
-    engine_class = getattr(engine, sys.argv[2])
+    return filename, state, outputs
 
-    # Save the engine
-    engine_model = database.EngineModel.query.filter_by(clazz=sys.argv[2]).first()
-    if engine_model is None:
-        engine_model = database.EngineModel(sys.argv[2])
-        database.db.session.add(engine_model)
 
-    signatureset_identifier = engine_class.get_engine_identifier()
-    dest_dir = os.path.join("data", "signatures", sys.argv[1], signatureset_identifier)
+def write_records(dest_dir, pending, npz_path_for, float32=False):
+    """
+    Appends extracted signatures to the record file of an engine. Signatures that do not fit its records
+    are saved to .npz files instead.
+    :param pending: List of (track, signature, source state)
+    :param npz_path_for: Function returning the .npz destination path of a track
+    :return: List of (track, path the signature was saved to, source state)
+    """
+    path = signature_file.records_path(dest_dir)
+    try:
+        signature_file.append(dest_dir, [(track.id, sig) for track, sig, state in pending], float32)
+        return [(track, path, state) for track, sig, state in pending]
+    except ValueError:
+        pass
+
+    saved = []
+    for track, sig, state in pending:
+        try:
+            signature_file.append(dest_dir, [(track.id, sig)], float32)
+            saved.append((track, path, state))
+        except ValueError as e:
+            print("Saving signature of " + track.path + " to a separate file: " + str(e))
+            dest_path = npz_path_for(track)
+            util.mkdir_p(os.path.dirname(dest_path))
+            save_signature(sig, dest_path)
+            saved.append((track, dest_path, state))
+    return saved
+
+
+def preprocess(dataset_name, engine_classnames, workers=None, commit_every=50, force=False, cache_dir=None,
+               build_ann=False, float32=False, npz=False, playback_dir=None, stream=False, preview=None,
+               audio_dataset=None, n_neighbours=None):
+    """
+    :param float32: Store the signatures of new record files in single precision
+    :param npz: Save one .npz file per track instead of appending to the engine's record file
+    :param playback_dir: Directory to write missing playback files of the web application to, or None
+    :param stream: Extract in blocks of bounded memory when all engines of the run allow streaming extraction
+    :param preview: Tuple (window duration in seconds, number of windows) to extract cheaper signatures from
+    windows spread over every track instead of from whole tracks, or None
+    :param audio_dataset: Name of the directory in data/audio to read the tracks from, if it is not dataset_name,
+    e.g. to store a preview of a dataset as a dataset of its own
+    :param n_neighbours: Build or update the graph of this many most similar tracks of every track, or None
+    """
+    dir_name = os.path.join("data", "audio", audio_dataset or dataset_name)
+    if preview is not None and playback_dir is not None:
+        print("Not writing playback files for a preview, they are generated on demand")
+        playback_dir = None
+
+    # Batch commits must not expire the tracks, or every one of them would be reloaded on its next access
+    database.db.session().expire_on_commit = False
+
+    engine_models, dest_dirs = {}, {}
+    for engine_classname in engine_classnames:
+        engine_class = getattr(engine, engine_classname)
+
+        # Save the engine
+        engine_model = database.EngineModel.query.filter_by(clazz=engine_classname).first()
+        if engine_model is None:
+            engine_model = database.EngineModel(engine_classname)
+            database.db.session.add(engine_model)
+
+        engine_models[engine_classname] = engine_model
+        dest_dirs[engine_classname] = signature_store.signature_dir_for(dataset_name, engine_class)
+        util.mkdir_p(dest_dirs[engine_classname])
+
+    # Engines whose signatures are saved to .npz files by the workers
+    npz_engines = set(engine_classname for engine_classname in engine_classnames
+                      if npz or not getattr(engine, engine_classname).has_fixed_shape_signatures())
 
     # Save the dataset
-    dataset = database.Dataset.query.filter_by(name=sys.argv[1]).first()
+    dataset = database.Dataset.query.filter_by(name=dataset_name).first()
     if dataset is None:
-        dataset = database.Dataset(sys.argv[1])
+        dataset = database.Dataset(dataset_name)
         database.db.session.add(dataset)
 
     # Find audio files in tree
-    util.mkdir_p(dest_dir)
     print("Looking for audio files in " + dir_name)
     filenames = get_all_files_in_tree(dir_name)
     print("Found " + str(len(filenames)) + " audio files.")
-    i = 0
 
+    # Look up the existing tracks and signatures of the dataset at once
+    tracks = {track.path: track for track in database.AudioTrack.query.filter_by(dataset_name=dataset_name)}
+    signatures = {(s.engine_class, s.audio_track_id): s for s in database.TrackSignature.query
+                  .join(database.AudioTrack, database.TrackSignature.audio_track_id == database.AudioTrack.id)
+                  .filter(database.AudioTrack.dataset_name == dataset_name)
+                  .filter(database.TrackSignature.engine_class.in_(engine_classnames))}
+
+    # Save the new tracks
+    new_tracks = [database.AudioTrack(os.path.splitext(os.path.basename(filename))[0], filename, dataset)
+                  for filename in filenames if filename not in tracks]
+    database.db.session.add_all(new_tracks)
+    database.db.session.flush()
+    tracks.update((track.path, track) for track in new_tracks)
+
+    def npz_path_for(engine_classname, filename):
+        return os.path.join(dest_dirs[engine_classname], os.path.relpath(filename, dir_name))
+
+    jobs = []
     for filename in filenames:
-        # Save the track
-        track = database.AudioTrack.query.filter_by(path=filename).first()
-        if track is None:
-            track = database.AudioTrack(os.path.splitext(os.path.basename(filename))[0], filename, dataset)
-            database.db.session.add(track)
+        targets = []
+        for engine_classname in engine_classnames:
+            track_signature = signatures.get((engine_classname, tracks[filename].id))
+            if force or not is_up_to_date(track_signature, filename, dest_dirs[engine_classname]):
+                dest_path = npz_path_for(engine_classname, filename) if engine_classname in npz_engines else None
+                targets.append((engine_classname, dest_path))
 
-        data, rate = librosa.load(filename)
-        sig = engine_class.extract_signature(data, rate)
+        playback_path = None
+        if playback_dir is not None:
+            playback_path = os.path.join(playback_dir, playback.track_asset_name(tracks[filename].id))
+            if os.path.isfile(playback_path):
+                playback_path = None
 
-        rel_path = os.path.relpath(filename, dir_name)
-        dest_path = os.path.join(dest_dir, rel_path)
-        dest_parent = os.path.dirname(dest_path)
-        util.mkdir_p(dest_parent)
+        if len(targets) > 0 or playback_path is not None:
+            jobs.append((filename, targets, cache_dir, playback_path, stream, preview))
+
+    database.db.session.commit()
+    if playback_dir is not None:
+        util.mkdir_p(playback_dir)
+    print("Skipping " + str(len(filenames) - len(jobs)) + " unchanged files, processing " + str(len(jobs)) + ".")
 
-        print("Processing file " + filename + ", will save to " + dest_path)
-        save_signature(sig, dest_path)
+    pool = multiprocessing.Pool(workers) if workers != 1 else None
+    results = pool.imap_unordered(extract_file, jobs) if pool is not None else map(extract_file, jobs)
 
-        # Save the signature
-        track_signature = database.TrackSignature.query.filter_by(engine_model=engine_model, audio_track=track).first()
+    new_signatures = []
+    pending = {engine_classname: [] for engine_classname in engine_classnames}
+
+    def save_track_signature(engine_classname, track, path, state):
+        track_signature = signatures.get((engine_classname, track.id))
         if track_signature is None:
-            track_signature = database.TrackSignature(dest_path, engine_model, track)
-            database.db.session.add(track_signature)
+            track_signature = database.TrackSignature(path, engine_models[engine_classname], track)
+            signatures[(engine_classname, track.id)] = track_signature
+            new_signatures.append(track_signature)
+        track_signature.path = path
+        track_signature.source_mtime, track_signature.source_size = state
+
+    def commit():
+        # Signatures are written to the record files before the database refers to them
+        for engine_classname in engine_classnames:
+            saved = write_records(dest_dirs[engine_classname], pending[engine_classname],
+                                  lambda track: npz_path_for(engine_classname, track.path), float32)
+            for track, path, state in saved:
+                save_track_signature(engine_classname, track, path, state)
+            pending[engine_classname] = []
+
+        database.db.session.add_all(new_signatures)
+        database.db.session.commit()
+        del new_signatures[:]
 
+    i = 0
+    for filename, state, outputs in results:
         i += 1
-        print("Progress: " + str(i*100/len(filenames)) + "%")
+        track = tracks[filename]
+        for engine_classname, dest_path, sig, error in outputs:
+            if error is not None:
+                print("Failed to process file " + filename + " with " + engine_classname + ": " + error)
+                continue
 
-    database.db.session.commit()
+            if dest_path is None:
+                print("Processed file " + filename + " with " + engine_classname)
+                pending[engine_classname].append((track, sig, state))
+            else:
+                print("Processed file " + filename + " with " + engine_classname + ", saved to " + dest_path)
+                save_track_signature(engine_classname, track, dest_path, state)
+
+        if i % commit_every == 0:
+            commit()
+        print("Progress: " + str(i*100/len(jobs)) + "%")
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    commit()
+    for engine_classname in engine_classnames:
+        engine_class = getattr(engine, engine_classname)
+
+        n_dropped = signature_file.compact(dest_dirs[engine_classname])
+        if n_dropped > 0:
+            print("Dropped " + str(n_dropped) + " superseded signatures of " + engine_classname)
+        signature_store.invalidate(dataset_name, engine_class)
+
+        if engine_class.allows_metric_indexing():
+            print("Building metric index for " + engine_classname)
+            metric_index.build_index(dataset_name, engine_class)
+
+        if build_ann and engine_class.get_gaussian_keys() is not None:
+            print("Building approximate nearest-neighbour index for " + engine_classname)
+            if ann.build_index(dataset_name, engine_class) is None:
+                print("Too few signatures of " + engine_classname + " for an approximate nearest-neighbour index")
+
+        if n_neighbours is not None:
+            print("Updating neighbour graph for " + engine_classname)
+            neighbours.build_graph(dataset_name, engine_class, n_neighbours=n_neighbours, workers=workers)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Extracts signatures of a dataset in data/audio.")
+    parser.add_argument("source_audioset")
+    parser.add_argument("engine_class", nargs="+", help="One or more engine classes, each file is decoded once")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of extraction processes, defaults to the number of cores")
+    parser.add_argument("--commit-every", type=int, default=50,
+                        help="Number of processed files after which the database is committed")
+    parser.add_argument("--force", action="store_true", help="Reprocess files whose signature is up to date")
+    parser.add_argument("--pcm-cache", action="store_true",
+                        help="Keep decoded audio in " + audio.PCM_CACHE_DIR + " and reuse it in later runs")
+    parser.add_argument("--ann", action="store_true",
+                        help="Build an approximate nearest-neighbour index for engines with Gaussian signatures")
+    parser.add_argument("--float32", action="store_true",
+                        help="Store new signature record files in single precision, halving their size")
+    parser.add_argument("--npz", action="store_true",
+                        help="Save one .npz file per track instead of appending to the engine's record file")
+    parser.add_argument("--playback", action="store_true",
+                        help="Also write the playback files of the web application to " + playback.PLAYBACK_DIR)
+    parser.add_argument("--streaming", action="store_true",
+                        help="Extract in blocks, in memory independent of the length of the tracks; only for runs "
+                             "whose engines all allow it (MandelEllisEngine, SpectralContrastEngine, TempogramEngine)")
+    parser.add_argument("--preview", type=float, default=None, metavar="SECONDS",
+                        help="Extract preview signatures from windows of this length instead of whole tracks and "
+                             "store them as a dataset of their own")
+    parser.add_argument("--preview-segments", type=int, default=1,
+                        help="Number of preview windows spread over every track, pooled into one signature")
+    parser.add_argument("--preview-name", default=None,
+                        help="Name of the preview dataset, defaults to the source dataset's name followed by -preview")
+    parser.add_argument("--neighbours", type=int, default=None, metavar="K",
+                        help="Build or update the graph of the K most similar tracks of every track, served by "
+                             "/similar/<track_id>")
+    args = parser.parse_args()
+
+    database.upgrade()
+    if args.preview is not None:
+        preprocess(args.preview_name or args.source_audioset + "-preview", args.engine_class, args.workers,
+                   args.commit_every, args.force, audio.PCM_CACHE_DIR if args.pcm_cache else None, args.ann,
+                   args.float32, args.npz, None, False, (args.preview, args.preview_segments), args.source_audioset,
+                   args.neighbours)
+    else:
+        preprocess(args.source_audioset, args.engine_class, args.workers, args.commit_every, args.force,
+                   audio.PCM_CACHE_DIR if args.pcm_cache else None, args.ann, args.float32, args.npz,
+                   playback.PLAYBACK_DIR if args.playback else None, args.streaming, None, None, args.neighbours)
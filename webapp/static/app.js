@@ -17,9 +17,13 @@ $(document).ready(function () {
     myDropzone.on("success", function (file, response) {
         //console.log(file);
 
-        parseResults(response);
+        pollSearch(response["status_url"]);
 
     })
+    myDropzone.on("error", function (file, message, xhr) {
+        $('#dropzone').removeClass('processing')
+        $('#dropzone .user-info').text(xhr && xhr.status == 429 ? message["result"] : "The search failed.")
+    })
     myDropzone.on("sending", function(file, xhr, formData) {
         formData.append("dataset", $("#dataset").val())
         formData.append("engine", $("#engine").val())
@@ -83,6 +87,23 @@ function getAcceptedFiles() {
     return ".mp3,.wav";
 }
 
+function pollSearch(statusUrl) {
+    $.getJSON(statusUrl, function (job) {
+        if (job["status"] == "done") {
+            parseResults(job["result"]);
+        }
+        else if (job["status"] == "failed" || job["status"] == "cancelled") {
+            $('#dropzone').removeClass('processing')
+            $('#dropzone .user-info').text("The search " + job["status"] + ".")
+        }
+        else {
+            var stage = job["stage"] ? job["stage"] + " " + Math.round(job["progress"] * 100) + "%" : "queued";
+            $('#dropzone .user-info').text("Searching: " + stage)
+            setTimeout(function () { pollSearch(statusUrl) }, 500);
+        }
+    });
+}
+
 function parseResults(result) {
     var name, artist, url, rating, similarity, orig_file, orig_url;
     var results = result["results"]
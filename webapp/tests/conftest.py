@@ -0,0 +1,7 @@
+__author__ = 'dm'
+
+import os
+import sys
+
+# The modules of the webapp import each other from its directory, e.g. engine.engine and db.database
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
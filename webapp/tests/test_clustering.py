@@ -0,0 +1,57 @@
+__author__ = 'dm'
+
+import itertools
+
+import numpy
+import pytest
+
+import engine.clustering as clustering
+import engine.engine as engine
+
+
+def sum_of_squared_errors(values, labels):
+    return sum(numpy.sum((values[labels == label] - values[labels == label].mean()) ** 2)
+               for label in numpy.unique(labels))
+
+
+def brute_force_sse(values, n_clusters):
+    # Optimal 1-D clusters are runs of the sorted distinct values, so trying every split of them is exhaustive
+    unique = numpy.unique(values)
+    best = numpy.inf
+    for cuts in itertools.combinations(range(1, len(unique)), n_clusters - 1):
+        edges = unique[list(cuts)]
+        best = min(best, sum_of_squared_errors(values, numpy.searchsorted(edges, values, side='right')))
+    return best
+
+
+@pytest.mark.parametrize("seed", range(25))
+def test_optimal_1d_labels_match_brute_force(seed):
+    rng = numpy.random.RandomState(seed)
+    n_clusters = rng.randint(1, 5)
+    values = rng.randint(0, 12, size=rng.randint(n_clusters + 1, 20)).astype(float)  # Repeated values
+    if len(numpy.unique(values)) <= n_clusters:
+        values = numpy.append(values, numpy.arange(n_clusters + 1) + 100.0)
+
+    labels = clustering.optimal_1d_labels(values, n_clusters)
+
+    assert set(labels) == set(range(n_clusters))
+    assert sum_of_squared_errors(values, labels) == pytest.approx(brute_force_sse(values, n_clusters))
+    # Clusters are numbered in increasing order of their values
+    assert all(values[labels == m].max() < values[labels == m + 1].min() for m in range(n_clusters - 1))
+
+
+def test_optimal_1d_labels_with_fewer_distinct_values_than_clusters():
+    labels = clustering.optimal_1d_labels(numpy.array([3.0, 1.0, 3.0, 2.0]), 8)
+    numpy.testing.assert_array_equal(labels, [2, 0, 2, 1])
+
+
+def test_logan_signature_stays_finite_with_empty_clusters(monkeypatch):
+    data = numpy.random.RandomState(0).normal(size=22050 * 3) * 0.1
+    # Clusters 6 and 7 get no frame
+    monkeypatch.setattr(clustering, 'cluster_labels', lambda samples, n_clusters, backend: numpy.arange(len(samples)) % 6)
+
+    sig = engine.LoganEngine.extract_signature(data, 22050)
+
+    assert all(numpy.isfinite(value).all() for value in sig.values())
+    assert sig['weights'][6] == sig['weights'][7] == 0
+    assert numpy.isfinite(engine.LoganEngine.measure_similarity(sig, sig))
@@ -0,0 +1,83 @@
+__author__ = 'dm'
+
+import warnings
+
+import numpy
+import pytest
+import scipy.optimize
+
+import engine.distance as distance
+
+
+def linprog_transportation_cost(supply, demand, cost):
+    # Reference: the transportation problem as a linear program
+    m, n = cost.shape
+    rows = numpy.kron(numpy.eye(m), numpy.ones(n))
+    cols = numpy.kron(numpy.ones(m), numpy.eye(n))
+    result = scipy.optimize.linprog(cost.ravel(), A_eq=numpy.vstack([rows, cols]),
+                                    b_eq=numpy.concatenate([supply, demand]), bounds=(0, None), method="highs")
+    assert result.success
+    return result.fun
+
+
+def linprog_emd(hist1, hist2, distance_matrix):
+    # Reference: partial matching moving the smaller total weight, as defined by Rubner et al.
+    m, n = distance_matrix.shape
+    rows = numpy.kron(numpy.eye(m), numpy.ones(n))
+    cols = numpy.kron(numpy.ones(m), numpy.eye(n))
+    flow_sum = min(hist1.sum(), hist2.sum())
+    result = scipy.optimize.linprog(distance_matrix.ravel(), A_ub=numpy.vstack([rows, cols]),
+                                    b_ub=numpy.concatenate([hist1, hist2]), A_eq=numpy.ones((1, m * n)),
+                                    b_eq=[flow_sum], bounds=(0, None), method="highs")
+    assert result.success
+    return result.fun / flow_sum
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_transportation_cost_matches_linear_program(seed):
+    rng = numpy.random.RandomState(seed)
+    m, n = rng.randint(1, 9, size=2)
+    supply = rng.randint(0, 20, size=m).astype(float)
+    supply[0] += 1
+    demand = rng.multinomial(int(supply.sum()), numpy.ones(n) / n).astype(float)
+    cost = rng.randint(0, 5, size=(m, n)).astype(float)  # Small integer costs give many ties and degenerate bases
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        result = distance.transportation_cost(supply, demand, cost)
+
+    assert result == pytest.approx(linprog_transportation_cost(supply, demand, cost), abs=1e-9)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_earth_movers_distance_matches_linear_program(seed):
+    rng = numpy.random.RandomState(seed)
+    m, n = rng.randint(1, 9, size=2)
+    hist1 = rng.randint(1, 30, size=m).astype(float)
+    hist2 = rng.randint(1, 30, size=n).astype(float)
+    distance_matrix = numpy.abs(rng.normal(size=(m, 1)) - rng.normal(size=(1, n)))
+
+    assert distance.earth_movers_distance(hist1, hist2, distance_matrix) == \
+        pytest.approx(linprog_emd(hist1, hist2, distance_matrix), rel=1e-9, abs=1e-12)
+
+
+def test_earth_movers_distance_batch_matches_pairs():
+    rng = numpy.random.RandomState(0)
+    hist1 = rng.randint(1, 30, size=6).astype(float)
+    hists2 = rng.randint(1, 30, size=(5, 6)).astype(float)
+    distance_matrices = rng.uniform(size=(5, 6, 6))
+
+    expected = [distance.earth_movers_distance(hist1, hist2, matrix)
+                for hist2, matrix in zip(hists2, distance_matrices)]
+    numpy.testing.assert_allclose(distance.earth_movers_distance_batch(hist1, hists2, distance_matrices), expected)
+
+
+def test_transportation_cost_warns_at_iteration_cap():
+    supply = numpy.array([1.0, 1.0])
+    demand = numpy.array([1.0, 1.0])
+    cost = numpy.array([[1.0, 0.0], [0.0, 1.0]])  # The north-west corner flow is not optimal
+
+    with pytest.warns(RuntimeWarning):
+        result = distance.transportation_cost(supply, demand, cost, max_iterations=0)
+    assert result >= linprog_transportation_cost(supply, demand, cost)
+    assert distance.transportation_cost(supply, demand, cost) == pytest.approx(0)
@@ -0,0 +1,99 @@
+__author__ = 'dm'
+
+import numpy
+
+import engine.ann as ann
+import engine.engine as engine
+import engine.index as metric_index
+import engine.search as search
+import engine.store as signature_store
+
+
+class EuclideanEngine(engine.MetricEngine, engine.Engine):
+    # A metric distance, for which the index must find exactly what a scan finds
+    @classmethod
+    def extract_signature(cls, track_data, track_rate, features=None):
+        return {'x': track_data}
+
+    @classmethod
+    def measure_similarity(cls, sig1, sig2):
+        return float(cls.measure_similarity_batch(sig1, {'x': sig2['x'][None]})[0])
+
+    @classmethod
+    def measure_similarity_batch(cls, sig, signatures):
+        return 1 / (1 + cls.measure_distance_batch(sig, signatures))
+
+    @classmethod
+    def measure_distance_batch(cls, sig, signatures):
+        return numpy.sqrt(numpy.sum((signatures['x'] - sig['x']) ** 2, axis=1))
+
+    @classmethod
+    def get_engine_identifier(cls):
+        return "Euclidean_test"
+
+
+def make_store(arrays):
+    n = len(next(iter(arrays.values())))
+    return signature_store.SignatureStore(numpy.arange(n), numpy.arange(n), arrays)
+
+
+def gaussian_signatures(rng, n, d=4):
+    means = rng.normal(size=(n, d))
+    factors = rng.normal(size=(n, d, d)) * 0.3
+    covariances = numpy.einsum('nab,ncb->nac', factors, factors) + numpy.eye(d) * 0.1
+    return engine.MandelEllisEngine.prepare_signatures({'me_means': means, 'me_covariance': covariances})
+
+
+def index_search(engine_class, sig, store, index, n_tracks):
+    rows, distances, n_evaluations = index.search(engine_class, sig, store.arrays, n_tracks)
+    return search.rerank_candidates(engine_class, sig, store, rows, n_tracks)
+
+
+def test_index_matches_scan_for_a_metric():
+    rng = numpy.random.RandomState(0)
+    store = make_store({'x': rng.normal(size=(500, 3))})
+    index = metric_index.PivotIndex.build(EuclideanEngine, store, n_pivots=8)
+
+    for _ in range(20):
+        sig = {'x': rng.normal(size=3)}
+        exact = search.scan_greatest_similarity(EuclideanEngine, sig, store, 10)
+        found = index_search(EuclideanEngine, sig, store, index, 10)
+        assert [s.row for s in found] == [s.row for s in exact]
+        numpy.testing.assert_allclose([s.similarity_measure for s in found], [s.similarity_measure for s in exact])
+
+
+def test_index_scores_like_scan_for_divergences():
+    rng = numpy.random.RandomState(1)
+    store = make_store(gaussian_signatures(rng, 400))
+    index = metric_index.PivotIndex.build(engine.MandelEllisEngine, store, n_pivots=8)
+
+    recalls = []
+    for sig in (store.signature(row) for row in range(0, 400, 20)):
+        exact = {s.row: s.similarity_measure for s in search.scan_greatest_similarity(engine.MandelEllisEngine, sig,
+                                                                                         store, 10)}
+        found = index_search(engine.MandelEllisEngine, sig, store, index, 10)
+        # Rows both searches find have the same similarity, so they rank alike
+        for s in found:
+            if s.row in exact:
+                assert s.similarity_measure == exact[s.row]
+        recalls.append(search.shortlist_recall(list(exact), [s.row for s in found]))
+
+    # The divergence is not a metric, so the index misses some of the tracks a scan finds
+    assert numpy.mean(recalls) >= 0.7
+
+
+def test_only_metric_engines_allow_metric_indexing():
+    assert engine.MandelEllisEngine.allows_metric_indexing()
+    assert engine.SpectralContrastEngine.allows_metric_indexing()
+    assert not engine.ZeroCrossingEngine.allows_metric_indexing()
+    assert not hasattr(engine.ZeroCrossingEngine, 'measure_distance_batch')
+
+
+def test_ann_index_is_not_built_for_too_few_tracks(tmp_path, monkeypatch):
+    empty = make_store({'me_means': numpy.zeros((0, 4)), 'me_covariance': numpy.zeros((0, 4, 4))})
+    monkeypatch.setattr(signature_store, 'get_store', lambda *args: empty)
+    assert ann.build_index("test", engine.MandelEllisEngine, str(tmp_path)) is None
+
+    small = make_store(gaussian_signatures(numpy.random.RandomState(2), 5))
+    monkeypatch.setattr(signature_store, 'get_store', lambda *args: small)
+    assert ann.build_index("test", engine.MandelEllisEngine, str(tmp_path), n_lists=8) is None
@@ -0,0 +1,63 @@
+__author__ = 'dm'
+
+import os
+
+import numpy
+
+import engine.engine as engine
+import engine.neighbours as neighbours
+import engine.store as signature_store
+
+
+def gaussian_signatures(rng, n, d=4):
+    factors = rng.normal(size=(n, d, d)) * 0.3
+    return {'me_means': rng.normal(size=(n, d)),
+            'me_covariance': numpy.einsum('nab,ncb->nac', factors, factors) + numpy.eye(d) * 0.1}
+
+
+def make_store(track_ids, raw, stamp=None):
+    arrays = engine.MandelEllisEngine.prepare_signatures(dict(raw))
+    return signature_store.SignatureStore(numpy.asarray(track_ids) + 1000, numpy.asarray(track_ids), arrays, stamp)
+
+
+def test_update_matches_rebuild():
+    engine_class = engine.MandelEllisEngine
+    rng = numpy.random.RandomState(0)
+    raw = gaussian_signatures(rng, 80)
+    old_store = make_store(numpy.arange(80), raw)
+    graph = neighbours.NeighbourGraph.build(engine_class, old_store, n_neighbours=8)
+
+    # Remove a few tracks, change a few others and add new ones
+    kept = numpy.setdiff1d(numpy.arange(80), [5, 17, 42])
+    changed = gaussian_signatures(rng, 4)
+    added = gaussian_signatures(rng, 10)
+    new_raw = {key: raw[key][kept].copy() for key in raw}
+    for key in raw:
+        new_raw[key][[0, 20, 40, 60]] = changed[key]
+        new_raw[key] = numpy.concatenate([new_raw[key], added[key]])
+    new_store = make_store(numpy.concatenate([kept, numpy.arange(100, 110)]), new_raw)
+
+    updated = graph.update(engine_class, new_store)
+    rebuilt = neighbours.NeighbourGraph.build(engine_class, new_store, n_neighbours=8)
+
+    assert updated.n_neighbours == rebuilt.n_neighbours
+    for track_id in new_store.track_ids:
+        found, expected = updated.neighbours(track_id), rebuilt.neighbours(track_id)
+        assert [s for s, _ in found] == [s for s, _ in expected]
+        numpy.testing.assert_allclose([m for _, m in found], [m for _, m in expected])
+    assert updated.neighbours(17) is None
+
+
+def test_graph_is_stale_after_signatures_are_written(tmp_path):
+    engine_class = engine.MandelEllisEngine
+    signature_dir = str(tmp_path)
+    os.makedirs(signature_store.signature_dir_for("test", engine_class, signature_dir))
+
+    store = make_store(numpy.arange(20), gaussian_signatures(numpy.random.RandomState(1), 20),
+                       signature_store.read_stamp("test", engine_class, signature_dir))
+    neighbours.NeighbourGraph.build(engine_class, store, n_neighbours=5)\
+        .save(neighbours.graph_path_for("test", engine_class, signature_dir))
+    assert not neighbours.get_graph("test", engine_class, signature_dir).stale
+
+    signature_store.invalidate("test", engine_class, signature_dir)
+    assert neighbours.get_graph("test", engine_class, signature_dir).stale
@@ -0,0 +1,44 @@
+__author__ = 'dm'
+
+import os
+
+import numpy
+
+import engine.engine as engine
+import engine.parallel as parallel
+import engine.search as search
+import engine.store as signature_store
+
+
+def gaussian_store(seed, n=60, d=4):
+    rng = numpy.random.RandomState(seed)
+    factors = rng.normal(size=(n, d, d)) * 0.3
+    arrays = engine.MandelEllisEngine.prepare_signatures({
+        'me_means': rng.normal(size=(n, d)),
+        'me_covariance': numpy.einsum('nab,ncb->nac', factors, factors) + numpy.eye(d) * 0.1})
+    return signature_store.SignatureStore(numpy.arange(n), numpy.arange(n), arrays)
+
+
+def test_replaced_searcher_serves_its_users_until_released(tmp_path):
+    engine_class = engine.MandelEllisEngine
+    old_store, new_store = gaussian_store(0), gaussian_store(1)
+    sig = new_store.signature(3)
+
+    try:
+        with parallel.get_searcher("test", engine_class, old_store, str(tmp_path), 2) as old:
+            with parallel.get_searcher("test", engine_class, new_store, str(tmp_path), 2) as new:
+                assert new is not old
+                # The reloaded store replaced the searcher, but a search still using the old one can finish
+                rows, similarities = old.search(sig, 5)
+                exact = search.scan_greatest_similarity(engine_class, sig, old_store, 5)
+                assert list(rows) == [s.row for s in exact]
+                numpy.testing.assert_allclose(similarities, [s.similarity_measure for s in exact])
+            assert os.path.isdir(old.array_dir)
+        assert not os.path.isdir(old.array_dir)
+
+        with parallel.get_searcher("test", engine_class, new_store, str(tmp_path), 2) as searcher:
+            assert searcher is new
+            rows, similarities = searcher.search(sig, 5)
+            assert rows[0] == 3
+    finally:
+        parallel.close_searchers()
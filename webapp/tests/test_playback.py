@@ -0,0 +1,59 @@
+__author__ = 'dm'
+
+import os
+import threading
+
+import numpy
+import pytest
+
+import util.audio as audio
+import util.playback as playback
+
+
+def write_file(cache, name, size):
+    with open(cache.path_for(name), "wb") as f:
+        f.write(b"\0" * size)
+    os.utime(cache.path_for(name), (1000, 1000))
+
+
+def test_use_does_not_change_the_modification_time(tmp_path):
+    cache = playback.PlaybackCache(str(tmp_path), max_bytes=250)
+    write_file(cache, "a.wav", 100)
+    cache.touch("a.wav")
+    assert os.stat(cache.path_for("a.wav")).st_mtime == 1000
+
+
+def test_least_recently_used_files_are_evicted(tmp_path):
+    cache = playback.PlaybackCache(str(tmp_path), max_bytes=250)
+    for name in ("a.wav", "b.wav", "c.wav"):
+        write_file(cache, name, 100)
+    cache.touch("a.wav")
+    cache.touch("c.wav")
+
+    cache.evict()
+    assert sorted(os.listdir(str(tmp_path))) == ["a.wav", "c.wav"]
+
+
+def test_wait_raises_while_the_file_is_generated(tmp_path, monkeypatch):
+    cache = playback.PlaybackCache(str(tmp_path))
+    release = threading.Event()
+    monkeypatch.setattr(cache, 'generate', lambda name, source_path: release.wait())
+
+    cache.request("a.wav", "source.wav")
+    with pytest.raises(playback.NotReady):
+        cache.wait("a.wav", timeout=0.01)
+    release.set()
+    assert cache.wait("a.wav") is None
+
+
+def test_uploads_are_not_added_to_the_pcm_cache(tmp_path, monkeypatch):
+    pcm_dir = tmp_path / "pcm"
+    monkeypatch.setattr(audio, 'PCM_CACHE_DIR', str(pcm_dir))
+    source = str(tmp_path / "upload.wav")
+    playback.write_wav(source, numpy.sin(numpy.arange(22050) * 0.05) * 0.5, audio.DEFAULT_RATE)
+
+    cache = playback.PlaybackCache(str(tmp_path / "playback"))
+    path = cache.generate("upload-x.wav", source)
+
+    assert os.path.isfile(path)
+    assert not pcm_dir.exists()
@@ -0,0 +1,15 @@
+__author__ = 'dm'
+
+import numpy
+
+import engine.search as search
+
+
+def test_rank_normalize_ties_share_the_lowest_rank():
+    numpy.testing.assert_allclose(search.rank_normalize([0.5, 0.1, 0.5, 0.9]), [0.25, 0, 0.25, 0.75])
+
+
+def test_rank_normalize_ranks_nan_lowest():
+    ranks = search.rank_normalize([0.5, numpy.nan, 0.1, 0.9])
+    assert ranks[1] == 0
+    numpy.testing.assert_allclose(ranks[[2, 0, 3]], [0.25, 0.5, 0.75])
@@ -0,0 +1,77 @@
+__author__ = 'dm'
+
+import os
+
+import numpy
+import pytest
+
+import engine.signature_file as signature_file
+import engine.store as signature_store
+
+
+def signature(x):
+    return {'means': numpy.full(3, x), 'covariance': numpy.eye(3) * x}
+
+
+def test_latest_record_of_every_track_is_loaded(tmp_path):
+    dest_dir = str(tmp_path)
+    signature_file.append(dest_dir, [(1, signature(1.0)), (2, signature(2.0))])
+    signature_file.append(dest_dir, [(1, signature(3.0))])
+
+    records = signature_file.load(dest_dir)
+    track_ids, rows = signature_file.latest_rows(records)
+    assert list(track_ids) == [1, 2]
+    numpy.testing.assert_array_equal(records['means'][rows, 0], [3.0, 2.0])
+
+    assert signature_file.compact(dest_dir) == 1
+    records = signature_file.load(dest_dir)
+    numpy.testing.assert_array_equal(records['track_id'], [2, 1])
+
+
+def test_append_after_an_interrupted_append(tmp_path):
+    dest_dir = str(tmp_path)
+    signature_file.append(dest_dir, [(1, signature(1.0)), (2, signature(2.0))])
+    path = signature_file.records_path(dest_dir)
+    with open(path, "ab") as f:
+        f.write(b"\0" * 17)  # The beginning of a record whose append was interrupted
+
+    assert len(signature_file.load(dest_dir)) == 2
+    signature_file.append(dest_dir, [(3, signature(3.0))])
+
+    records = signature_file.load(dest_dir)
+    numpy.testing.assert_array_equal(records['track_id'], [1, 2, 3])
+    numpy.testing.assert_array_equal(records['covariance'][:, 1, 1], [1.0, 2.0, 3.0])
+    assert os.path.getsize(path) == 3 * records.dtype.itemsize
+
+
+def test_append_rejects_other_keys(tmp_path):
+    dest_dir = str(tmp_path)
+    signature_file.append(dest_dir, [(1, signature(1.0))])
+    with pytest.raises(ValueError):
+        signature_file.append(dest_dir, [(2, {'means': numpy.zeros(3)})])
+    with pytest.raises(ValueError):
+        signature_file.append(dest_dir, [(2, {'means': numpy.zeros(4), 'covariance': numpy.eye(3)})])
+
+
+def test_derived_fields_no_longer_stored_are_dropped(tmp_path):
+    dest_dir = str(tmp_path)
+    old = dict(signature(1.0), covariance_logdet=numpy.float64(0))
+    signature_file.append(dest_dir, [(1, old)], float32=True)
+    signature_file.append(dest_dir, [(2, signature(2.0))])
+
+    records = signature_file.load(dest_dir)
+    assert records.dtype.names == ('track_id', 'covariance', 'means')
+    assert records.dtype['means'].base == numpy.float32
+    numpy.testing.assert_array_equal(records['means'][:, 0], [1.0, 2.0])
+
+
+def test_load_arrays_follows_the_records_of_the_database(tmp_path):
+    dest_dir = str(tmp_path)
+    signature_file.append(dest_dir, [(5, signature(5.0)), (7, signature(7.0))])
+    path = signature_file.records_path(dest_dir)
+
+    arrays = signature_store.load_arrays([(1, 7, path), (2, 5, path)])
+    numpy.testing.assert_array_equal(arrays['means'][:, 0], [7.0, 5.0])
+
+    with pytest.raises(ValueError):
+        signature_store.load_arrays([(1, 7, path), (2, 6, path)])
@@ -0,0 +1,55 @@
+__author__ = 'dm'
+
+import numpy
+import pytest
+
+import engine.engine as engine
+import engine.streaming as streaming
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_accumulator_matches_numpy_statistics(seed):
+    rng = numpy.random.RandomState(seed)
+    frames = rng.normal(size=(6, 500)) * rng.uniform(0.1, 10, size=(6, 1)) + rng.normal(size=(6, 1)) * 100
+    cuts = numpy.sort(rng.choice(numpy.arange(1, 500), size=12, replace=False))
+
+    accumulator = streaming.GaussianAccumulator()
+    for block in numpy.split(frames, cuts, axis=1):
+        accumulator.update(block)
+    accumulator.update(frames[:, :0])
+
+    assert accumulator.n == 500
+    numpy.testing.assert_allclose(accumulator.mean, numpy.mean(frames, axis=1), rtol=1e-12)
+    numpy.testing.assert_allclose(accumulator.covariance(), numpy.cov(frames), rtol=1e-10)
+
+
+def synthetic_track(seconds=20, rate=22050):
+    # Tones that change every second over noise, without the near-silence the per-window decibel floor affects
+    rng = numpy.random.RandomState(0)
+    t = numpy.arange(seconds * rate) / rate
+    frequencies = rng.uniform(110, 880, size=seconds)[(t // 1).astype(int)]
+    return (0.3 * numpy.sin(2 * numpy.pi * numpy.cumsum(frequencies) / rate) +
+            0.05 * rng.normal(size=len(t))).astype(numpy.float32), rate
+
+
+@pytest.mark.parametrize("engine_class, rtol", [(engine.MandelEllisEngine, 1e-6),
+                                                (engine.SpectralContrastEngine, 1e-3),
+                                                (engine.TempogramEngine, 1e-3)])
+def test_streaming_extraction_matches_whole_track(engine_class, rtol):
+    data, rate = synthetic_track()
+    whole = engine_class.extract_signature(data, rate)
+
+    # Windows of 256 frames split the track into several of them
+    streamed = streaming.extract_signatures(streaming.array_blocks(data, 10000), rate, [engine_class],
+                                            block_frames=256)[engine_class]
+
+    assert sorted(streamed) == sorted(whole)
+    for key in whole:
+        scale = numpy.max(numpy.abs(whole[key]))
+        numpy.testing.assert_allclose(streamed[key], whole[key], rtol=0, atol=rtol * scale, err_msg=key)
+
+
+def test_only_streaming_engines_allow_streaming():
+    assert engine.MandelEllisEngine.allows_streaming()
+    assert not engine.ZeroCrossingEngine.allows_streaming()
+    assert not hasattr(engine.ZeroCrossingEngine, 'frame_features')
@@ -0,0 +1,107 @@
+__author__ = 'dm'
+
+import hashlib
+import os
+import librosa
+import numpy
+import util
+
+PCM_CACHE_DIR = os.path.join("data", "pcm")
+DEFAULT_RATE = 22050
+
+
+def pcm_cache_path(path, sr=DEFAULT_RATE, cache_dir=PCM_CACHE_DIR):
+    key = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, str(sr), key[:2], key + ".npy")
+
+
+def load(path, sr=DEFAULT_RATE, cache_dir=None, offset=0.0, duration=None):
+    """
+    Decodes an audio file like librosa.load, optionally through an on-disk cache of the decoded samples.
+    Cached samples are stored as float32 .npy files and returned memory-mapped; a cache entry older than
+    its source file is decoded again.
+    :param path: Path to the audio file
+    :param sr: Target sampling rate
+    :param cache_dir: Directory of the PCM cache, or None to always decode
+    :param offset: Start of the window to decode in seconds
+    :param duration: Length of the window to decode in seconds, or None to decode to the end. Only the window
+    is decoded; it is cut from the cached samples if the file is in the cache, but not added to it
+    :return: Tuple (samples, sampling rate)
+    """
+    windowed = offset > 0 or duration is not None
+    if cache_dir is None:
+        return librosa.load(path, sr=sr, offset=offset, duration=duration) if windowed else librosa.load(path, sr=sr)
+
+    cache_path = pcm_cache_path(path, sr, cache_dir)
+    if os.path.isfile(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        data = numpy.load(cache_path, mmap_mode='r')
+        return (slice_window(data, sr, offset, duration) if windowed else data), sr
+
+    if windowed:
+        return librosa.load(path, sr=sr, offset=offset, duration=duration)
+
+    data, rate = librosa.load(path, sr=sr)
+    util.mkdir_p(os.path.dirname(cache_path))
+    tmp_path = cache_path + "." + str(os.getpid()) + ".tmp.npy"
+    numpy.save(tmp_path, data.astype(numpy.float32))
+    os.replace(tmp_path, cache_path)
+
+    return data, rate
+
+
+def slice_window(data, sr, offset=0.0, duration=None):
+    start = int(round(offset * sr))
+    return data[start:] if duration is None else data[start:start + int(round(duration * sr))]
+
+
+def segment_windows(total_duration, duration, n_segments=1, offset=0.0):
+    """
+    Places windows of a query or preview in a track: n_segments windows of the given duration spread evenly
+    over the track from offset on, or a single window starting at offset.
+    :param total_duration: Length of the track in seconds, or None if it is unknown
+    :param duration: Length of every window in seconds, or None for the rest of the track
+    :return: List of (offset, duration) in seconds
+    """
+    if duration is None or n_segments <= 1 or total_duration is None:
+        return [(offset, duration)]
+
+    available = total_duration - offset
+    if available <= n_segments * duration:
+        # The windows would overlap, so the rest of the track is taken as a whole
+        return [(offset, None)]
+
+    # Centered in n_segments equal parts of the track, which avoids the very beginning and end
+    part = available / n_segments
+    return [(offset + part * (i + 0.5) - duration / 2, duration) for i in range(n_segments)]
+
+
+def get_duration(path, default=None):
+    """
+    Length of an audio file in seconds, read from its header where the format allows it.
+    :param default: Value returned if the file cannot be read
+    """
+    try:
+        return librosa.get_duration(path=path)
+    except Exception:
+        return default
+
+
+def load_segments(path, sr=DEFAULT_RATE, cache_dir=None, offset=0.0, duration=None, n_segments=1):
+    """
+    Decodes only the windows of an audio file placed by segment_windows.
+    :return: Tuple (list of sample arrays, sampling rate)
+    """
+    total_duration = get_duration(path) if duration is not None and n_segments > 1 else None
+    segments = []
+    for segment_offset, segment_duration in segment_windows(total_duration, duration, n_segments, offset):
+        data, sr = load(path, sr, cache_dir, segment_offset, segment_duration)
+        segments.append(data)
+    return segments, sr
+
+
+def slice_segments(data, sr, offset=0.0, duration=None, n_segments=1):
+    """
+    Like load_segments, for samples already in memory.
+    """
+    return [slice_window(data, sr, segment_offset, segment_duration) for segment_offset, segment_duration
+            in segment_windows(len(data) / float(sr), duration, n_segments, offset)]
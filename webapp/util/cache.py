@@ -0,0 +1,82 @@
+__author__ = 'dm'
+
+import collections
+import hashlib
+import sys
+import threading
+import numpy
+
+
+def content_hash(path, chunk_size=1 << 20):
+    """
+    SHA-1 of a file's contents.
+    """
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def size_of(value):
+    """
+    Rough number of bytes a cached value holds: the data of arrays, including those in dictionaries and sequences.
+    """
+    if isinstance(value, numpy.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(size_of(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(size_of(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """
+    Thread-safe cache evicting the least recently used entries once it holds more than max_entries entries
+    or more than max_bytes bytes as estimated by size_of.
+    """
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._entries = collections.OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        size = size_of(value)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.n_bytes -= old[1]
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+
+            self._entries[key] = (value, size)
+            self.n_bytes += size
+            while (self.max_entries is not None and len(self._entries) > self.max_entries) or \
+                    (self.max_bytes is not None and self.n_bytes > self.max_bytes):
+                evicted_key, (evicted, evicted_size) = self._entries.popitem(last=False)
+                self.n_bytes -= evicted_size
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.n_bytes -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.n_bytes = 0
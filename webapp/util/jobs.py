@@ -0,0 +1,136 @@
+__author__ = 'dm'
+
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+import uuid
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """
+    A unit of work run on a JobQueue. The work reports its progress through report(), which is also where
+    a requested cancellation takes effect.
+    """
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = QUEUED
+        self.stage = None
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.future = None
+        self._cancel_requested = threading.Event()
+
+    def report(self, stage, progress):
+        """
+        :param stage: Name of the stage the work is in, e.g. "extraction"
+        :param progress: Fraction of the stage done, from 0 to 1
+        :raise JobCancelled: If the job was cancelled
+        """
+        if self._cancel_requested.is_set():
+            raise JobCancelled()
+        self.stage = stage
+        self.progress = float(progress)
+
+    def to_dict(self):
+        ret = {"id": self.id, "status": self.status, "stage": self.stage, "progress": self.progress}
+        if self.status == DONE:
+            ret["result"] = self.result
+        elif self.status == FAILED:
+            ret["error"] = self.error
+        return ret
+
+
+class JobQueue:
+    """
+    Runs jobs on a bounded pool of threads. At most max_pending jobs may be queued or running at once;
+    the most recent max_finished finished jobs are kept for their results to be fetched.
+    """
+    def __init__(self, n_workers=2, max_pending=16, max_finished=256):
+        self.max_pending = max_pending
+        self.max_finished = max_finished
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=n_workers)
+        self._pending = {}
+        self._finished = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queues fn(job, *args, **kwargs); its return value becomes the job's result.
+        :return: The Job
+        :raise QueueFull: If max_pending jobs are already queued or running
+        """
+        job = Job()
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                raise QueueFull()
+            self._pending[job.id] = job
+            job.future = self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._pending.get(job_id) or self._finished.get(job_id)
+
+    def cancel(self, job_id):
+        """
+        Cancels a queued job at once and a running job at its next progress report.
+        :return: The Job, or None if there is no such job
+        """
+        job = self.get(job_id)
+        if job is None:
+            return None
+        job._cancel_requested.set()
+        if job.future.cancel():
+            self._finish(job, CANCELLED)
+        return job
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _run(self, job, fn, args, kwargs):
+        if job._cancel_requested.is_set():
+            self._finish(job, CANCELLED)
+            return
+
+        job.status = RUNNING
+        try:
+            job.result = fn(job, *args, **kwargs)
+            self._finish(job, DONE)
+        except JobCancelled:
+            self._finish(job, CANCELLED)
+        except Exception as e:
+            logger.exception("Job %s failed", job.id)
+            job.error = repr(e)
+            self._finish(job, FAILED)
+
+    def _finish(self, job, status):
+        with self._lock:
+            if self._pending.pop(job.id, None) is None:
+                return
+            job.status = status
+            job.finished = time.time()
+            self._finished[job.id] = job
+            while len(self._finished) > self.max_finished:
+                self._finished.popitem(last=False)
@@ -0,0 +1,84 @@
+__author__ = 'dm'
+
+import contextlib
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    key = _key(name, labels)
+    with _lock:
+        if key not in _histograms:
+            _histograms[key] = Histogram()
+        _histograms[key].observe(value)
+
+
+@contextlib.contextmanager
+def timed(stage, **labels):
+    """
+    Records the duration of the enclosed block in the stage_seconds histogram.
+    :param stage: Name of the stage, e.g. "decode"
+    :param labels: Further labels, e.g. engine and dataset
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("stage_seconds", time.perf_counter() - start, stage=stage, **labels)
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if len(items) == 0:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items) + "}"
+
+
+def render():
+    """
+    Renders all counters and histograms in the Prometheus text exposition format.
+    """
+    lines = []
+    with _lock:
+        for (name, labels), value in sorted(_counters.items()):
+            lines.append(name + _format_labels(labels) + " " + repr(value))
+
+        for (name, labels), histogram in sorted(_histograms.items(), key=lambda item: item[0]):
+            for bound, count in zip(histogram.buckets, histogram.bucket_counts):
+                lines.append(name + "_bucket" + _format_labels(labels, [("le", bound)]) + " " + str(count))
+            lines.append(name + "_bucket" + _format_labels(labels, [("le", "+Inf")]) + " " + str(histogram.count))
+            lines.append(name + "_sum" + _format_labels(labels) + " " + repr(histogram.sum))
+            lines.append(name + "_count" + _format_labels(labels) + " " + str(histogram.count))
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,181 @@
+__author__ = 'dm'
+
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+import wave
+import numpy
+import util
+import util.audio as audio
+import util.metrics as metrics
+
+PLAYBACK_DIR = os.path.join("data", "playback")
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+logger = logging.getLogger(__name__)
+
+
+class NotReady(Exception):
+    pass
+
+
+def track_asset_name(track_id):
+    return "track-" + str(track_id) + ".wav"
+
+
+def upload_asset_name(content_hash):
+    return "upload-" + content_hash + ".wav"
+
+
+class WavWriter:
+    """
+    Writes mono samples in [-1, 1] block by block to a 16-bit PCM WAV file, which replaces the file at path
+    once the writer is closed without an error.
+    """
+    def __init__(self, path, rate):
+        self.path = path
+        self.tmp_path = path + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp"
+        self._file = wave.open(self.tmp_path, "wb")
+        self._file.setnchannels(1)
+        self._file.setsampwidth(2)
+        self._file.setframerate(int(rate))
+
+    def write(self, data):
+        self._file.writeframes((numpy.clip(numpy.asarray(data), -1, 1) * 32767).astype('<i2').tobytes())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._file.close()
+        if exc_type is None:
+            os.replace(self.tmp_path, self.path)
+        else:
+            os.remove(self.tmp_path)
+
+
+def write_wav(path, data, rate):
+    """
+    Writes mono samples in [-1, 1] as a 16-bit PCM WAV file, replacing the file atomically.
+    """
+    with WavWriter(path, rate) as writer:
+        writer.write(data)
+
+
+class PlaybackCache:
+    """
+    Directory of playback WAV files generated in the background and evicted, least recently used first,
+    once they take more than max_bytes. The times of use are kept in memory, falling back to the time a file
+    was written, so that the modification time the HTTP validators derive from changes only with the contents.
+    """
+    def __init__(self, directory=PLAYBACK_DIR, max_bytes=DEFAULT_MAX_BYTES, n_workers=1):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=n_workers)
+        self._in_flight = {}
+        self._last_used = {}
+        self._lock = threading.Lock()
+        util.mkdir_p(directory)
+
+    def path_for(self, name):
+        return os.path.join(self.directory, name)
+
+    def request(self, name, source_path, remove_source=False):
+        """
+        Schedules the generation of a playback file unless it exists or is being generated.
+        :param remove_source: Delete the source file once it was converted, e.g. for uploads
+        :return: True if the file is ready
+        """
+        if os.path.isfile(self.path_for(name)):
+            if remove_source:
+                _remove_upload(source_path)
+            return True
+
+        with self._lock:
+            if name not in self._in_flight:
+                self._in_flight[name] = self._executor.submit(self._generate_scheduled, name, source_path,
+                                                              remove_source)
+        return False
+
+    def wait(self, name, timeout=60):
+        """
+        :return: Path of the playback file once it is ready, or None if it neither exists nor is being generated
+        :raise NotReady: If the file is still being generated after timeout seconds
+        """
+        with self._lock:
+            future = self._in_flight.get(name)
+        if future is not None:
+            try:
+                future.result(timeout)
+            except concurrent.futures.TimeoutError:
+                raise NotReady(name)
+
+        path = self.path_for(name)
+        return path if os.path.isfile(path) else None
+
+    def generate(self, name, source_path, data=None, rate=None):
+        """
+        Writes the playback file of a source file, decoding it unless its samples are given. The decoded samples
+        of the PCM cache are used if preprocess.py stored them, but playback adds nothing to it.
+        :return: Path of the playback file
+        """
+        path = self.path_for(name)
+        if data is None:
+            cached = os.path.isfile(audio.pcm_cache_path(source_path, audio.DEFAULT_RATE, audio.PCM_CACHE_DIR))
+            with metrics.timed("transcode"):
+                data, rate = audio.load(source_path, cache_dir=audio.PCM_CACHE_DIR if cached else None)
+        write_wav(path, data, rate)
+        self.evict()
+        return path
+
+    def touch(self, name):
+        with self._lock:
+            self._last_used[name] = time.time()
+
+    def evict(self):
+        """
+        Deletes the least recently used playback files until the rest fit max_bytes.
+        """
+        with self._lock:
+            last_used = dict(self._last_used)
+
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".wav"):
+                stat = entry.stat()
+                entries.append((max(stat.st_mtime, last_used.get(entry.name, 0)), stat.st_size, entry.name))
+
+        total = sum(size for used, size, name in entries)
+        for used, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(self.path_for(name))
+                total -= size
+                metrics.increment("playback_evictions_total")
+            except OSError:
+                pass
+            with self._lock:
+                self._last_used.pop(name, None)
+
+    def _generate_scheduled(self, name, source_path, remove_source):
+        try:
+            self.generate(name, source_path)
+            if remove_source:
+                _remove_upload(source_path)
+        except Exception:
+            logger.exception("Failed to generate playback file %s from %s", name, source_path)
+        finally:
+            with self._lock:
+                self._in_flight.pop(name, None)
+
+
+def _remove_upload(path):
+    # Uploads live in a directory of their own, which is removed with them
+    try:
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        pass
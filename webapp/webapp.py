@@ -1,10 +1,23 @@
 from flask import Flask
-from flask import render_template, request, jsonify, send_file
+from flask import render_template, request, jsonify, Response, url_for, abort
 import werkzeug.utils
+import argparse
+import logging
+import email.utils
 import os
+import re
+import shutil
+import threading
+import uuid
 import engine.search as srch
-import librosa
+import engine.neighbours as neighbours
+import engine.batch as batch
 import util
+import util.audio as audio
+import util.cache as cache
+import util.jobs as jobs
+import util.playback as playback
+import util.metrics as metrics
 import engine.engine as engine
 import db.database as db
 
@@ -14,6 +27,41 @@ ALLOWED_UPLOAD_EXTENSIONS = {'mp3', 'wav', 'au'}
 DEFAULT_DATASET = "genres"
 DEFAULT_ENGINE = "BeatEngine"
 UPLOAD_FOLDER = "uploaded"
+DEFAULT_SEARCH_THREADS = 2
+DEFAULT_MAX_PENDING_SEARCHES = 16
+MAX_BATCH_QUERIES = 1000
+MAX_QUERY_SEGMENTS = 16
+
+logger = logging.getLogger(__name__)
+
+_search_jobs = None
+_playback_cache = None
+_workers_lock = threading.Lock()
+
+
+def search_jobs():
+    """
+    The queue search and batch jobs run on, created on first use from the configuration
+    (SEARCH_THREADS, MAX_PENDING_SEARCHES).
+    """
+    global _search_jobs
+    with _workers_lock:
+        if _search_jobs is None:
+            _search_jobs = jobs.JobQueue(app.config.get('SEARCH_THREADS', DEFAULT_SEARCH_THREADS),
+                                         app.config.get('MAX_PENDING_SEARCHES', DEFAULT_MAX_PENDING_SEARCHES))
+        return _search_jobs
+
+
+def playback_cache():
+    """
+    The cache of playback files, created on first use from the configuration (PLAYBACK_CACHE_BYTES).
+    """
+    global _playback_cache
+    with _workers_lock:
+        if _playback_cache is None:
+            _playback_cache = playback.PlaybackCache(
+                max_bytes=app.config.get('PLAYBACK_CACHE_BYTES', playback.DEFAULT_MAX_BYTES))
+        return _playback_cache
 
 
 @app.route('/')
@@ -29,49 +77,363 @@ def search():
         file = request.files['file']
 
         if file and allowed_file(file.filename):
+            if len(search_jobs()) >= search_jobs().max_pending:
+                return too_many_searches()
+
+            try:
+                engine_classname, dataset = search_target(request.form)
+                window = query_window(request.form)
+            except ValueError as e:
+                response = jsonify(result="Invalid search: " + str(e))
+                response.status_code = 400
+                return response
+
+            # Every upload gets its own directory, so that concurrent uploads of equally named files do not collide
             sec_filename = werkzeug.utils.secure_filename(file.filename)
-            path = os.path.join(UPLOAD_FOLDER, sec_filename)
-            util.mkdir_p(UPLOAD_FOLDER)
-            file.save(path)
-            search_result_list = search_results(path, engine=request.form['engine'],
-                                                      dataset=request.form['dataset'])
-            return jsonify(process_search_results(search_result_list, sec_filename))
+            uploaded_file = os.path.join(uuid.uuid4().hex, sec_filename)
+            path = os.path.join(UPLOAD_FOLDER, uploaded_file)
+            util.mkdir_p(os.path.dirname(path))
+            with metrics.timed("upload_save", engine=engine_classname, dataset=dataset):
+                file.save(path)
+
+            if window[0] > 0 and window[0] >= audio.get_duration(path, default=float('inf')):
+                shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+                response = jsonify(result="Invalid search: offset is past the end of the upload")
+                response.status_code = 400
+                return response
+
+            try:
+                job = search_jobs().submit(run_search, path, uploaded_file, sec_filename,
+                                           engine=engine_classname, dataset=dataset, window=window)
+            except jobs.QueueFull:
+                shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+                return too_many_searches()
+            metrics.increment("search_jobs_total")
+
+            response = jsonify(job_id=job.id, status_url=url_for('get_search', job_id=job.id))
+            response.status_code = 202
+            return response
         else:
             return jsonify(result="You nit.")
 
 
-@app.route('/play/data/wav/<path:path>')
-def get_audio(path):
-    return send_file(os.path.join('data', 'wav', path))
+@app.route('/batch', methods=['POST'])
+def batch_search():
+    """
+    Searches with many queries at once: uploaded files (form field file, repeated) and tracks of the dataset
+    (form field track_ids, comma-separated), with the fields of /search and n for the number of results per query.
+    Runs as a job like /search; its result lists the results of every query and their mean precision@n
+    against the folders of the dataset.
+    """
+    files = [f for f in request.files.getlist('file') if f and allowed_file(f.filename)]
+    try:
+        track_ids = [int(track_id) for track_id in request.form.get('track_ids', '').split(',') if track_id.strip()]
+        engine_classname, dataset = search_target(request.form)
+        window = query_window(request.form)
+        n_tracks = int(request.form.get('n') or 10)
+        if n_tracks < 1:
+            raise ValueError("n must be at least 1")
+    except ValueError as e:
+        response = jsonify(result="Invalid batch: " + str(e))
+        response.status_code = 400
+        return response
 
+    if len(files) + len(track_ids) == 0 or len(files) + len(track_ids) > MAX_BATCH_QUERIES:
+        response = jsonify(result="A batch takes from 1 to " + str(MAX_BATCH_QUERIES) + " queries.")
+        response.status_code = 400
+        return response
+    if len(search_jobs()) >= search_jobs().max_pending:
+        return too_many_searches()
 
-@app.route('/play/uploaded/<path:path>')
-def get_uploaded_audio(path):
-    return send_file(os.path.join('uploaded', path))
+    upload_dir = os.path.join(UPLOAD_FOLDER, uuid.uuid4().hex)
+    util.mkdir_p(upload_dir)
+    paths, names = [], {}
+    for i, file in enumerate(files):
+        path = os.path.join(upload_dir, str(i) + "_" + werkzeug.utils.secure_filename(file.filename))
+        file.save(path)
+        paths.append(path)
+        names[path] = file.filename
 
+    try:
+        job = search_jobs().submit(run_batch, upload_dir, paths + track_ids, names, engine=engine_classname,
+                                   dataset=dataset, n_tracks=n_tracks, window=window)
+    except jobs.QueueFull:
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        return too_many_searches()
+    metrics.increment("batch_jobs_total")
 
-def process_search_results(results, uploaded_file):
-    for result in results:
-        print(result)
+    response = jsonify(job_id=job.id, status_url=url_for('get_search', job_id=job.id))
+    response.status_code = 202
+    return response
+
+
+@app.route('/search/<job_id>', methods=['GET'])
+def get_search(job_id):
+    job = search_jobs().get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.to_dict())
+
+
+@app.route('/search/<job_id>', methods=['DELETE'])
+def cancel_search(job_id):
+    job = search_jobs().cancel(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.to_dict())
+
+
+def too_many_searches():
+    metrics.increment("search_jobs_rejected_total")
+    response = jsonify(result="Too many searches in progress, try again later.")
+    response.status_code = 429
+    response.headers['Retry-After'] = '5'
+    return response
+
+
+def search_target(form):
+    """
+    Reads the engine and the dataset to search from the form fields engine and dataset. Only engines of
+    engine.engine and datasets of the database are accepted, which also bounds the labels of the search's metrics.
+    :return: Tuple (engine class name, dataset name)
+    :raise ValueError: If there is no such engine or dataset
+    """
+    engine_classname = form.get('engine', DEFAULT_ENGINE)
+    dataset = form.get('dataset', DEFAULT_DATASET)
+    engine_class = getattr(engine, engine_classname, None)
+    if not isinstance(engine_class, type) or not issubclass(engine_class, engine.Engine):
+        raise ValueError("unknown engine " + engine_classname)
+    if db.Dataset.query.get(dataset) is None:
+        raise ValueError("unknown dataset " + dataset)
+    return engine_classname, dataset
+
+
+def query_window(form):
+    """
+    Reads the part of an upload to search with from the optional form fields offset and duration (in seconds),
+    segments (number of windows of the duration spread over the upload, at most MAX_QUERY_SEGMENTS) and sr
+    (sampling rate to decode at, which must be the rate the datasets were extracted at, or the signatures would not
+    be comparable). Missing fields default to the application's configuration.
+    :return: Tuple (offset, duration or None, number of segments, sampling rate)
+    :raise ValueError: If a field is not a valid number
+    """
+    offset = float(form.get('offset') or 0)
+    duration = form.get('duration') or app.config.get('QUERY_DURATION')
+    duration = float(duration) if duration is not None else None
+    n_segments = int(form.get('segments') or app.config.get('QUERY_SEGMENTS') or 1)
+    sr = int(form.get('sr') or audio.DEFAULT_RATE)
+    if offset < 0 or (duration is not None and duration <= 0) or not 1 <= n_segments <= MAX_QUERY_SEGMENTS:
+        raise ValueError("offset must not be negative, duration must be positive and segments from 1 to " +
+                         str(MAX_QUERY_SEGMENTS))
+    if sr != audio.DEFAULT_RATE:
+        raise ValueError("sr must be " + str(audio.DEFAULT_RATE) + ", the sampling rate of the datasets' signatures")
+    return offset, duration, n_segments, sr
+
+
+def run_search(job, path, uploaded_file, original_name, dataset=DEFAULT_DATASET, engine=DEFAULT_ENGINE, window=None):
+    """
+    Runs a search job on a worker thread of search_jobs.
+    """
+    with app.app_context():
+        query_key = cache.content_hash(path)
+        search_result_list = search_results(path, dataset, engine, progress=job.report, query_key=query_key,
+                                            window=window)
+        return process_search_results(search_result_list, uploaded_file, original_name, query_key)
+
+
+def run_batch(job, upload_dir, queries, names, dataset=DEFAULT_DATASET, engine=DEFAULT_ENGINE, n_tracks=10,
+              window=None):
+    """
+    Runs a batch job on a worker thread of search_jobs; the uploaded queries are deleted afterwards.
+    """
+    with app.app_context():
+        try:
+            ret, precisions = [], []
+            labels = {'engine': engine, 'dataset': dataset}
+            for entry in batch.batch_search(queries, engine, dataset, n_tracks=n_tracks, window=window,
+                                            workers=app.config.get('SEARCH_WORKERS'), progress=job.report):
+                query = names.get(entry["query"], entry["query"])
+                if entry["error"] is not None:
+                    ret.append({"query": query, "error": entry["error"]})
+                    continue
+
+                ranked = [(int(signature_id), float(similarity))
+                          for signature_id, similarity in zip(entry["signature_ids"], entry["similarities"])]
+                ret.append({"query": query, "precision": entry["precision"],
+                            "results": result_entries(srch.fetch_results(ranked, labels), with_audio=False)})
+                if entry["precision"] is not None:
+                    precisions.append(entry["precision"])
 
-    h, ret = [], {}
+            precision = sum(precisions) / len(precisions) if len(precisions) > 0 else None
+            return {"queries": ret, "precision": precision}
+        finally:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+
+
+@app.route('/similar/<int:track_id>', methods=['GET'])
+def similar(track_id):
+    """
+    The tracks most similar to a catalog track, looked up in the neighbour graph preprocess.py built.
+    Query parameters: engine (defaults to DEFAULT_ENGINE) and n (number of tracks, 10 by default, at most the
+    number the graph was built with). stale is true when signatures were extracted after the graph was built.
+    """
+    engine_classname = request.args.get('engine', DEFAULT_ENGINE)
+    engine_class = getattr(engine, engine_classname, None)
+    track = db.AudioTrack.query.get(track_id)
+    if track is None or not isinstance(engine_class, type) or not issubclass(engine_class, engine.Engine):
+        abort(404)
+
+    graph = neighbours.get_graph(track.dataset_name, engine_class)
+    if graph is None:
+        abort(404)
+    n = request.args.get('n', 10, type=int)
+    if n is None or not 1 <= n <= graph.n_neighbours:
+        response = jsonify(result="n must be from 1 to " + str(graph.n_neighbours) + ".")
+        response.status_code = 400
+        return response
+    ranked = graph.neighbours(track_id, n)
+    if ranked is None:
+        abort(404)
+    if graph.stale:
+        logger.warning("Neighbour graph of %s by %s is older than its signatures, run preprocess.py with --neighbours",
+                       track.dataset_name, engine_classname)
+
+    metrics.increment("similar_requests_total", engine=engine_classname, dataset=track.dataset_name)
+    results = srch.fetch_results(ranked, {'engine': engine_classname, 'dataset': track.dataset_name})
+    return jsonify(track=track.name, audio_url=audio_url_for_file(track), stale=graph.stale,
+                   results=result_entries(results))
+
+
+@app.route('/metrics')
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain')
+
+
+@app.route('/play/<name>')
+def get_audio(name):
+    try:
+        path = playback_cache().wait(name)
+        if path is None:
+            # Playback files of dataset tracks can be generated again after they were evicted
+            match = re.match(r'^track-(\d+)\.wav$', name)
+            track = db.AudioTrack.query.get(int(match.group(1))) if match else None
+            if track is None:
+                abort(404)
+            playback_cache().request(name, track.path)
+            path = playback_cache().wait(name)
+            if path is None:
+                abort(404)
+    except playback.NotReady:
+        response = jsonify(result="The audio is still being converted, try again later.")
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+
+    playback_cache().touch(name)
+    return send_audio(path)
+
+
+def send_audio(path, chunk_size=64 * 1024):
+    """
+    Serves a file with support for conditional GET (ETag, Last-Modified) and single byte ranges.
+    """
+    stat = os.stat(path)
+    etag = '"%x-%x"' % (int(stat.st_mtime), stat.st_size)
+    last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+
+    if_none_match = request.headers.get('If-None-Match')
+    if_modified_since = email.utils.parsedate_tz(request.headers.get('If-Modified-Since') or '')
+    if (if_none_match is not None and etag in [t.strip() for t in if_none_match.split(',')]) or \
+            (if_none_match is None and if_modified_since is not None and
+             int(stat.st_mtime) <= email.utils.mktime_tz(if_modified_since)):
+        response = Response(status=304)
+        response.headers['ETag'] = etag
+        return response
+
+    start, end, status = 0, stat.st_size - 1, 200
+    range_match = re.match(r'^bytes=(\d*)-(\d*)$', request.headers.get('Range', '').strip())
+    if range_match and (range_match.group(1) or range_match.group(2)) and \
+            request.headers.get('If-Range', etag) in (etag, last_modified):
+        if range_match.group(1):
+            start = int(range_match.group(1))
+            if range_match.group(2):
+                end = min(int(range_match.group(2)), end)
+        else:
+            start = max(stat.st_size - int(range_match.group(2)), 0)
+        if start > end:
+            response = Response(status=416)
+            response.headers['Content-Range'] = 'bytes */' + str(stat.st_size)
+            return response
+        status = 206
+
+    def stream():
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    response = Response(stream(), status=status, mimetype='audio/wav', direct_passthrough=True)
+    response.headers['Content-Length'] = str(end - start + 1)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['ETag'] = etag
+    response.headers['Last-Modified'] = last_modified
+    if status == 206:
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, stat.st_size)
+    return response
+
+
+def process_search_results(results, uploaded_file, original_name=None, query_key=None):
+    if logger.isEnabledFor(logging.DEBUG):
+        for result in results:
+            logger.debug("%s", result)
+
+    ret = {}
+    ret['original_file'] = original_name or uploaded_file
+    ret['original_audio_url'] = audio_url_for_upload(uploaded_file, query_key)
+    ret['results'] = result_entries(results)
+    return ret
+
+
+def result_entries(results, with_audio=True):
+    """
+    :param with_audio: Link the playback files of the tracks, which schedules the generation of missing ones
+    """
+    h = []
     for result in results:
-        h.append({
+        entry = {
             "signature_file": result["signature"].path,
+            "track_id": result["signature"].audio_track.id,
             "name": result["signature"].audio_track.name,
-            "similarity": "{0:.4f}".format(result["absolute_similarity"]),
-            "audio_url": audio_url_for_file(result["signature"].audio_track)
-        })
+            "similarity": "{0:.4f}".format(result["absolute_similarity"])
+        }
+        if with_audio:
+            entry["audio_url"] = audio_url_for_file(result["signature"].audio_track)
+        h.append(entry)
+    return h
 
-    ret['original_file'] = uploaded_file
-    ret['original_audio_url'] = audio_url_for_file(uploaded_file, uploaded=True)
-    ret['results'] = h
-    return ret
 
+def search_results(path, dataset=DEFAULT_DATASET, engine=DEFAULT_ENGINE, progress=None, query_key=None, window=None):
+    """
+    :param window: Tuple (offset, duration, number of segments, sampling rate) as returned by query_window;
+    None decodes the whole upload at the default rate
+    """
+    offset, duration, n_segments, sr = window or (0.0, None, 1, audio.DEFAULT_RATE)
 
-def search_results(path, dataset=DEFAULT_DATASET, engine=DEFAULT_ENGINE):
-    (data, rate) = librosa.load(path)
-    return srch.search_greatest_similarity(data, rate, engine, dataset)
+    def decode():
+        # Only the windows searched with are decoded
+        with metrics.timed("decode", engine=engine, dataset=dataset):
+            segments, rate = audio.load_segments(path, sr, offset=offset, duration=duration, n_segments=n_segments)
+        return (segments if len(segments) > 1 else segments[0]), rate
+
+    return srch.search_cached(decode, query_key or cache.content_hash(path), engine, dataset, progress=progress,
+                              query_window=window, workers=app.config.get('SEARCH_WORKERS'),
+                              ann_candidates=app.config.get('ANN_CANDIDATES'),
+                              use_index=app.config.get('USE_METRIC_INDEX', False))
 
 
 def allowed_file(filename):
@@ -79,22 +441,56 @@ def allowed_file(filename):
            filename.rsplit('.', 1)[1] in ALLOWED_UPLOAD_EXTENSIONS
 
 
-def audio_url_for_file(audio_track, uploaded=False):
-
-    if uploaded:
-        wav_path = os.path.join(UPLOAD_FOLDER, audio_track)
-    else:
-        util.mkdir_p(os.path.join('data', 'wav'))
-        wav_path = os.path.join('data', 'wav', str(audio_track.id) + ".wav")
+def audio_url_for_file(audio_track):
+    # The playback file is generated in the background; /play waits for it if it is requested earlier
+    name = playback.track_asset_name(audio_track.id)
+    playback_cache().request(name, audio_track.path)
+    return os.path.join('play', name)
 
-    if not os.path.isfile(wav_path):
-        data, rate = librosa.load(audio_track.path)
-        librosa.output.write_wav(wav_path, data, rate)
 
-    return os.path.join('play', wav_path)
+def audio_url_for_upload(uploaded_file, query_key=None):
+    # The upload itself is deleted once its playback file was generated
+    path = os.path.join(UPLOAD_FOLDER, uploaded_file)
+    name = playback.upload_asset_name(query_key or cache.content_hash(path))
+    playback_cache().request(name, path, remove_source=True)
+    return os.path.join('play', name)
 
 
 
 if __name__ == '__main__':
-    app.run(port=8000, debug=True)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--verbose", action="store_true", help="Log the similarity of every track on every search")
+    parser.add_argument("--search-workers", type=int, default=None,
+                        help="Number of processes each search is sharded across")
+    parser.add_argument("--ann-candidates", type=int, default=None,
+                        help="Rerank this many candidates from the approximate nearest-neighbour index, if one was built")
+    parser.add_argument("--metric-index", action="store_true",
+                        help="Search through the metric index of the Gaussian engines, if one was built; faster, but "
+                             "may miss tracks a full scan finds")
+    parser.add_argument("--search-threads", type=int, default=DEFAULT_SEARCH_THREADS,
+                        help="Number of searches run at the same time")
+    parser.add_argument("--max-pending-searches", type=int, default=DEFAULT_MAX_PENDING_SEARCHES,
+                        help="Number of running and queued searches beyond which uploads are rejected")
+    parser.add_argument("--playback-cache-mb", type=int, default=playback.DEFAULT_MAX_BYTES // 1024 ** 2,
+                        help="Size of the playback files in " + playback.PLAYBACK_DIR + " beyond which the least "
+                             "recently played ones are deleted")
+    parser.add_argument("--query-duration", type=float, default=None,
+                        help="Search with this many seconds of an upload unless the request gives a duration; "
+                             "defaults to the whole upload")
+    parser.add_argument("--query-segments", type=int, default=1,
+                        help="Number of windows of the query duration spread over an upload and pooled into one "
+                             "query, unless the request gives a number of segments")
+    args = parser.parse_args()
+
+    db.upgrade()
+    app.config['SEARCH_WORKERS'] = args.search_workers
+    app.config['SEARCH_THREADS'] = args.search_threads
+    app.config['MAX_PENDING_SEARCHES'] = args.max_pending_searches
+    app.config['PLAYBACK_CACHE_BYTES'] = args.playback_cache_mb * 1024 ** 2
+    app.config['ANN_CANDIDATES'] = args.ann_candidates
+    app.config['USE_METRIC_INDEX'] = args.metric_index
+    app.config['QUERY_DURATION'] = args.query_duration
+    app.config['QUERY_SEGMENTS'] = args.query_segments
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    app.run(port=8000, debug=True, threaded=True)
 